@@ -0,0 +1,280 @@
+"""
+Micro-benchmarks for django-pinpayments' hot paths.
+
+Runs offline: Pin is replaced by InMemoryTransport serving canned
+responses, and the database is an in-memory SQLite one.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare results.json
+
+Results are written as JSON, with the per-call time of each benchmark in
+seconds, so runs from different releases can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    DEBUG=False,
+    SECRET_KEY='benchmarks',
+    USE_TZ=True,
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'pinpayments',
+    ],
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+    },
+    TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+    }],
+    PIN_ENVIRONMENTS={
+        'test': {
+            'key': 'pk_benchmark',
+            'secret': 'sk_benchmark',
+            'host': 'test-api.pin.net.au',
+            'transport': 'pinpayments.transports.InMemoryTransport',
+        },
+    },
+    PIN_DEFAULT_ENVIRONMENT='test',
+)
+django.setup()
+
+from django.core.management import call_command
+from django.template import Context, Template
+from pinpayments.models import PinTransaction
+from pinpayments.objects import get_environment
+from pinpayments.utils import CURRENCIES, get_value
+
+
+CHARGE_SUCCESS = {
+    'response': {
+        'token': 'ch_lfUYEBK14zotCTykezJkfg',
+        'success': True,
+        'amount': 400,
+        'currency': 'AUD',
+        'description': 'test charge',
+        'email': 'roland@pinpayments.com',
+        'ip_address': '203.192.1.172',
+        'created_at': '2012-06-20T03:10:49Z',
+        'status_message': 'Success',
+        'error_message': None,
+        'card': {
+            'token': 'card_pIQJKMs93GsCc9vLSLevbw',
+            'scheme': 'master',
+            'display_number': 'XXXX-XXXX-XXXX-0000',
+            'expiry_month': 5,
+            'expiry_year': 2025,
+            'name': 'Roland Robot',
+            'address_line1': '42 Sevenoaks St',
+            'address_line2': None,
+            'address_city': 'Lathlain',
+            'address_postcode': '6454',
+            'address_state': 'WA',
+            'address_country': 'Australia',
+            'primary': None,
+        },
+        'transfer': [],
+        'amount_refunded': 0,
+        'total_fees': 42,
+        'merchant_entitlement': 358,
+        'refund_pending': False,
+        'settlement_currency': 'AUD',
+    }
+}
+
+CHARGE_DECLINED = {
+    'error': 'card_declined',
+    'error_description': 'The card was declined',
+    'charge_token': 'ch_lfUYEBK14zotCTykezJkfg',
+    'messages': [{
+        'code': 'card_declined',
+        'message': 'The card was declined',
+        'param': 'card_token',
+    }],
+}
+
+# Each supported currency once, the largest balance Pin can report, with the
+# looked up currency (TWD) last in the list
+BALANCE = {
+    'response': {
+        'available': [
+            {'currency': currency, 'amount': 50000 + index}
+            for index, currency in enumerate(CURRENCIES)
+        ],
+        'pending': [
+            {'currency': currency, 'amount': 1000 + index}
+            for index, currency in enumerate(CURRENCIES)
+        ],
+    }
+}
+
+
+def new_transaction():
+    """ An unsaved transaction paid with a card token """
+    return PinTransaction(
+        card_token='card_pIQJKMs93GsCc9vLSLevbw',
+        ip_address='203.192.1.172',
+        amount=4,
+        currency='AUD',
+        description='test charge',
+        email_address='roland@pinpayments.com',
+        environment='test',
+    )
+
+
+def bench_transaction_save():
+    def run():
+        new_transaction().save()
+    return run
+
+
+def canned_response(method, url_tail, status_code, data):
+    """ Queues data as the only response to a request, returning it """
+    pin_env = get_environment('test')
+    pin_env.transport.clear()
+    pin_env.transport.add(method, url_tail, status_code, data)
+    return pin_env.transport.request(method.lower(), pin_env._url(
+        method.lower(), url_tail
+    ))
+
+
+def bench_parse_charge(data, status_code):
+    def setup():
+        pin_env = get_environment('test')
+        response = canned_response('POST', '/charges', status_code, data)
+
+        def run():
+            response_json = pin_env._parse_response(response, '', True)[1]
+            new_transaction()._record_response(response, response_json)
+        return run
+    return setup
+
+
+def bench_process_transaction(data, status_code):
+    def setup():
+        canned_response('POST', '/charges', status_code, data)
+
+        def run():
+            new_transaction().process_transaction()
+        return run
+    return setup
+
+
+def bench_get_balance():
+    pin_env = get_environment('test')
+    canned_response('GET', '/balance', 200, BALANCE)
+
+    def run():
+        pin_env.get_balance('TWD')
+    return run
+
+
+def bench_get_value():
+    pairs = [(1234 * index, currency) for index, currency in enumerate(
+        CURRENCIES * 4
+    )]
+
+    def run():
+        for amount, currency in pairs:
+            get_value(amount, currency)
+    return run
+
+
+def bench_template(source):
+    def setup():
+        template = Template(source)
+
+        def run():
+            template.render(Context({}))
+        return run
+    return setup
+
+
+# Each benchmark is a setup function, returning the callable to time
+BENCHMARKS = (
+    ('transaction_save', bench_transaction_save),
+    ('parse_charge_success', bench_parse_charge(CHARGE_SUCCESS, 200)),
+    ('parse_charge_declined', bench_parse_charge(CHARGE_DECLINED, 400)),
+    ('process_transaction_success',
+     bench_process_transaction(CHARGE_SUCCESS, 200)),
+    ('process_transaction_declined',
+     bench_process_transaction(CHARGE_DECLINED, 400)),
+    ('get_balance_all_currencies', bench_get_balance),
+    ('get_value_x60', bench_get_value),
+    ('pin_header_tag',
+     bench_template('{% load pin_payment_tags %}{% pin_header %}')),
+    ('pin_form_tag',
+     bench_template('{% load pin_payment_tags %}{% pin_form %}')),
+)
+
+
+def measure(func, repeat):
+    """ Returns the best and mean per-call time of func, in seconds """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return {
+        'number': number,
+        'best': min(times),
+        'mean': sum(times) / len(times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument(
+        '--compare', help="Compare against results from an earlier run"
+    )
+    parser.add_argument(
+        '--filter', default='', help="Only run benchmarks containing this"
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5, help="Timing runs per benchmark"
+    )
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)['benchmarks']
+
+    results = {}
+    for name, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        results[name] = measure(setup(), args.repeat)
+        line = "{0:<32} {1:>12.2f} us".format(name, results[name]['best'] * 1e6)
+        if name in baseline:
+            line += "  {0:>6.2f}x".format(
+                results[name]['best'] / baseline[name]['best']
+            )
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'benchmarks': results,
+            }, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,158 @@
 """ Administrative access to Pin data """
-from django.contrib import admin
+from itertools import islice
+import ipaddress
+
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.forms.models import BaseInlineFormSet
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
+from pinpayments.exceptions import PinError
 from pinpayments.models import (
-    PinRecipient, PinTransfer, PinTransaction, CustomerToken
+    IMPORTED_DECLINE_CODE, PinRecipient, PinTransfer, PinTransaction,
+    CustomerToken
 )
+from pinpayments.objects import get_environment
+from pinpayments.utils import CURRENCIES, get_value
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginates without counting every row of a large, unfiltered table.
+    On PostgreSQL the planner's estimate of the table size is used instead,
+    once it is over ESTIMATE_ABOVE rows.
+    """
+    ESTIMATE_ABOVE = 100000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = self._estimate(self.object_list)
+            if estimate is not None and estimate > self.ESTIMATE_ABOVE:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    def _estimate(self, queryset):
+        """ The estimated number of rows in the table, if available """
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            # Cast through regclass so the table is resolved on the
+            # search_path, rather than matching its name in any schema
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class "
+                "WHERE oid = %s::regclass",
+                [connection.ops.quote_name(queryset.model._meta.db_table)]
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
+class FixedChoicesListFilter(admin.SimpleListFilter):
+    """
+    Filters on an exact value of field, chosen from a fixed list rather
+    than every distinct value in the table, which would be read on each
+    load of the changelist
+    """
+    field = None
+    values = ()
+
+    def lookups(self, request, model_admin):
+        return self.values
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(**{self.field: self.value()})
+
+
+class EnvironmentListFilter(FixedChoicesListFilter):
+    """ The environments of PIN_ENVIRONMENTS """
+    title = _('environment')
+    parameter_name = field = 'environment'
+
+    def lookups(self, request, model_admin):
+        return [(name, name) for name in sorted(settings.PIN_ENVIRONMENTS)]
+
+
+class CurrencyListFilter(FixedChoicesListFilter):
+    """ The currencies Pin supports """
+    title = _('currency')
+    parameter_name = field = 'currency'
+    values = [(currency, currency) for currency in CURRENCIES]
+
+
+class TransferStatusListFilter(FixedChoicesListFilter):
+    """ The statuses Pin gives transfers """
+    title = _('status')
+    parameter_name = field = 'status'
+    values = (
+        ('pending', _('Pending')),
+        ('paid', _('Paid')),
+        ('failed', _('Failed')),
+    )
+
+
+class ErrorCodeListFilter(FixedChoicesListFilter):
+    """ The errors Pin gives failed charges """
+    title = _('error code')
+    parameter_name = field = 'error_code'
+    values = (
+        ('card_declined', _('Card declined')),
+        ('insufficient_funds', _('Insufficient funds')),
+        ('expired_card', _('Expired card')),
+        ('suspected_fraud', _('Suspected fraud')),
+        ('processing_error', _('Processing error')),
+        ('invalid_resource', _('Invalid resource')),
+        (IMPORTED_DECLINE_CODE, _('Declined, without an error code')),
+    )
+
+
+class CappedInlineFormSet(BaseInlineFormSet):
+    """
+    Shows only the first max_shown rows of an inline, in the order of its
+    queryset, so an object with thousands of children still loads quickly
+    """
+    max_shown = 20
+
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super(
+                CappedInlineFormSet, self
+            ).get_queryset()[:self.max_shown]
+        return self._capped_queryset
+
+
+class ChargeSearchForm(forms.Form):
+    """ A search of the charges held by Pin """
+    environment = forms.ChoiceField(label=_('Environment'))
+    query = forms.CharField(
+        label=_('Search'), required=False, help_text=_(
+            'Matched by Pin against the description, amount (eg 1000 for '
+            '$10.00), email address, IP address and currency'
+        )
+    )
+    start_date = forms.DateField(label=_('Created from'), required=False)
+    end_date = forms.DateField(label=_('Created until'), required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(ChargeSearchForm, self).__init__(*args, **kwargs)
+        self.fields['environment'].choices = [
+            (name, name) for name in sorted(settings.PIN_ENVIRONMENTS)
+        ]
+        self.fields['environment'].initial = getattr(
+            settings, 'PIN_DEFAULT_ENVIRONMENT', 'test'
+        )
 
 
 class PinTransactionAdmin(admin.ModelAdmin):
@@ -21,14 +169,25 @@ class PinTransactionAdmin(admin.ModelAdmin):
         'ip_address',
         'transaction_token',
     )
+    # Searched with indexed lookups by get_search_results
     search_fields = (
-        'email_address',
+        'email_lower',
         'ip_address',
         'card_token',
         'transaction_token',
     )
-    list_filter = ('processed', 'succeeded', 'environment', 'currency')
-    date_hierarchy = 'date'
+    # How the search box matches e-mail addresses: 'exact', 'prefix', or
+    # 'contains', which needs the trigram index of PIN_TRIGRAM_SEARCH
+    email_search = (
+        'contains' if getattr(settings, 'PIN_TRIGRAM_SEARCH', False)
+        else 'prefix'
+    )
+    list_filter = (
+        'date', 'processed', 'succeeded', ErrorCodeListFilter,
+        EnvironmentListFilter, CurrencyListFilter,
+    )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = (
         'date',
         'description',
@@ -38,8 +197,12 @@ class PinTransactionAdmin(admin.ModelAdmin):
         'amount',
         'currency',
         'fees',
+        'amount_minor',
+        'fees_minor',
         'email_address',
         'pin_response',
+        'error_code',
+        'error_message',
         'ip_address',
         'transaction_token',
         'card_token',
@@ -53,16 +216,95 @@ class PinTransactionAdmin(admin.ModelAdmin):
         'card_country',
         'card_number',
         'card_type',
-        'pin_response_text',
+        'response_text',
+        'pin_response_data',
     )
+    # The most charges shown by a search of Pin
+    search_pin_limit = 100
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Matches the search term against the lower cased e-mail address,
+        as set by email_search, and exactly against the IP address and
+        tokens, so every lookup can use an index
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        lookup = {
+            'exact': 'email_lower',
+            'prefix': 'email_lower__startswith',
+            'contains': 'email_lower__contains',
+        }[self.email_search]
+        match = (
+            Q(**{lookup: term.lower()})
+            | Q(card_token=term)
+            | Q(transaction_token=term)
+        )
+        try:
+            match |= Q(ip_address=str(ipaddress.ip_address(term)))
+        except ValueError:
+            pass
+        return queryset.filter(match), False
+
+    def get_urls(self):
+        return [
+            path(
+                'search-pin/',
+                self.admin_site.admin_view(self.search_pin_view),
+                name='pinpayments_pintransaction_search_pin',
+            ),
+        ] + super(PinTransactionAdmin, self).get_urls()
+
+    def search_pin_view(self, request):
+        """
+        Searches the charges held by Pin, for those not stored locally.
+        Pin does the filtering; charges that are stored here link to them.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        form = ChargeSearchForm(request.GET or None)
+        results = []
+        if form.is_valid():
+            search = dict(form.cleaned_data)
+            pin_env = get_environment(search.pop('environment'))
+            try:
+                charges = list(islice(
+                    pin_env.search_charges(**search), self.search_pin_limit
+                ))
+            except PinError as exc:
+                self.message_user(request, str(exc), messages.ERROR)
+                charges = []
+            stored = dict(PinTransaction.objects.filter(
+                transaction_token__in=[charge['token'] for charge in charges]
+            ).values_list('transaction_token', 'pk'))
+            results = [{
+                'charge': charge,
+                'value': get_value(charge['amount'], charge['currency']),
+                'pk': stored.get(charge['token']),
+            } for charge in charges]
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_('Search charges on Pin'),
+            opts=self.model._meta,
+            form=form,
+            results=results,
+            limit=self.search_pin_limit,
+        )
+        return TemplateResponse(
+            request,
+            'admin/pinpayments/pintransaction/search_pin.html',
+            context,
+        )
 
 
 class PinTransactionInline(admin.TabularInline):
     """
     Used to show transactions for a particular customer token, if using
-    the Customer API.
+    the Customer API. Only the most recent are shown.
     """
     model = PinTransaction
+    formset = CappedInlineFormSet
     fields = (
         'date',
         'processed',
@@ -77,7 +319,7 @@ class PinTransactionInline(admin.TabularInline):
     extra = 0
     can_delete = False
 
-    def has_add_permission(self, request):
+    def has_add_permission(self, request, obj=None):
         return False
 
 
@@ -92,9 +334,12 @@ class TokenAdmin(admin.ModelAdmin):
         'card_type',
         'card_number',
     )
-    search_fields = ('token', 'card_number')
-    list_filter = ('environment', 'card_type', 'active')
-    date_hierarchy = 'created'
+    search_fields = ('=token',)
+    list_filter = ('created', EnvironmentListFilter, 'card_type', 'active')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = (PinTransactionInline,)
     readonly_fields = ('environment', 'token', 'card_type', 'card_number')
 
@@ -108,10 +353,13 @@ class PinTransferAdmin(admin.ModelAdmin):
         'status',
     )
     search_fields = (
-        'recipient',
-        'transfer_token',
+        '=recipient__token',
+        '=transfer_token',
     )
-    date_hierarchy = 'created'
+    list_filter = ('created', TransferStatusListFilter)
+    list_select_related = ('recipient',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = (
         'transfer_token',
         'status',
@@ -133,8 +381,10 @@ class PinTransferAdmin(admin.ModelAdmin):
 
 
 class PinTransferInline(admin.TabularInline):
-    """ Shows transfers under recipients """
+    """ Shows the most recent transfers under recipients """
     model = PinTransfer
+    formset = CappedInlineFormSet
+    ordering = ('-created',)
     fields = [
         'created',
         'get_value',
@@ -147,7 +397,7 @@ class PinTransferInline(admin.TabularInline):
     extra = 0
     can_delete = False
 
-    def has_add_permission(self, request):
+    def has_add_permission(self, request, obj=None):
         return False
 
     def get_value(self, obj):
@@ -165,9 +415,11 @@ class PinRecipientAdmin(admin.ModelAdmin):
         'created',
         'bank_account',
     )
-    search_fields = ('token', 'email', 'name')
-    list_filter = ('environment',)
-    date_hierarchy = 'created'
+    search_fields = ('=token', 'email', 'name')
+    list_filter = (EnvironmentListFilter,)
+    list_select_related = ('bank_account',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = (PinTransferInline,)
     readonly_fields = list_display  # all the fields
 
@@ -9,3 +9,7 @@ class ConfigError(Exception):
 
 class PinError(Exception):
     """ Errors related to Pin """
+
+
+class PinTimeout(PinError):
+    """ A request to Pin, or the deadline for an operation, ran out of time """
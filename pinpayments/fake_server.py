@@ -0,0 +1,411 @@
+"""
+A stand-in for the Pin API, for load testing without touching Pin.
+Serves charges (including searches), customers, recipients, transfers and
+balances from memory over plain HTTP, with configurable latency, error
+rate and rate limit.
+
+Point an environment at it with 'scheme': 'http', eg:
+
+    PIN_ENVIRONMENTS = {
+        'fake': {
+            'key': 'pk_fake',
+            'secret': 'sk_fake',
+            'host': '127.0.0.1:8765',
+            'scheme': 'http',
+        },
+    }
+
+Charges made with the card token 'card_declined' are declined.
+"""
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+from .utils import CURRENCIES
+
+
+PER_PAGE = 25
+# The fields of a charge matched by the query of a charge search
+SEARCHED_FIELDS = ('description', 'amount', 'email', 'ip_address', 'currency')
+DECLINED_CARD_TOKEN = 'card_declined'
+TOKEN_PREFIXES = {
+    'charges': 'ch',
+    'customers': 'cus',
+    'recipients': 'rp',
+    'transfers': 'tfer',
+}
+
+CARD = {
+    'scheme': 'master',
+    'display_number': 'XXXX-XXXX-XXXX-0000',
+    'expiry_month': 5,
+    'expiry_year': 2030,
+    'name': 'Roland Robot',
+    'address_line1': '42 Sevenoaks St',
+    'address_line2': None,
+    'address_city': 'Lathlain',
+    'address_postcode': '6454',
+    'address_state': 'WA',
+    'address_country': 'Australia',
+    'primary': True,
+}
+
+
+def _flatten(data, prefix=''):
+    """
+    The members of a JSON body as form fields, so nested objects such as
+    {'bank_account': {'name': ...}} are read as bank_account[name]
+    """
+    fields = {}
+    for name, value in data.items():
+        if '[' in name:
+            # Like Pin, only nested objects are understood in JSON
+            continue
+        field = '{0}[{1}]'.format(prefix, name) if prefix else name
+        if isinstance(value, dict):
+            fields.update(_flatten(value, field))
+        else:
+            fields[field] = value
+    return fields
+
+
+def _error(status, error, description):
+    """ A Pin error response """
+    return status, {'error': error, 'error_description': description}
+
+
+def _not_found():
+    return _error(404, 'not_found', 'The requested resource could not be found.')
+
+
+class FakePinServer(ThreadingHTTPServer):
+    """
+    An HTTP server imitating the Pin API.
+    latency is the seconds taken to answer each request, error_rate the
+    fraction of requests answered with a 500, and rate_limit the number of
+    requests answered each second before 429s are returned (0 for none).
+    Every currency starts with opening_balance available for transfers.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0, error_rate=0, rate_limit=0,
+                 opening_balance=10 ** 12):
+        ThreadingHTTPServer.__init__(self, address, FakePinHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.tokens = itertools.count(1)
+        self.records = {
+            'charges': [],
+            'customers': [],
+            'recipients': [],
+            'transfers': [],
+        }
+        self.window = None
+        self.window_count = 0
+        self.balances = dict(
+            (currency, opening_balance) for currency in CURRENCIES
+        )
+
+    @property
+    def host(self):
+        """ The host and port to set as the 'host' of an environment """
+        return '{0}:{1}'.format(*self.server_address[:2])
+
+    def serve_in_thread(self):
+        """ Starts serving from a daemon thread, returning the thread """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def rate_limited(self):
+        """ Whether the current request is over this second's rate limit """
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window = window
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.rate_limit
+
+    def new_token(self, prefix):
+        return '{0}_fake{1:08d}'.format(prefix, next(self.tokens))
+
+    def add(self, kind, record):
+        """ Stores a newly created record, returning it """
+        with self.lock:
+            record['token'] = self.new_token(TOKEN_PREFIXES[kind])
+            record['created_at'] = datetime.now(timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'
+            )
+            self.records[kind].append(record)
+        return record
+
+    def find(self, kind, token):
+        with self.lock:
+            for record in self.records[kind]:
+                if record['token'] == token:
+                    return record
+        return None
+
+    def page(self, kind, page, match=None):
+        """
+        A page of records, newest first, as returned by list endpoints.
+        Only records for which match returns True are listed, if given.
+        """
+        with self.lock:
+            records = [
+                record for record in reversed(self.records[kind])
+                if match is None or match(record)
+            ]
+        pages = max(1, (len(records) + PER_PAGE - 1) // PER_PAGE)
+        start = (page - 1) * PER_PAGE
+        return 200, {
+            'response': records[start:start + PER_PAGE],
+            'count': len(records),
+            'pagination': {
+                'current': page,
+                'previous': page - 1 if page > 1 else None,
+                'next': page + 1 if page < pages else None,
+                'per_page': PER_PAGE,
+                'pages': pages,
+                'count': len(records),
+            },
+        }
+
+    def search_charges(self, params):
+        """ A page of the charges matching a search, newest first """
+        query = params.get('query', '').lower()
+        start_date = params.get('start_date', '').replace('/', '-')
+        end_date = params.get('end_date', '').replace('/', '-')
+
+        def match(charge):
+            date = charge['created_at'][:10]
+            if (start_date and date < start_date) or (
+                    end_date and date > end_date):
+                return False
+            return not query or any(
+                query in str(charge.get(field) or '').lower()
+                for field in SEARCHED_FIELDS
+            )
+        return self.page('charges', int(params.get('page', 1)), match)
+
+    def create_charge(self, params):
+        amount = int(params.get('amount', 0))
+        currency = params.get('currency', 'AUD').upper()
+        card_token = params.get('card_token')
+        if card_token == DECLINED_CARD_TOKEN:
+            return 400, {
+                'error': 'card_declined',
+                'error_description': 'The card was declined',
+                'charge_token': self.new_token('ch'),
+                'messages': [{
+                    'code': 'card_declined',
+                    'message': 'The card was declined',
+                    'param': 'card_token',
+                }],
+            }
+        metadata = dict(
+            (name[len('metadata['):-1], value)
+            for name, value in params.items()
+            if name.startswith('metadata[')
+        )
+        fees = 30 + amount * 175 // 10000
+        card = dict(CARD, token=card_token or self.new_token('card'))
+        charge = self.add('charges', {
+            'success': True,
+            'amount': amount,
+            'currency': currency,
+            'description': params.get('description'),
+            'email': params.get('email'),
+            'ip_address': params.get('ip_address'),
+            'status_message': 'Success',
+            'error_message': None,
+            'card': card,
+            'transfer': [],
+            'amount_refunded': 0,
+            'total_fees': fees,
+            'merchant_entitlement': amount - fees,
+            'refund_pending': False,
+            'settlement_currency': currency,
+            'metadata': metadata,
+        })
+        with self.lock:
+            self.balances[currency] = self.balances.get(currency, 0) + (
+                amount - fees
+            )
+        return 201, {'response': charge}
+
+    def create_customer(self, params):
+        customer = self.add('customers', {
+            'email': params.get('email'),
+            'card': dict(CARD, token=params.get('card_token')),
+        })
+        return 201, {'response': customer}
+
+    def update_customer(self, token, params):
+        customer = self.find('customers', token)
+        if customer is None:
+            return _not_found()
+        with self.lock:
+            customer['card'] = dict(CARD, token=params.get('card_token'))
+        return 200, {'response': customer}
+
+    def create_recipient(self, params):
+        recipient = self.add('recipients', {
+            'email': params.get('email'),
+            'name': params.get('name'),
+            'bank_account': {
+                'token': self.new_token('ba'),
+                'name': params.get('bank_account[name]'),
+                'bsb': params.get('bank_account[bsb]'),
+                'number': params.get('bank_account[number]'),
+                'bank_name': 'Fake Bank',
+                'branch': 'Fake Branch',
+            },
+        })
+        return 201, {'response': recipient}
+
+    def create_transfer(self, params):
+        if self.find('recipients', params.get('recipient')) is None:
+            return _error(
+                422, 'invalid_resource', 'The recipient does not exist.'
+            )
+        amount = int(params.get('amount', 0))
+        currency = params.get('currency', 'AUD').upper()
+        with self.lock:
+            if self.balances.get(currency, 0) < amount:
+                return _error(
+                    422, 'insufficient_pin_balance',
+                    'There are insufficient funds for this transfer.'
+                )
+            self.balances[currency] -= amount
+        transfer = self.add('transfers', {
+            'status': 'pending',
+            'currency': currency,
+            'description': params.get('description'),
+            'amount': amount,
+            'total_debits': amount,
+            'total_credits': 0,
+            'recipient': params.get('recipient'),
+        })
+        return 201, {'response': transfer}
+
+    def balance(self):
+        with self.lock:
+            available = [
+                {'currency': currency, 'amount': amount}
+                for currency, amount in sorted(self.balances.items())
+            ]
+        return 200, {'response': {
+            'available': available,
+            'pending': [
+                dict(entry, amount=0) for entry in available
+            ],
+        }}
+
+    def respond(self, method, path, params):
+        """ Returns the status and body of the answer to a request """
+        match = re.match(r'^/1/(\w+)(?:/(\w+))?/?$', path)
+        if match is None:
+            return _not_found()
+        kind, token = match.groups()
+        if method == 'GET' and kind == 'balance' and token is None:
+            return self.balance()
+        if method == 'GET' and kind in ('charges', 'transfers') and not token:
+            return self.page(kind, int(params.get('page', 1)))
+        if method == 'GET' and kind == 'charges' and token == 'search':
+            return self.search_charges(params)
+        if method == 'GET' and kind in self.records and token:
+            record = self.find(kind, token)
+            if record is None:
+                return _not_found()
+            return 200, {'response': record}
+        if method == 'POST' and token is None:
+            create = {
+                'charges': self.create_charge,
+                'customers': self.create_customer,
+                'recipients': self.create_recipient,
+                'transfers': self.create_transfer,
+            }.get(kind)
+            if create is not None:
+                return create(params)
+        if method == 'PUT' and kind == 'customers' and token:
+            return self.update_customer(token, params)
+        return _not_found()
+
+
+class FakePinHandler(BaseHTTPRequestHandler):
+    """ Answers each request from the state held by its FakePinServer """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        """ The request parameters, from the query string and body """
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if body:
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params.update(_flatten(json.loads(body.decode('utf-8'))))
+            else:
+                params.update(parse_qsl(body.decode('utf-8')))
+        return params
+
+    def _handle(self, method):
+        server = self.server
+        params = self._params()
+        if server.latency:
+            time.sleep(server.latency)
+
+        headers = {}
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            status, data = _error(
+                401, 'unauthenticated', 'Not authorised. (Check API Key)'
+            )
+        elif server.rate_limited():
+            status, data = _error(
+                429, 'too_many_requests', 'Too many requests.'
+            )
+            headers['Retry-After'] = '1'
+        elif server.error_rate and random.random() < server.error_rate:
+            status, data = _error(
+                500, 'server_error', 'An internal error occurred.'
+            )
+        else:
+            status, data = server.respond(
+                method, urlsplit(self.path).path, params
+            )
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
@@ -0,0 +1,40 @@
+""" Prints the decline rate of processed transactions by error code """
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from pinpayments.models import PinTransaction
+
+
+class Command(BaseCommand):
+    """
+    Prints one line per day and error code, with the number of processed
+    transactions that failed with it and their share of that day's total
+    """
+    help = "Report declines by day and error code"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', default=None,
+            help="Only report on transactions for this Pin environment"
+        )
+        parser.add_argument(
+            '--days', type=int, default=30,
+            help="Number of days to report on"
+        )
+
+    def handle(self, *args, **options):
+        transactions = PinTransaction.objects.filter(
+            date__gte=timezone.now() - timedelta(days=options['days'])
+        )
+        if options['environment']:
+            transactions = transactions.filter(
+                environment=options['environment']
+            )
+        for row in transactions.decline_report():
+            if row['error_code'] is None:
+                continue
+            self.stdout.write("{0} {1} {2} {3:.1%}".format(
+                row['day'], row['error_code'], row['count'], row['rate']
+            ))
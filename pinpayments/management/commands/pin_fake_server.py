@@ -0,0 +1,49 @@
+""" Runs a local stand-in for the Pin API, for load testing """
+from django.core.management.base import BaseCommand
+
+from pinpayments.fake_server import FakePinServer
+
+
+class Command(BaseCommand):
+    """
+    Serves a fake Pin API over plain HTTP until interrupted. Point an
+    environment at it with 'scheme': 'http' and 'host': 'HOST:PORT'.
+    """
+    help = "Run a fake Pin API server for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host', default='127.0.0.1', help="The address to listen on"
+        )
+        parser.add_argument(
+            '--port', type=int, default=8765, help="The port to listen on"
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help="Seconds to wait before answering each request"
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help="Fraction of requests to answer with a 500, eg 0.01"
+        )
+        parser.add_argument(
+            '--rate-limit', type=int, default=0,
+            help="Requests to answer each second before returning 429s"
+        )
+
+    def handle(self, *args, **options):
+        server = FakePinServer(
+            (options['host'], options['port']),
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'],
+        )
+        self.stdout.write("Fake Pin API listening on http://{0}/1/".format(
+            server.host
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,26 @@
+""" Backfills PinTransaction from the charges held by Pin """
+from django.core.management.base import BaseCommand
+
+from pinpayments.models import PinTransaction
+
+
+class Command(BaseCommand):
+    """
+    Copies Pin's charge history for an environment into PinTransaction,
+    updating any charges that are already stored.
+    """
+    help = "Import charges from Pin into PinTransaction"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', default='',
+            help="The Pin environment to import from, eg test or live"
+        )
+
+    def handle(self, *args, **options):
+        created, updated = PinTransaction.objects.import_charges(
+            options['environment']
+        )
+        self.stdout.write(
+            "Created {0} transactions, updated {1}".format(created, updated)
+        )
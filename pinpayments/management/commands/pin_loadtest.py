@@ -0,0 +1,150 @@
+""" Drives the payment path at a given concurrency, reporting latency """
+import math
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from pinpayments.models import (
+    CustomerToken, PinRecipient, PinTransaction, PinTransfer
+)
+from pinpayments.objects import get_environment
+
+
+CARD_TOKEN = 'card_pIQJKMs93GsCc9vLSLevbw'
+EMAIL = 'pin-loadtest@example.com'
+PIN_HOSTS = ('pinpayments.com', 'pin.net.au')
+
+
+def percentile(latencies, percent):
+    """ The nearest-rank percentile of a sorted list of latencies """
+    if not latencies:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+
+class Command(BaseCommand):
+    """
+    Sends charges, customers or transfers through the library as fast as
+    the given number of threads allows, then reports throughput and p50 and
+    p99 latency. Intended for use against pin_fake_server, never Pin itself.
+    """
+    help = "Load test charges, customers or transfers against a Pin API"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', default='',
+            help="The Pin environment to use, eg one pointing at "
+                 "pin_fake_server"
+        )
+        parser.add_argument(
+            '--operation', default='charge',
+            choices=['charge', 'customer', 'transfer'],
+            help="What to send: process_transaction, "
+                 "CustomerToken.create_from_card_token or PinTransfer.send_new"
+        )
+        parser.add_argument(
+            '--requests', type=int, default=1000,
+            help="Total number of operations to send"
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=10,
+            help="Number of operations in flight at once"
+        )
+
+    def handle(self, *args, **options):
+        pin_env = get_environment(options['environment'])
+        if pin_env.host.split(':')[0].endswith(PIN_HOSTS):
+            raise CommandError(
+                "Refusing to load test Pin itself; use pin_fake_server"
+            )
+        operation = getattr(self, 'send_' + options['operation'])
+        context = self.prepare(options['operation'], pin_env)
+
+        total = options['requests']
+        concurrency = max(1, min(options['concurrency'], total))
+        latencies = []
+        errors = []
+        threads = [
+            threading.Thread(target=self.run_worker, args=(
+                operation, context, total // concurrency +
+                (1 if index < total % concurrency else 0),
+                latencies, errors
+            ))
+            for index in range(concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write(
+            "Sent {0} {1} operations in {2:.2f}s with concurrency {3}: "
+            "{4:.1f}/s, p50 {5:.1f}ms, p99 {6:.1f}ms, {7} errors".format(
+                total, options['operation'], elapsed, concurrency,
+                total / elapsed if elapsed else 0,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000,
+                len(errors),
+            )
+        )
+        if errors:
+            self.stdout.write("First error: {0}".format(errors[0]))
+
+    def run_worker(self, operation, context, count, latencies, errors):
+        """ Sends count operations one after another, timing each """
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    operation(context)
+                except Exception as exc:
+                    errors.append(exc)
+                latencies.append(time.perf_counter() - started)
+        finally:
+            connection.close()
+
+    def prepare(self, operation, pin_env):
+        """ Creates whatever each operation needs before timing starts """
+        if operation == 'customer':
+            user_model = get_user_model()
+            user, _ = user_model._default_manager.get_or_create(
+                defaults={user_model.get_email_field_name(): EMAIL},
+                **{user_model.USERNAME_FIELD: EMAIL}
+            )
+            return {'user': user, 'environment': pin_env.name}
+        if operation == 'transfer':
+            recipient = PinRecipient.create_with_bank_account(
+                EMAIL, 'Load Test', '123456', '987654321',
+                environment=pin_env.name
+            )
+            return {'recipient': recipient}
+        return {'environment': pin_env.name}
+
+    def send_charge(self, context):
+        PinTransaction(
+            card_token=CARD_TOKEN,
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            description='Load test',
+            email_address=EMAIL,
+            environment=context['environment'],
+        ).process_transaction()
+
+    def send_customer(self, context):
+        CustomerToken.create_from_card_token(
+            CARD_TOKEN, context['user'], context['environment']
+        )
+
+    def send_transfer(self, context):
+        PinTransfer.send_new(
+            100, 'Load test', context['recipient'],
+            environment=context['recipient'].environment
+        )
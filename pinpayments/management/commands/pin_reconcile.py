@@ -0,0 +1,87 @@
+""" Reports differences between the stored records and those held by Pin """
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from pinpayments.models import ReconciliationCheckpoint
+from pinpayments.objects import get_environment
+from pinpayments.reconcile import reconcile_charges, reconcile_transfers
+
+
+RECONCILERS = (
+    ('charges', reconcile_charges),
+    ('transfers', reconcile_transfers),
+)
+
+
+class Command(BaseCommand):
+    """
+    Compares PinTransactions and PinTransfers with the charges and transfers
+    held by Pin, printing one line per discrepancy.
+    Each run starts where the last one finished, unless told otherwise.
+    """
+    help = "Reconcile stored charges and transfers against Pin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', default='',
+            help="The Pin environment to reconcile, eg test or live"
+        )
+        parser.add_argument(
+            '--only', choices=[kind for kind, _ in RECONCILERS],
+            help="Only reconcile charges or transfers"
+        )
+        parser.add_argument(
+            '--since',
+            help="Reconcile records created from this ISO 8601 time, "
+                 "ignoring the saved checkpoint"
+        )
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Reconcile every record, ignoring the saved checkpoint"
+        )
+        parser.add_argument(
+            '--no-checkpoint', action='store_true',
+            help="Don't save a checkpoint at the end of the run"
+        )
+
+    def handle(self, *args, **options):
+        pin_env = get_environment(options['environment'])
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(
+                    "Invalid --since time '{0}'".format(options['since'])
+                )
+            if settings.USE_TZ and timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        for kind, reconcile in RECONCILERS:
+            if options['only'] and options['only'] != kind:
+                continue
+            checkpoint = ReconciliationCheckpoint.objects.filter(
+                environment=pin_env.name, kind=kind
+            ).first()
+            start = since
+            if start is None and checkpoint and not options['full']:
+                start = checkpoint.reconciled_until
+            until = timezone.now()
+
+            found = 0
+            for discrepancy in reconcile(pin_env, start, until):
+                found += 1
+                self.stdout.write("{0} {1} {2} local={3} remote={4}".format(
+                    kind, discrepancy.kind, discrepancy.token,
+                    discrepancy.local, discrepancy.remote
+                ))
+            self.stdout.write("Found {0} discrepancies in {1}".format(
+                found, kind
+            ))
+
+            if not options['no_checkpoint']:
+                ReconciliationCheckpoint.objects.update_or_create(
+                    environment=pin_env.name, kind=kind,
+                    defaults={'reconciled_until': until}
+                )
@@ -0,0 +1,68 @@
+""" Drains unprocessed transactions, safely alongside other workers """
+import time
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.models import PinTransaction, process_concurrently
+
+
+class Command(BaseCommand):
+    """
+    Claims batches of unprocessed PinTransactions and sends them to Pin.
+    Any number of workers can run at once, on any number of hosts; each
+    row is claimed by exactly one of them.
+    """
+    help = "Send unprocessed PinTransactions to Pin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', default=None,
+            help="Only process transactions for this Pin environment"
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Number of transactions to claim at a time"
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help="Number of transactions to send to Pin in parallel"
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help="Seconds to wait before polling again once drained"
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Exit once there is nothing left to process"
+        )
+
+    def handle(self, *args, **options):
+        pending = PinTransaction.objects.all()
+        if options['environment']:
+            pending = pending.filter(environment=options['environment'])
+
+        while True:
+            claimed = pending.claim(options['batch_size'])
+            if not claimed:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+
+            outcomes = process_concurrently(
+                claimed, 'send_claimed', options['concurrency']
+            )
+            succeeded = 0
+            for transaction in claimed:
+                outcome = outcomes.get(transaction.pk)
+                if isinstance(outcome, Exception):
+                    PinTransaction.objects.filter(pk=transaction.pk).update(
+                        pin_response='Failure: {0}'.format(outcome)[:255]
+                    )
+                elif transaction.succeeded:
+                    succeeded += 1
+            self.stdout.write(
+                "Processed {0} transactions, {1} succeeded".format(
+                    len(claimed), succeeded
+                )
+            )
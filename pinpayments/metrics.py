@@ -0,0 +1,130 @@
+"""
+Hooks for recording metrics about calls to Pin.
+Set PIN_METRICS_BACKEND to the dotted path of a MetricsBackend subclass to
+receive them. With no backend configured nothing is measured.
+"""
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .exceptions import PinTimeout
+
+
+logger = logging.getLogger('pinpayments.metrics')
+
+# Path segments holding a token (eg /customers/cus_XXXX) are replaced so
+# that endpoint labels don't grow without bound. Tokens are a lowercase
+# prefix, an underscore and a random part holding capitals or digits, which
+# keeps resource names such as /bank_accounts intact.
+TOKEN_SEGMENT = re.compile(
+    r'/[a-z]+_(?=[a-z-]*[A-Z0-9])[A-Za-z0-9-]+(?=/|$)'
+)
+
+_backend = None
+_backend_loaded = False
+
+
+class MetricsBackend(object):
+    """
+    Receives measurements of calls to Pin. Subclass it and override the
+    methods you need; the defaults discard everything.
+    """
+    def request_started(self, environment, method, endpoint):
+        """
+        A request to Pin is about to be sent. Together with
+        request_finished, this lets a backend track requests in flight.
+        """
+
+    def request_finished(self, environment, method, endpoint, status,
+                         duration, retries, error):
+        """
+        A request to Pin has finished, including any retries.
+        status is the final HTTP status, or None if no response arrived.
+        error is None on success, or one of 'timeout', 'transport',
+        'rate_limited', 'client' or 'server'.
+        """
+
+    def timing(self, environment, name, duration):
+        """
+        Some other step took duration seconds, eg 'parse' for decoding a
+        response or 'transaction_save' for saving a PinTransaction
+        """
+
+
+class LoggingMetricsBackend(MetricsBackend):
+    """ Writes every measurement to the pinpayments.metrics logger """
+    def request_finished(self, environment, method, endpoint, status,
+                         duration, retries, error):
+        logger.info(
+            "%s %s %s status=%s duration=%.3f retries=%d error=%s",
+            environment, method.upper(), endpoint, status, duration,
+            retries, error
+        )
+
+    def timing(self, environment, name, duration):
+        logger.info("%s %s duration=%.3f", environment, name, duration)
+
+
+def get_metrics_backend():
+    """ Returns the configured MetricsBackend instance, or None """
+    global _backend, _backend_loaded
+    if not _backend_loaded:
+        path = getattr(settings, 'PIN_METRICS_BACKEND', None)
+        _backend = import_string(path)() if path else None
+        _backend_loaded = True
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    """ Load the backend again when PIN_METRICS_BACKEND changes """
+    global _backend, _backend_loaded
+    if setting == 'PIN_METRICS_BACKEND':
+        _backend = None
+        _backend_loaded = False
+
+
+def endpoint_label(url_tail):
+    """ The URL of a request, with any tokens in it replaced by :token """
+    return TOKEN_SEGMENT.sub('/:token', url_tail)
+
+
+def error_category(status, exc):
+    """ Groups the outcome of a request for request_finished """
+    if exc is not None:
+        if isinstance(exc, PinTimeout):
+            return 'timeout'
+        return 'transport'
+    if status == 429:
+        return 'rate_limited'
+    if status is not None and status >= 500:
+        return 'server'
+    if status is not None and status >= 400:
+        return 'client'
+    return None
+
+
+class Measurement(object):
+    """ Times one call to Pin, and reports it to the backend when done """
+    def __init__(self, backend, environment, method, url_tail):
+        self.backend = backend
+        self.environment = environment
+        self.method = method
+        self.endpoint = endpoint_label(url_tail)
+        self.retries = 0
+        backend.request_started(environment, method, self.endpoint)
+        self.started = time.perf_counter()
+
+    def finish(self, response=None, exc=None):
+        """ Report the request as finished with a response or exception """
+        status = getattr(response, 'status_code', None)
+        self.backend.request_finished(
+            self.environment, self.method, self.endpoint, status,
+            time.perf_counter() - self.started, self.retries,
+            error_category(status, exc)
+        )
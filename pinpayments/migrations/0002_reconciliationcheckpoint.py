@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('environment', models.CharField(help_text='The name of the Pin environment to use, eg test or live.', max_length=25)),
+                ('kind', models.CharField(choices=[('charges', 'Charges'), ('transfers', 'Transfers')], max_length=20)),
+                ('reconciled_until', models.DateTimeField(help_text='Records created before this time have been reconciled')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('environment', 'kind')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:56
+
+from django.db import migrations, models
+
+from pinpayments.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently on PostgreSQL, which can't be
+    # done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0002_reconciliationcheckpoint'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='customertoken',
+            index=models.Index(condition=models.Q(('active', True)), fields=['user', 'environment'], name='pin_token_user_active_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['environment', 'date'], name='pin_txn_unprocessed_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['customer_token', '-date'], name='pin_txn_customer_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['succeeded', '-date'], name='pin_txn_succeeded_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['currency', '-date'], name='pin_txn_currency_date_idx'),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:59
+
+import json
+
+from django.db import migrations, models
+
+from pinpayments.operations import AddIndexConcurrently
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_response_data(apps, schema_editor):
+    """
+    Decodes the stored response of existing transactions, a batch at a
+    time, and copies out the error code and message
+    """
+    PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+    pending = PinTransaction.objects.filter(
+        pin_response_text__isnull=False, pin_response_data__isnull=True
+    ).only('pk', 'pin_response_text').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        changed = []
+        for transaction in batch:
+            try:
+                data = json.loads(transaction.pin_response_text)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            transaction.pin_response_data = data
+            message = data.get('error_message')
+            if 'error' in data:
+                transaction.error_code = data['error']
+                messages = data.get('messages') or [{}]
+                message = messages[0].get(
+                    'message', data.get('error_description')
+                )
+            transaction.error_message = (message or '')[:255] or None
+            changed.append(transaction)
+        PinTransaction.objects.bulk_update(
+            changed, ['pin_response_data', 'error_code', 'error_message']
+        )
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently on PostgreSQL, and the backfill
+    # commits batch by batch, so this can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0003_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransaction',
+            name='error_code',
+            field=models.CharField(blank=True, help_text='The error Pin gave for a failed charge, eg card_declined', max_length=100, null=True, verbose_name='Error Code'),
+        ),
+        migrations.AddField(
+            model_name='pintransaction',
+            name='error_message',
+            field=models.CharField(blank=True, help_text='The reason Pin gave for a failed charge', max_length=255, null=True, verbose_name='Error Message'),
+        ),
+        migrations.AddField(
+            model_name='pintransaction',
+            name='pin_response_data',
+            field=models.JSONField(blank=True, help_text='The JSON response from the Pin API, for querying', null=True, verbose_name='API Response Data'),
+        ),
+        migrations.RunPython(
+            backfill_response_data, migrations.RunPython.noop, elidable=True
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['error_code', 'date'], name='pin_txn_error_code_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['card_type', 'date'], name='pin_txn_card_type_idx'),
+        ),
+    ]
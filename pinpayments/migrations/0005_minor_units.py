@@ -0,0 +1,78 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:02
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+# Frozen copies of pinpayments.utils.CURRENCY_EXPONENTS and get_minor_units
+# as they were when this migration was written, so later changes to them
+# don't change what it does
+CURRENCY_EXPONENTS = {
+    'AUD': 2, 'USD': 2, 'NZD': 2, 'SGD': 2, 'EUR': 2, 'GBP': 2, 'CAD': 2,
+    'HKD': 2, 'JPY': 0, 'MYR': 0, 'THB': 0, 'PHP': 0, 'ZAR': 0, 'IDR': 0,
+    'TWD': 0,
+}
+
+
+def get_minor_units(value, currency):
+    """ A value in the currency's usual unit in its base unit, eg cents """
+    return int(Decimal(value).scaleb(
+        CURRENCY_EXPONENTS.get(currency, 0)
+    ).to_integral_value(ROUND_HALF_UP))
+
+
+def backfill_minor_units(apps, schema_editor):
+    """
+    Fills in amount_minor and fees_minor for existing transactions, a
+    batch at a time
+    """
+    PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+    pending = PinTransaction.objects.filter(
+        amount_minor__isnull=True
+    ).only('pk', 'amount', 'fees', 'currency').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        for transaction in batch:
+            transaction.amount_minor = get_minor_units(
+                transaction.amount, transaction.currency
+            )
+            if transaction.fees is not None:
+                transaction.fees_minor = get_minor_units(
+                    transaction.fees, transaction.currency
+                )
+        PinTransaction.objects.bulk_update(
+            batch, ['amount_minor', 'fees_minor']
+        )
+
+
+class Migration(migrations.Migration):
+    # The backfill commits batch by batch, so large tables aren't held in
+    # one long transaction
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0004_response_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransaction',
+            name='amount_minor',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='The amount in the base unit of the currency, eg cents for AUD or yen for JPY. Kept in step with amount when saved.', null=True, verbose_name='Amount (Base Unit)'),
+        ),
+        migrations.AddField(
+            model_name='pintransaction',
+            name='fees_minor',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='The fees in the base unit of the currency, as reported by Pin', null=True, verbose_name='Transaction Fees (Base Unit)'),
+        ),
+        migrations.RunPython(
+            backfill_minor_units, migrations.RunPython.noop, elidable=True
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+from pinpayments.operations import AddIndexConcurrently
+
+
+BATCH_SIZE = 1000
+TRIGRAM_INDEX = 'pin_txn_email_trgm_idx'
+
+
+def backfill_email_lower(apps, schema_editor):
+    """
+    Fills in email_lower for existing transactions, with one UPDATE per
+    batch of rows
+    """
+    PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+    pending = PinTransaction.objects.filter(
+        email_lower__isnull=True
+    ).order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            return
+        last_pk = batch[-1]
+        PinTransaction.objects.filter(pk__in=batch).update(
+            email_lower=Lower('email_address')
+        )
+
+
+def add_trigram_index(apps, schema_editor):
+    """
+    With PIN_TRIGRAM_SEARCH set, adds a pg_trgm index on PostgreSQL, so
+    the admin can search for e-mail addresses containing any text
+    """
+    connection = schema_editor.connection
+    if (connection.vendor != 'postgresql'
+            or not getattr(settings, 'PIN_TRIGRAM_SEARCH', False)):
+        return
+    PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} "
+        "USING gin (email_lower gin_trgm_ops)".format(
+            TRIGRAM_INDEX,
+            schema_editor.quote_name(PinTransaction._meta.db_table),
+        )
+    )
+
+
+def remove_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "DROP INDEX CONCURRENTLY IF EXISTS {0}".format(TRIGRAM_INDEX)
+        )
+
+
+class Migration(migrations.Migration):
+    # The backfill commits batch by batch, and the indexes are built
+    # concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0005_minor_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransaction',
+            name='email_lower',
+            field=models.CharField(blank=True, editable=False, help_text='The e-mail address in lower case, for indexed searches. Kept in step with the e-mail address when saved.', max_length=100, null=True, verbose_name='E-Mail Address (Lower Case)'),
+        ),
+        migrations.RunPython(
+            backfill_email_lower, migrations.RunPython.noop, elidable=True
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['email_lower'], name='pin_txn_email_lower_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['ip_address'], name='pin_txn_ip_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pintransaction',
+            index=models.Index(fields=['card_token'], name='pin_txn_card_token_idx'),
+        ),
+        migrations.RunPython(add_trigram_index, remove_trigram_index),
+    ]
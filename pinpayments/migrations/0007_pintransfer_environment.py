@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_environment(apps, schema_editor):
+    """
+    Fills in the environment of existing transfers, a batch at a time.
+    Transfers were sent with the default environment, as their recipients
+    were created, so the recipient's environment is used where it is known.
+    """
+    PinTransfer = apps.get_model('pinpayments', 'PinTransfer')
+    default = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+    pending = PinTransfer.objects.filter(environment='').only(
+        'pk', 'recipient__environment'
+    ).select_related('recipient').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        for transfer in batch:
+            recipient = transfer.recipient
+            transfer.environment = (
+                recipient and recipient.environment
+            ) or default
+        PinTransfer.objects.bulk_update(batch, ['environment'])
+
+
+class Migration(migrations.Migration):
+    # The backfill commits batch by batch, so large tables aren't held in
+    # one long transaction
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0006_email_ip_lookups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransfer',
+            name='environment',
+            field=models.CharField(blank=True, db_index=True, help_text='The name of the Pin environment to use, eg test or live.', max_length=25),
+        ),
+        migrations.RunPython(
+            backfill_environment, migrations.RunPython.noop, elidable=True
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:43
+
+from django.db import migrations, models
+
+from pinpayments.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The index is built concurrently on PostgreSQL, which can't be done
+    # inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('pinpayments', '0007_pintransfer_environment'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='customertoken',
+            index=models.Index(fields=['token'], name='pin_token_token_idx'),
+        ),
+    ]
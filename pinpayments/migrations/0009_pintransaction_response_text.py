@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0008_customertoken_token_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pintransaction',
+            name='pin_response_text',
+            field=models.TextField(blank=True, help_text='The response from the Pin API, when it could not be decoded as JSON', null=True, verbose_name='Complete API Response'),
+        ),
+    ]
@@ -2,18 +2,27 @@
 Models for interacting with Pin, and storing results
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
+from functools import partial
+import json
+import queue
+import threading
+import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import models
+from django.db import connection, models
+from django.db.models.functions import TruncDate
+from django.db.transaction import atomic
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import get_default_timezone
 from django.utils.translation import ugettext_lazy as _
 
-from .exceptions import ConfigError, PinError
-from .objects import PinEnvironment
-from .utils import get_value
+from .exceptions import ConfigError, PinError, PinTimeout
+from .objects import get_async_environment, get_environment
+from .utils import get_minor_units, get_value, value_expression
 
 
 if getattr(settings, 'PIN_ENVIRONMENTS', {}) == {}:
@@ -30,6 +39,66 @@ CARD_TYPES = (
     ('visa', 'Visa'),
 )
 
+# The metadata key holding the pk of the PinTransaction a charge was sent
+# for, so a charge whose response was lost can be found again
+CHARGE_METADATA_KEY = 'pinpayments_transaction'
+
+# Stored for imported charges made without an IP address, which is required
+UNKNOWN_IP_ADDRESS = '0.0.0.0'
+
+# The error_code of an imported or looked up charge that failed, when Pin
+# gives no error for it; the Charges API only reports an error_message for
+# stored charges
+IMPORTED_DECLINE_CODE = 'declined'
+
+# Fields of a PinTransaction that are refreshed from Pin when importing
+# a charge that is already stored locally.
+IMPORTED_CHARGE_FIELDS = (
+    'processed',
+    'succeeded',
+    'fees',
+    'fees_minor',
+    'pin_response',
+    'card_address1',
+    'card_address2',
+    'card_city',
+    'card_state',
+    'card_postcode',
+    'card_country',
+    'card_number',
+    'card_type',
+    'pin_response_text',
+    'pin_response_data',
+    'error_code',
+    'error_message',
+)
+
+# Fields of a PinTransaction written with the outcome of a charge
+CHARGE_RESULT_FIELDS = (
+    'succeeded',
+    'transaction_token',
+    'fees',
+    'fees_minor',
+    'pin_response',
+    'card_address1',
+    'card_address2',
+    'card_city',
+    'card_state',
+    'card_postcode',
+    'card_country',
+    'card_number',
+    'card_type',
+    'pin_response_text',
+    'pin_response_data',
+    'error_code',
+    'error_message',
+)
+
+
+def _lower(email):
+    """ An e-mail address in lower case, as stored in email_lower """
+    return email.lower() if email is not None else None
+
 
 class CustomerToken(models.Model):
     """
@@ -64,6 +133,18 @@ class CustomerToken(models.Model):
         _('Name on Card'), max_length=100, blank=True, null=True
     )
 
+    class Meta:
+        indexes = [
+            # Active tokens for a user in an environment
+            models.Index(
+                fields=['user', 'environment'],
+                condition=models.Q(active=True),
+                name='pin_token_user_active_idx',
+            ),
+            # The admin's exact search by token
+            models.Index(fields=['token'], name='pin_token_token_idx'),
+        ]
+
     def __str__(self):
         return "{0}".format(self.token)
 
@@ -77,24 +158,34 @@ class CustomerToken(models.Model):
         self.update_card(card_token)
         return True
 
+    def _update_from_response(self, data):
+        """ Copies the card details from a Customers API response """
+        self.card_number = data['card']['display_number']
+        self.card_type = data['card']['scheme']
+        self.card_name = data['card']['name']
+
     def update_card(self, card_token):
         """ Provide a card token to update the details for this customer """
-        pin_env = PinEnvironment(self.environment)
+        pin_env = get_environment(self.environment)
         payload = {'card_token': card_token}
-        url_tail = "/customers/{1}".format(self.token)
+        url_tail = "/customers/{0}".format(self.token)
         data = pin_env.pin_put(url_tail, payload)[1]['response']
-        self.card_number = data['card']['display_number']
-        self.card_type = data['card']['scheme']
-        self.card_name = data['card']['name']
+        self._update_from_response(data)
         self.save()
 
+    async def aupdate_card(self, card_token):
+        """ Async equivalent of update_card """
+        pin_env = get_async_environment(self.environment)
+        payload = {'card_token': card_token}
+        url_tail = "/customers/{0}".format(self.token)
+        data = (await pin_env.apin_put(url_tail, payload))[1]['response']
+        self._update_from_response(data)
+        await sync_to_async(self.save)()
+
     @classmethod
-    def create_from_card_token(cls, card_token, user, environment=''):
-        """ Create a customer token from a card token """
-        pin_env = PinEnvironment(environment)
-        payload = {'email': user.email, 'card_token': card_token}
-        data = pin_env.pin_post("/customers", payload)[1]['response']
-        customer = CustomerToken.objects.create(
+    def _create_from_response(cls, data, user, environment):
+        """ Saves a new customer token from a Customers API response """
+        return CustomerToken.objects.create(
             user=user,
             token=data['token'],
             environment=environment,
@@ -102,7 +193,231 @@ class CustomerToken(models.Model):
             card_type=data['card']['scheme'],
             card_name=data['card']['name'],
         )
-        return customer
+
+    @classmethod
+    def create_from_card_token(cls, card_token, user, environment=''):
+        """ Create a customer token from a card token """
+        pin_env = get_environment(environment)
+        payload = {'email': user.email, 'card_token': card_token}
+        data = pin_env.pin_post("/customers", payload)[1]['response']
+        return cls._create_from_response(data, user, environment)
+
+    @classmethod
+    async def acreate_from_card_token(cls, card_token, user, environment=''):
+        """ Async equivalent of create_from_card_token """
+        pin_env = get_async_environment(environment)
+        payload = {'email': user.email, 'card_token': card_token}
+        data = (await pin_env.apin_post("/customers", payload))[1]['response']
+        return await sync_to_async(cls._create_from_response)(
+            data, user, environment
+        )
+
+
+def _call_queued(method_name, transactions, outcomes):
+    """
+    Worker loop for process_concurrently: calls the named method on
+    transactions from the queue until it receives None
+    """
+    try:
+        while True:
+            transaction = transactions.get()
+            if transaction is None:
+                return
+            try:
+                outcomes[transaction.pk] = getattr(transaction, method_name)()
+            except Exception as exc:
+                outcomes[transaction.pk] = exc
+    finally:
+        connection.close()
+
+
+def process_concurrently(transactions, method_name, concurrency):
+    """
+    Calls the named method on each of the given transactions, using up to
+    `concurrency` threads.
+    Returns a dict mapping each transaction's pk to the method's result,
+    or to the exception it raised.
+    """
+    outcomes = {}
+    if concurrency <= 1:
+        for transaction in transactions:
+            try:
+                outcomes[transaction.pk] = getattr(transaction, method_name)()
+            except Exception as exc:
+                outcomes[transaction.pk] = exc
+        return outcomes
+
+    queued = queue.Queue(maxsize=concurrency * 2)
+    workers = [
+        threading.Thread(
+            target=_call_queued, args=(method_name, queued, outcomes)
+        )
+        for _ in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for transaction in transactions:
+            queued.put(transaction)
+    finally:
+        for worker in workers:
+            queued.put(None)
+        for worker in workers:
+            worker.join()
+    return outcomes
+
+
+# Fields holding the raw response from Pin, which can be kilobytes of JSON
+RESPONSE_FIELDS = ('pin_response_text', 'pin_response_data')
+
+
+class ResponseTextQuerySet(models.QuerySet):
+    """ Querysets of models storing the raw responses from Pin """
+    def with_response_text(self):
+        """ Loads the raw response fields, which are deferred by default """
+        return self.defer(None)
+
+
+class ResponseTextManager(models.Manager):
+    """
+    Leaves the raw response fields unloaded until they are accessed or
+    asked for with with_response_text().
+    Saving a row that was loaded without them leaves them untouched.
+    """
+    def get_queryset(self):
+        queryset = super(ResponseTextManager, self).get_queryset()
+        return queryset.defer(*[
+            field.name for field in self.model._meta.concrete_fields
+            if field.name in RESPONSE_FIELDS
+        ])
+
+
+class PinTransferQuerySet(ResponseTextQuerySet):
+    """ Reporting on transfers """
+    def with_value(self):
+        """
+        Annotates each transfer with db_value, its value as returned by
+        PinTransfer.value but computed by the database
+        """
+        return self.annotate(db_value=value_expression())
+
+    def totals(self):
+        """
+        Returns a dict mapping each currency to the total value of the
+        transfers in it, summed by the database in the base unit
+        """
+        return dict(
+            (currency, get_value(total, currency))
+            for currency, total in self.order_by().values_list(
+                'currency'
+            ).annotate(total=models.Sum('amount'))
+        )
+
+
+class PinTransactionQuerySet(ResponseTextQuerySet):
+    """ Bulk operations on transactions """
+    def process_all(self, concurrency=4):
+        """
+        Sends every unprocessed transaction in this queryset to Pin, using
+        up to `concurrency` requests in parallel.
+        Returns a dict mapping each transaction's pk to the result of its
+        process_transaction call, or to the exception it raised.
+        """
+        pending = self.filter(processed=False).iterator()
+        return process_concurrently(pending, 'process_transaction', concurrency)
+
+    def claim(self, batch_size=100):
+        """
+        Marks up to batch_size of the oldest unprocessed transactions in
+        this queryset as processed, and returns them.
+        Rows locked by another worker are skipped rather than waited on, so
+        many workers can claim from the same table at once. Claimed
+        transactions are sent with send_claimed().
+        """
+        with atomic():
+            claimed = list(
+                self.filter(processed=False)
+                .select_for_update(skip_locked=True)
+                .order_by('date')[:batch_size]
+            )
+            self.model.objects.filter(
+                pk__in=[transaction.pk for transaction in claimed]
+            ).update(processed=True)
+        for transaction in claimed:
+            transaction.processed = True
+        return claimed
+
+    def import_charges(self, environment=''):
+        """
+        Copies every charge Pin holds for the environment into
+        PinTransaction, updating rows whose transaction_token is already
+        stored and bulk creating the rest.
+        Works one page of charges at a time, while the next page is
+        fetched, so memory use doesn't grow with the size of the history.
+        Returns a tuple of the number of rows created and updated.
+        """
+        pin_env = get_environment(environment)
+        created = updated = 0
+        for charges in pin_env.iter_charge_pages():
+            fetched = [
+                self.model.from_charge(charge, pin_env.name)
+                for charge in charges
+            ]
+            existing = dict(self.model.objects.filter(
+                transaction_token__in=[t.transaction_token for t in fetched]
+            ).values_list('transaction_token', 'pk'))
+            new = []
+            changed = []
+            for transaction in fetched:
+                transaction.pk = existing.get(transaction.transaction_token)
+                if transaction.pk is None:
+                    new.append(transaction)
+                else:
+                    changed.append(transaction)
+            with atomic():
+                self.model.objects.bulk_create(new)
+                self.model.objects.bulk_update(changed, IMPORTED_CHARGE_FIELDS)
+            created += len(new)
+            updated += len(changed)
+        return (created, updated)
+
+    def totals(self):
+        """
+        Returns a dict mapping each currency to a tuple of the total amount
+        and fees of the transactions in it, summed by the database in the
+        base unit
+        """
+        return dict(
+            (currency, (get_value(amount or 0, currency),
+                        get_value(fees or 0, currency)))
+            for currency, amount, fees in self.order_by().values_list(
+                'currency'
+            ).annotate(
+                amount=models.Sum('amount_minor'),
+                fees=models.Sum('fees_minor'),
+            )
+        )
+
+    def decline_report(self):
+        """
+        Counts processed transactions by day and error_code, which is None
+        for successful charges, in one grouped query.
+        Returns a list of dicts of day, error_code, count and rate, the
+        share of that day's processed transactions with the error_code.
+        """
+        rows = list(
+            self.filter(processed=True)
+            .annotate(day=TruncDate('date'))
+            .values('day', 'error_code')
+            .annotate(count=models.Count('pk'))
+            .order_by('day', 'error_code')
+        )
+        totals = {}
+        for row in rows:
+            totals[row['day']] = totals.get(row['day'], 0) + row['count']
+        for row in rows:
+            row['rate'] = row['count'] / totals[row['day']]
+        return rows
 
 
 class PinTransaction(models.Model):
@@ -131,6 +446,19 @@ class PinTransaction(models.Model):
             'Fees charged to you by Pin, for this transaction, in dollars'
         )
     )
+    amount_minor = models.BigIntegerField(
+        _('Amount (Base Unit)'), blank=True, null=True, editable=False,
+        help_text=_(
+            'The amount in the base unit of the currency, eg cents for AUD '
+            'or yen for JPY. Kept in step with amount when saved.'
+        )
+    )
+    fees_minor = models.BigIntegerField(
+        _('Transaction Fees (Base Unit)'), blank=True, null=True,
+        editable=False, help_text=_(
+            'The fees in the base unit of the currency, as reported by Pin'
+        )
+    )
     description = models.TextField(
         _('Description'), blank=True, null=True,
         help_text=_('As provided when you initiated the transaction')
@@ -172,6 +500,13 @@ class PinTransaction(models.Model):
     email_address = models.EmailField(
         _('E-Mail Address'), max_length=100, help_text=_('As passed to Pin.')
     )
+    email_lower = models.CharField(
+        _('E-Mail Address (Lower Case)'), max_length=100, blank=True,
+        null=True, editable=False, help_text=_(
+            'The e-mail address in lower case, for indexed searches. '
+            'Kept in step with the e-mail address when saved.'
+        )
+    )
     card_address1 = models.CharField(
         _('Cardholder Street Address'), max_length=100, blank=True, null=True,
         help_text=_('Address entered by customer to process this transaction')
@@ -203,8 +538,25 @@ class PinTransaction(models.Model):
     )
     pin_response_text = models.TextField(
         _('Complete API Response'), blank=True, null=True,
-        help_text=_('The full JSON response from the Pin API')
+        help_text=_(
+            'The response from the Pin API, when it could not be decoded '
+            'as JSON'
+        )
+    )
+    pin_response_data = models.JSONField(
+        _('API Response Data'), blank=True, null=True,
+        help_text=_('The JSON response from the Pin API, for querying')
     )
+    error_code = models.CharField(
+        _('Error Code'), max_length=100, blank=True, null=True,
+        help_text=_('The error Pin gave for a failed charge, eg card_declined')
+    )
+    error_message = models.CharField(
+        _('Error Message'), max_length=255, blank=True, null=True,
+        help_text=_('The reason Pin gave for a failed charge')
+    )
+
+    objects = ResponseTextManager.from_queryset(PinTransactionQuerySet)()
 
     def save(self, *args, **kwargs):
         if not (self.card_token or self.customer_token):
@@ -213,11 +565,7 @@ class PinTransaction(models.Model):
         if self.card_token and self.customer_token:
             raise PinError("Can only provide card_token OR customer_token, not both")
 
-        if not self.environment:
-            self.environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
-
-        if self.environment not in getattr(settings, 'PIN_ENVIRONMENTS', {}):
-            raise PinError("Pin Environment '{0}' does not exist".format(self.environment))
+        self._check_environment()
 
         if not self.date:
             now = datetime.now()
@@ -225,68 +573,349 @@ class PinTransaction(models.Model):
                 now = timezone.make_aware(now, get_default_timezone())
             self.date = now
 
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = self._set_email_lower(
+                self._set_minor_units(kwargs['update_fields'])
+            )
+        else:
+            self._set_minor_units()
+            self._set_email_lower()
         super(PinTransaction, self).save(*args, **kwargs)
 
+    def _check_environment(self):
+        """ Defaults the environment, and checks that it is configured """
+        if not self.environment:
+            self.environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+
+        if self.environment not in getattr(settings, 'PIN_ENVIRONMENTS', {}):
+            raise PinError("Pin Environment '{0}' does not exist".format(self.environment))
+
+    def _set_minor_units(self, update_fields=None):
+        """
+        Recomputes amount_minor and fees_minor from amount and fees.
+        Returns update_fields, with them added if amount, fees or currency
+        are being saved.
+        """
+        sources = set(['amount', 'fees', 'currency'])
+        if sources.intersection(self.get_deferred_fields()):
+            return update_fields
+        self.amount_minor = get_minor_units(self.amount, self.currency)
+        if self.fees is not None:
+            self.fees_minor = get_minor_units(self.fees, self.currency)
+        if update_fields is not None and sources.intersection(update_fields):
+            update_fields = list(update_fields) + ['amount_minor', 'fees_minor']
+        return update_fields
+
+    def _set_email_lower(self, update_fields=None):
+        """
+        Copies email_address into email_lower, in lower case.
+        Returns update_fields, with email_lower added if email_address is
+        being saved.
+        """
+        if 'email_address' in self.get_deferred_fields():
+            return update_fields
+        self.email_lower = _lower(self.email_address)
+        if update_fields is not None and 'email_address' in update_fields:
+            update_fields = list(update_fields) + ['email_lower']
+        return update_fields
+
     def __str__(self):
         return "{0}".format(self.id)
 
+    @classmethod
+    def from_charge(cls, charge, environment):
+        """ Builds an unsaved transaction from a charge returned by Pin """
+        date = parse_datetime(charge['created_at'])
+        if not settings.USE_TZ:
+            date = timezone.make_naive(date, get_default_timezone())
+        card = charge.get('card') or {}
+        succeeded = bool(charge.get('success'))
+        error_code = charge.get('error')
+        if not succeeded and not error_code:
+            error_code = IMPORTED_DECLINE_CODE
+        return cls(
+            date=date,
+            environment=environment,
+            amount=get_value(charge['amount'], charge['currency']),
+            amount_minor=charge['amount'],
+            fees=get_value(charge.get('total_fees') or 0, charge['currency']),
+            fees_minor=charge.get('total_fees') or 0,
+            description=charge.get('description'),
+            processed=True,
+            succeeded=succeeded,
+            currency=charge['currency'],
+            transaction_token=charge['token'],
+            card_token=card.get('token'),
+            pin_response=charge.get('status_message'),
+            ip_address=charge.get('ip_address') or UNKNOWN_IP_ADDRESS,
+            email_address=charge.get('email') or '',
+            email_lower=_lower(charge.get('email') or ''),
+            card_address1=card.get('address_line1'),
+            card_address2=card.get('address_line2'),
+            card_city=card.get('address_city'),
+            card_state=card.get('address_state'),
+            card_postcode=card.get('address_postcode'),
+            card_country=card.get('address_country'),
+            card_number=card.get('display_number'),
+            card_type=card.get('scheme'),
+            pin_response_data=charge,
+            error_code=error_code,
+            error_message=(charge.get('error_message') or '')[:255] or None,
+        )
+
     class Meta:
         verbose_name = 'PIN.net.au Transaction'
         verbose_name_plural = 'PIN.net.au Transactions'
         ordering = ['-date']
+        indexes = [
+            # Unprocessed transactions for an environment, oldest first,
+            # as claimed by pin_worker
+            models.Index(
+                fields=['environment', 'date'],
+                condition=models.Q(processed=False),
+                name='pin_txn_unprocessed_idx',
+            ),
+            # Transactions for a customer token, newest first
+            models.Index(
+                fields=['customer_token', '-date'],
+                name='pin_txn_customer_date_idx',
+            ),
+            # The admin's succeeded and currency filters
+            models.Index(
+                fields=['succeeded', '-date'],
+                name='pin_txn_succeeded_date_idx',
+            ),
+            models.Index(
+                fields=['currency', '-date'],
+                name='pin_txn_currency_date_idx',
+            ),
+            # Reports on declines and card schemes by day
+            models.Index(
+                fields=['error_code', 'date'],
+                name='pin_txn_error_code_idx',
+            ),
+            models.Index(
+                fields=['card_type', 'date'],
+                name='pin_txn_card_type_idx',
+            ),
+            # The admin's exact and prefix searches; the pattern operator
+            # class lets PostgreSQL use the index for LIKE 'prefix%'
+            models.Index(
+                fields=['email_lower'],
+                opclasses=['varchar_pattern_ops'],
+                name='pin_txn_email_lower_idx',
+            ),
+            models.Index(fields=['ip_address'], name='pin_txn_ip_idx'),
+            models.Index(fields=['card_token'], name='pin_txn_card_token_idx'),
+        ]
 
-    def process_transaction(self):
-        """ Send the data to Pin for processing """
-        if self.processed:
-            return None  # can only attempt to process once.
-        self.processed = True
-        self.save()
-
-        pin_env = PinEnvironment(self.environment)
+    def _charge_payload(self):
+        """ Builds the payload sent to the Charges API """
         payload = {
             'email': self.email_address,
             'description': self.description,
-            'amount': int(self.amount * 100),
+            # From amount, not amount_minor, which is stale if amount was
+            # changed since the transaction was saved
+            'amount': get_minor_units(self.amount, self.currency),
             'currency': self.currency,
             'ip_address': self.ip_address,
         }
+        if self.pk is not None:
+            payload['metadata[{0}]'.format(CHARGE_METADATA_KEY)] = self.pk
         if self.card_token:
             payload['card_token'] = self.card_token
         else:
             payload['customer_token'] = self.customer_token.token
+        return payload
 
-        response, response_json = pin_env.pin_post('/charges', payload, True)
-        self.pin_response_text = response.text
+    @property
+    def response_text(self):
+        """
+        The response from Pin as text, encoded from pin_response_data
+        unless it was stored as text
+        """
+        if self.pin_response_text is not None:
+            return self.pin_response_text
+        if self.pin_response_data is not None:
+            return json.dumps(self.pin_response_data)
+        return None
+
+    def _record_response(self, response, response_json):
+        """ Copies the outcome of a Charges API call onto this transaction """
+        # A JSON response is only stored decoded; response_text derives
+        # the text from it
+        self.pin_response_text = None
+        if response_json is None:
+            self.pin_response_text = response.text
+        self.pin_response_data = response_json
 
         if response_json is None:
             self.pin_response = 'Failure.'
         elif 'error' in response_json.keys():
+            self.error_code = response_json['error']
             if 'messages' in response_json.keys():
                 if 'message' in response_json['messages'][0].keys():
-                    self.pin_response = 'Failure: {0}'.format(
-                        response_json['messages'][0]['message']
-                    )
+                    self.error_message = response_json['messages'][0]['message']
             else:
-                self.pin_response = 'Failure: {0}'.format(
-                    response_json['error_description']
-                )
+                self.error_message = response_json['error_description']
+            if self.error_message is not None:
+                self.error_message = self.error_message[:255]
+                self.pin_response = 'Failure: {0}'.format(self.error_message)
             self.transaction_token = response_json.get('charge_token', None)
         else:
             data = response_json['response']
-            self.succeeded = True
             self.transaction_token = data['token']
-            self.fees = data['total_fees'] / Decimal("100.00")
-            self.pin_response = data['status_message']
-            self.card_address1 = data['card']['address_line1']
-            self.card_address2 = data['card']['address_line2']
-            self.card_city = data['card']['address_city']
-            self.card_state = data['card']['address_state']
-            self.card_postcode = data['card']['address_postcode']
-            self.card_country = data['card']['address_country']
-            self.card_number = data['card']['display_number']
-            self.card_type = data['card']['scheme']
+            # A charge looked up after a failed attempt, rather than
+            # created by this one, may have been declined
+            self.succeeded = data.get('success', True)
+            if self.succeeded:
+                self.pin_response = data['status_message']
+            else:
+                self.error_code = data.get('error') or IMPORTED_DECLINE_CODE
+                self.error_message = (
+                    data.get('error_message') or data.get('status_message')
+                    or ''
+                )[:255] or None
+                self.pin_response = 'Failure.'
+                if self.error_message is not None:
+                    self.pin_response = 'Failure: {0}'.format(
+                        self.error_message
+                    )
+            self.fees_minor = data.get('total_fees') or 0
+            self.fees = get_value(self.fees_minor, self.currency)
+            card = data.get('card') or {}
+            self.card_address1 = card.get('address_line1')
+            self.card_address2 = card.get('address_line2')
+            self.card_city = card.get('address_city')
+            self.card_state = card.get('address_state')
+            self.card_postcode = card.get('address_postcode')
+            self.card_country = card.get('address_country')
+            self.card_number = card.get('display_number')
+            self.card_type = card.get('scheme')
 
-        self.save()
+    def _claim(self):
+        """
+        Marks this transaction as processed, returning whether it was this
+        call that did so. A saved transaction is only claimed if its row is
+        still unprocessed, in a single conditional UPDATE, so concurrent
+        callers can't both claim it; an unsaved one is inserted as claimed.
+        """
+        if self.pk is None:
+            self.processed = True
+            self.save()
+            return True
+        self._check_environment()
+        claimed = type(self).objects.filter(
+            pk=self.pk, processed=False
+        ).update(processed=True)
+        self.processed = True
+        return bool(claimed)
+
+    def _save_result(self, update_fields=CHARGE_RESULT_FIELDS):
+        """
+        Writes the outcome of a charge to an already saved transaction.
+        Only update_fields are written, and the checks made by save() are
+        skipped, as they passed when the transaction was claimed.
+        """
+        super(PinTransaction, self).save(update_fields=update_fields)
+
+    def _sent_charge_search(self):
+        """
+        The search for charges that could have been sent for this
+        transaction, and the test picking out the one that was
+        """
+        search = {
+            'query': self.email_address,
+            # Allow for Pin's dates being in a different timezone
+            'start_date': self.date - timedelta(days=1),
+        }
+
+        def is_sent(charge):
+            metadata = charge.get('metadata') or {}
+            return str(metadata.get(CHARGE_METADATA_KEY)) == str(self.pk)
+        return search, is_sent
+
+    def _find_sent_charge(self, pin_env, deadline):
+        """
+        Guards resending a charge after a server error: returns the
+        response and JSON of the charge created by an earlier attempt, or
+        None if Pin holds none. Its requests share the charge's deadline.
+        """
+        search, is_sent = self._sent_charge_search()
+        for charge in pin_env.search_charges(deadline=deadline, **search):
+            if is_sent(charge):
+                return pin_env.pin_get(
+                    '/charges/{0}'.format(charge['token']), True, None,
+                    deadline
+                )
+        return None
+
+    async def _afind_sent_charge(self, pin_env, deadline):
+        """ Async equivalent of _find_sent_charge """
+        search, is_sent = self._sent_charge_search()
+        async for charge in pin_env.asearch_charges(
+                deadline=deadline, **search):
+            if is_sent(charge):
+                return await pin_env.apin_get(
+                    '/charges/{0}'.format(charge['token']), True, None,
+                    deadline
+                )
+        return None
+
+    def process_transaction(self, deadline=None):
+        """
+        Send the data to Pin for processing
+        Provide a deadline, in seconds, to bound the time spent waiting on
+        Pin. PinTimeout is raised if it runs out, in which case the outcome
+        of the charge is unknown; no response is stored.
+        Only the processed flag and the outcome of the charge are written,
+        so save any other changes to a stored transaction first.
+        """
+        if self.processed or not self._claim():
+            return None  # can only attempt to process once.
+        return self.send_claimed(deadline)
+
+    def send_claimed(self, deadline=None):
+        """
+        Send a transaction that has already been marked as processed, eg by
+        PinTransaction.objects.claim(), to Pin
+        """
+        pin_env = get_environment(self.environment)
+        try:
+            response, response_json = pin_env.pin_post(
+                '/charges', self._charge_payload(), True, deadline,
+                guard=partial(self._find_sent_charge, pin_env)
+            )
+        except PinTimeout:
+            self.pin_response = 'Timed out.'
+            self._save_result(['pin_response'])
+            raise
+        self._record_response(response, response_json)
+        started = time.perf_counter()
+        self._save_result()
+        pin_env.record_timing('transaction_save', time.perf_counter() - started)
+        return self.pin_response
+
+    async def aprocess_transaction(self, deadline=None):
+        """ Async equivalent of process_transaction """
+        if self.processed or not await sync_to_async(self._claim)():
+            return None  # can only attempt to process once.
+
+        pin_env = get_async_environment(self.environment)
+        payload = await sync_to_async(self._charge_payload)()
+        try:
+            response, response_json = await pin_env.apin_post(
+                '/charges', payload, True, deadline,
+                guard=partial(self._afind_sent_charge, pin_env)
+            )
+        except PinTimeout:
+            self.pin_response = 'Timed out.'
+            await sync_to_async(self._save_result)(['pin_response'])
+            raise
+        self._record_response(response, response_json)
+        started = time.perf_counter()
+        await sync_to_async(self._save_result)()
+        pin_env.record_timing('transaction_save', time.perf_counter() - started)
         return self.pin_response
 
 
@@ -352,9 +981,10 @@ class PinRecipient(models.Model):
         return "{0}".format(self.token)
 
     @classmethod
-    def create_with_bank_account(cls, email, account_name, bsb, number, name=""):
+    def create_with_bank_account(cls, email, account_name, bsb, number, name="",
+                                 environment=''):
         """ Creates a new recipient from a provided bank account's details """
-        pin_env = PinEnvironment()
+        pin_env = get_environment(environment)
         payload = {
             'email': email,
             'name': name,
@@ -411,10 +1041,21 @@ class PinTransfer(models.Model):
         _('Complete API Response'), blank=True, null=True,
         help_text=_('The full JSON response from the Pin API')
     )
+    environment = models.CharField(
+        max_length=25, db_index=True, blank=True,
+        help_text=_('The name of the Pin environment to use, eg test or live.')
+    )
+
+    objects = ResponseTextManager.from_queryset(PinTransferQuerySet)()
 
     def __str__(self):
         return "{0}".format(self.transfer_token)
 
+    def save(self, *args, **kwargs):
+        if not self.environment:
+            self.environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+        super(PinTransfer, self).save(*args, **kwargs)
+
     @property
     def value(self):
         """
@@ -425,18 +1066,11 @@ class PinTransfer(models.Model):
         return get_value(self.amount, self.currency)
 
     @classmethod
-    def send_new(cls, amount, description, recipient, currency="AUD"):
-        """ Creates a transfer by sending it to Pin """
-        pin_env = PinEnvironment()
-        payload = {
-            'amount': amount,
-            'description': description,
-            'recipient': recipient.token,
-            'currency': currency,
-        }
-        response, response_json = pin_env.pin_post('/transfers', payload)
+    def _create_from_response(cls, response, response_json, recipient,
+                              environment):
+        """ Saves a new transfer from a Transfers API response """
         data = response_json['response']
-        new_transfer = PinTransfer.objects.create(
+        return PinTransfer.objects.create(
             transfer_token=data['token'],
             status=data['status'],
             currency=data['currency'],
@@ -444,5 +1078,69 @@ class PinTransfer(models.Model):
             amount=data['amount'],
             recipient=recipient,
             pin_response_text=response.text,
+            environment=environment,
+        )
+
+    @classmethod
+    def send_new(cls, amount, description, recipient, currency="AUD",
+                 environment=''):
+        """
+        Creates a transfer by sending it to Pin, in the recipient's
+        environment unless another is given
+        """
+        pin_env = get_environment(environment or recipient.environment)
+        payload = {
+            'amount': amount,
+            'description': description,
+            'recipient': recipient.token,
+            'currency': currency,
+        }
+        response, response_json = pin_env.pin_post('/transfers', payload)
+        pin_env.invalidate_balances()
+        return cls._create_from_response(
+            response, response_json, recipient, pin_env.name
+        )
+
+    @classmethod
+    async def asend_new(cls, amount, description, recipient, currency="AUD",
+                        environment=''):
+        """ Async equivalent of send_new """
+        pin_env = get_async_environment(environment or recipient.environment)
+        payload = {
+            'amount': amount,
+            'description': description,
+            'recipient': recipient.token,
+            'currency': currency,
+        }
+        response, response_json = await pin_env.apin_post('/transfers', payload)
+        pin_env.invalidate_balances()
+        return await sync_to_async(cls._create_from_response)(
+            response, response_json, recipient, pin_env.name
+        )
+
+
+class ReconciliationCheckpoint(models.Model):
+    """
+    Records how far the pin_reconcile command got for an environment, so
+    the next run only has to look at records created since.
+    """
+    environment = models.CharField(
+        max_length=25,
+        help_text=_('The name of the Pin environment to use, eg test or live.')
+    )
+    kind = models.CharField(
+        max_length=20, choices=(
+            ('charges', 'Charges'),
+            ('transfers', 'Transfers'),
         )
-        return new_transfer
+    )
+    reconciled_until = models.DateTimeField(help_text=_(
+        'Records created before this time have been reconciled'
+    ))
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('environment', 'kind')
+
+    def __str__(self):
+        return "{0} {1}".format(self.environment, self.kind)
@@ -2,20 +2,156 @@
 Non-model related objects
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from urllib.parse import urlencode
+import asyncio
+import gzip
+import json
+import re
+import threading
+import time
 
 from django.conf import settings
-import requests
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
 
-from .exceptions import ConfigError, PinError
+from .exceptions import ConfigError, PinError, PinTimeout
+from .metrics import Measurement, get_metrics_backend
+from .retry import RetryPolicy, parse_retry_after
+
+
+_environments = {}
+_environments_lock = threading.Lock()
+
+# The Content-Type of request bodies, by the environment's body_format
+BODY_FORMATS = {
+    'form': 'application/x-www-form-urlencoded',
+    'json': 'application/json',
+}
+
+# A form field naming a member of an object, eg bank_account[name]
+NESTED_FIELD = re.compile(r'^([^\[\]]+)((?:\[[^\[\]]+\])+)$')
+
+
+def _nest(payload):
+    """
+    Turns form field names such as bank_account[name] into the nested
+    objects of a JSON body, eg {'bank_account': {'name': ...}}
+    """
+    nested = {}
+    for name, value in payload.items():
+        match = NESTED_FIELD.match(name)
+        if match is None:
+            nested[name] = value
+            continue
+        keys = [match.group(1)] + match.group(2)[1:-1].split('][')
+        target = nested
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return nested
+
+
+def _resolve_name(name):
+    """ Maps the empty and 'test' names onto the default environment """
+    if name in ('test', ''):
+        return getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+    return name
+
+
+def _get_shared(env_class, name):
+    """ Returns the shared instance of env_class for name """
+    key = (env_class, _resolve_name(name))
+    pin_env = _environments.get(key)
+    if pin_env is None:
+        with _environments_lock:
+            pin_env = _environments.get(key)
+            if pin_env is None:
+                pin_env = env_class(key[1])
+                _environments[key] = pin_env
+    return pin_env
+
+
+def get_environment(name=''):
+    """
+    Returns the shared PinEnvironment for the given name, building it
+    the first time it is asked for. Sharing the environment lets its
+    connection pool live for the whole process.
+    """
+    return _get_shared(PinEnvironment, name)
+
+
+def get_async_environment(name=''):
+    """ Returns the shared AsyncPinEnvironment for the given name """
+    return _get_shared(AsyncPinEnvironment, name)
+
+
+def clear_environments():
+    """ Forget every shared environment, so they are rebuilt from settings """
+    with _environments_lock:
+        _environments.clear()
+
+
+@receiver(setting_changed)
+def _reset_environments(setting, **kwargs):
+    """ Rebuild environments when the Pin settings change """
+    if setting in ('PIN_ENVIRONMENTS', 'PIN_DEFAULT_ENVIRONMENT',
+                   'PIN_METRICS_BACKEND'):
+        clear_environments()
+
+
+class Deadline(object):
+    """
+    A time budget shared by every request, and every retry, made for one
+    operation such as processing a transaction
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    @classmethod
+    def coerce(cls, deadline):
+        """ Accepts a Deadline, a number of seconds, or None for no limit """
+        if deadline is None or isinstance(deadline, Deadline):
+            return deadline
+        return cls(deadline)
+
+    def remaining(self):
+        """ Seconds left before the deadline, which may be negative """
+        return self.expires - time.monotonic()
+
+    def timeout(self, timeout):
+        """
+        Shortens a request timeout, either a number of seconds or a tuple of
+        connect and read timeouts, so the request ends by the deadline
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise PinTimeout(
+                "The {0} second deadline ran out".format(self.seconds)
+            )
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, (tuple, list)):
+            return tuple(
+                remaining if part is None else min(part, remaining)
+                for part in timeout
+            )
+        return min(timeout, remaining)
 
 
 class PinEnvironment(object):
     """ Container for pin settings """
+    # The settings key naming the transport, and the transport used if unset
+    transport_setting = 'transport'
+    default_transport = 'pinpayments.transports.RequestsTransport'
+
     def __init__(self, name="test", *args, **kwargs):
         """ Populate contents from Settings """
-        if name in ('test', ''):
-            name = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+        name = _resolve_name(name)
 
         env_dict = {}
         try:
@@ -34,6 +170,45 @@ class PinEnvironment(object):
         self.host = env_dict['host']
         self.key = env_dict['key']
         self.secret = env_dict['secret']
+        self.scheme = env_dict.get('scheme', 'https')
+        self.pool_connections = env_dict.get('pool_connections', 10)
+        self.pool_maxsize = env_dict.get('pool_maxsize', 10)
+        self.pool_block = env_dict.get('pool_block', False)
+        self.balance_cache = env_dict.get('balance_cache', 'default')
+        self.balance_cache_timeout = env_dict.get('balance_cache_timeout', 0)
+        self.timeout = env_dict.get('timeout', (10, 60))
+        if isinstance(self.timeout, list):
+            self.timeout = tuple(self.timeout)
+        self.deadline = env_dict.get('deadline', None)
+        self.body_format = env_dict.get('body_format', 'form')
+        if self.body_format not in BODY_FORMATS:
+            raise ConfigError(
+                "The body_format for environment {0} must be one of "
+                "{1}".format(name, ', '.join(sorted(BODY_FORMATS)))
+            )
+        self.compress_min_size = env_dict.get('compress_min_size', None)
+        self.retry = env_dict.get('retry', {})
+        try:
+            RetryPolicy.from_settings(self.retry, 'GET', '/')
+        except TypeError as exc:
+            raise ConfigError(
+                "The retry settings for environment {0} are invalid: "
+                "{1}".format(name, exc)
+            )
+        self.metrics = get_metrics_backend()
+        transport_path = env_dict.get(
+            self.transport_setting, self.default_transport
+        )
+        try:
+            transport_class = import_string(transport_path)
+        except ImportError as exc:
+            raise ConfigError(
+                "The transport for environment {0} could not be "
+                "imported: {1}".format(name, exc)
+            )
+        self.transport = transport_class(
+            self, **env_dict.get('transport_options', {})
+        )
         super(PinEnvironment, self).__init__(*args, **kwargs)
 
     @property
@@ -41,32 +216,118 @@ class PinEnvironment(object):
         """ Returns auth as expected by requests for Pin """
         return (self.secret, '')
 
-    def _pin_request(self, method, url_tail, payload=None, always_return=False):
-        """
-        Internal method to abstract common details of calls to Pin API
-        """
-        method = method.lower()
+    @property
+    def session(self):
+        """ The pooled requests.Session of a RequestsTransport """
+        return self.transport.session
+
+    def close(self):
+        """ Close any pooled connections held by this environment """
+        self.transport.close()
+
+    def _url(self, method, url_tail):
+        """ Validates the method and builds the full URL for a request """
         if method not in ['get', 'post', 'put']:
             raise Exception(
                 "Method for request '{0}' was invalid".format(method)
             )
-        requests_method = getattr(requests, method)
-        url = 'https://{0}/1{1}'.format(self.host, url_tail)
-        if payload is not None:
-            response = requests_method(
-                url,
-                auth=self.auth,
-                params=payload,
-                headers={'content_type': 'application/json'}
-            )
+        return '{0}://{1}/1{2}'.format(self.scheme, self.host, url_tail)
+
+    def _encode_payload(self, method, payload):
+        """
+        Keyword arguments carrying the payload of a request: the query
+        string of a GET, otherwise a form or JSON encoded body, as set by
+        body_format. Payloads are given as form fields, which are nested into
+        objects for JSON. Bodies of at least compress_min_size bytes are
+        gzipped.
+        Parameters set to None are left out, as they are from a query string.
+        """
+        if payload is None:
+            return {}
+        if method == 'get':
+            return {'params': payload}
+        payload = dict(
+            (name, value) for name, value in payload.items()
+            if value is not None
+        )
+        if self.body_format == 'json':
+            body = json.dumps(_nest(payload), default=str)
         else:
-            response = requests_method(
-                url,
-                auth=self.auth,
-                headers={'content_type': 'application/json'}
+            body = urlencode(payload, doseq=True)
+        body = body.encode('utf-8')
+        headers = {'Content-Type': BODY_FORMATS[self.body_format]}
+        if (self.compress_min_size is not None
+                and len(body) >= self.compress_min_size):
+            body = gzip.compress(body, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        return {'data': body, 'headers': headers}
+
+    def _request_kwargs(self, encoded, deadline=None):
+        """
+        Keyword arguments for one attempt at a request to Pin, given the
+        encoded payload from _encode_payload()
+        """
+        kwargs = {
+            'auth': self.auth,
+            'timeout': self.timeout,
+        }
+        if deadline is not None:
+            kwargs['timeout'] = deadline.timeout(self.timeout)
+        kwargs.update(encoded)
+        return kwargs
+
+    def retry_policy(self, method, url_tail):
+        """ The RetryPolicy for a request to the given URL """
+        return RetryPolicy.from_settings(self.retry, method, url_tail)
+
+    def _retry_delay(self, policy, method, attempt, deadline, response=None,
+                     sent=True, guarded=False):
+        """
+        Returns the seconds to wait before retrying a failed attempt, or None
+        if it shouldn't be retried, or can't be within the deadline
+        """
+        status = None
+        retry_after = None
+        if response is not None:
+            status = response.status_code
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After')
             )
+        if not policy.should_retry(
+                method, attempt, status=status, sent=sent, guarded=guarded):
+            return None
+        delay = policy.backoff(attempt, retry_after)
+        if deadline is not None and delay >= deadline.remaining():
+            return None
+        return delay
+
+    def _timed_out(self, url, exc):
+        """ The PinTimeout raised when a request to url timed out """
+        return PinTimeout(
+            "Timed out waiting for environment {0} "
+            "at url {1}: {2}".format(self.name, url, exc)
+        )
+
+    def _measure(self, method, url_tail):
+        """ Starts timing a request, if a metrics backend is configured """
+        if self.metrics is None:
+            return None
+        return Measurement(self.metrics, self.name, method, url_tail)
+
+    def record_timing(self, name, duration):
+        """ Reports the duration of some step to the metrics backend """
+        if self.metrics is not None:
+            self.metrics.timing(self.name, name, duration)
+
+    def _parse_response(self, response, url, always_return):
+        """ Decodes a response from Pin, raising PinError on errors """
         try:
-            response_json = response.json()
+            if self.metrics is None:
+                response_json = response.json()
+            else:
+                started = time.perf_counter()
+                response_json = response.json()
+                self.record_timing('parse', time.perf_counter() - started)
         except (AttributeError, ValueError):
             if always_return:
                 response_json = None
@@ -87,39 +348,122 @@ class PinEnvironment(object):
 
         return (response, response_json)
 
-    def pin_get(self, url_tail, always_return=False):
+    def _pin_request(self, method, url_tail, payload=None, always_return=False,
+                     deadline=None, guard=None):
+        """
+        Internal method to abstract common details of calls to Pin API
+        A POST is only retried after a server error response if given a
+        guard. It is called with the Deadline before the request is sent
+        again, and returns the response and decoded JSON of whatever the
+        earlier attempt created, or None if it created nothing. A POST that
+        timed out or was dropped once sent is never retried, as Pin may
+        still be acting on it.
+        """
+        method = method.lower()
+        url = self._url(method, url_tail)
+        transport = self.transport
+        policy = self.retry_policy(method, url_tail)
+        if deadline is None:
+            deadline = self.deadline
+        deadline = Deadline.coerce(deadline)
+        # Encoded first, so a payload that can't be sent is never measured
+        # as a request in flight
+        encoded = self._encode_payload(method, payload)
+        measurement = self._measure(method, url_tail)
+        attempt = 0
+        # Whether Pin may have acted on the last attempt
+        acted = False
+        try:
+            while True:
+                if acted and guard is not None:
+                    found = guard(deadline)
+                    if found is not None:
+                        if measurement is not None:
+                            measurement.finish(found[0])
+                        return found
+                try:
+                    response = transport.request(
+                        method, url, **self._request_kwargs(encoded, deadline)
+                    )
+                except transport.errors as exc:
+                    sent = not isinstance(exc, transport.connect_errors)
+                    delay = self._retry_delay(
+                        policy, method, attempt, deadline, sent=sent
+                    )
+                    if delay is None:
+                        if isinstance(exc, transport.timeout_errors):
+                            raise self._timed_out(url, exc) from exc
+                        raise
+                else:
+                    delay = self._retry_delay(
+                        policy, method, attempt, deadline, response=response,
+                        guarded=guard is not None
+                    )
+                    if delay is None:
+                        break
+                    acted = response.status_code != 429
+                time.sleep(delay)
+                attempt += 1
+                if measurement is not None:
+                    measurement.retries = attempt
+        except Exception as exc:
+            if measurement is not None:
+                measurement.finish(exc=exc)
+            raise
+        if measurement is not None:
+            measurement.finish(response)
+        return self._parse_response(response, url, always_return)
+
+    def pin_get(self, url_tail, always_return=False, params=None,
+                deadline=None):
         """
         Provide a relative URL to access the API for it via GET
         Include the leading /
+        Optionally provide a dict of query string params
         Returns a tuple of the response and the decoded JSON
         Provide always_return=True to handle all errors yourself
+        Provide a deadline, in seconds or as a Deadline, to bound the time
+        taken including any retries
         """
-        return self._pin_request('GET', url_tail, always_return)
+        return self._pin_request(
+            'GET', url_tail, params, always_return, deadline
+        )
 
-    def pin_put(self, url_tail, payload, always_return=False):
+    def pin_put(self, url_tail, payload, always_return=False, deadline=None):
         """
         Provide a relative URL to access the API for it via PUT
         Include the leading /
         Returns a tuple of the response and the decoded JSON
         Provide always_return=True to handle all errors yourself
+        Provide a deadline, in seconds or as a Deadline, to bound the time
+        taken including any retries
         """
-        return self._pin_request('PUT', url_tail, payload, always_return)
+        return self._pin_request(
+            'PUT', url_tail, payload, always_return, deadline
+        )
 
-    def pin_post(self, url_tail, payload, always_return=False):
+    def pin_post(self, url_tail, payload, always_return=False, deadline=None,
+                 guard=None):
         """
         Provide a relative URL to access the API for it via POST
         Include the leading /
         Returns a tuple of the response and the decoded JSON
         Provide always_return=True to handle all errors yourself
+        Provide a deadline, in seconds or as a Deadline, to bound the time
+        taken including any retries
+        Provide a guard to retry after server error responses too: it's
+        called with the Deadline before each retry, and returns the
+        response and JSON of anything the earlier attempt created, or None
         """
-        return self._pin_request('POST', url_tail, payload, always_return)
+        return self._pin_request(
+            'POST', url_tail, payload, always_return, deadline, guard
+        )
 
-    def get_balance(self, currency="AUD"):
+    def _parse_balances(self, response, response_json):
         """
-        Query Pin for the balance of a Pin account in the currency given
-        Returns a tuple containing Decimals of available and pending balance
+        Builds a dict of currency to (available, pending) balance from
+        a /balance response
         """
-        response, response_json = self.pin_get('/balance')
         response_json = response_json['response']
 
         if not set(response_json.keys()).issuperset(['available', 'pending']):
@@ -128,38 +472,330 @@ class PinEnvironment(object):
                 "details: {1}".format(self.name, response.text)
             )
 
-        available = set([
-            bal['amount'] if bal['currency'] == currency else None
-            for bal in response_json['available']
-        ])
-        if None in available:
-            available.remove(None)
-        if len(available) != 1:
+        balances = {}
+        for index, kind in enumerate(('available', 'pending')):
+            for bal in response_json[kind]:
+                amounts = balances.setdefault(bal['currency'], [None, None])
+                if amounts[index] is not None:
+                    raise PinError(
+                        "Pin returned more than one {0} balance for currency "
+                        "{1} in environment {2}. Values are: \n"
+                        "\t{3}".format(
+                            kind, bal['currency'], self.name, response_json[kind]
+                        )
+                    )
+                amounts[index] = Decimal(bal['amount'])
+        return dict(
+            (currency, tuple(amounts))
+            for currency, amounts in balances.items()
+        )
+
+    def _balance_for(self, balances, currency):
+        """ Picks the balance for currency out of a get_balances() result """
+        available_balance, pending_balance = balances.get(
+            currency, (None, None)
+        )
+        if available_balance is None:
             raise PinError(
                 "Error retrieving available balance for currency {0} "
                 "in environment {1}. Available currencies and values are: \n"
-                "\t{2}".format(currency, self.name, response_json['available'])
+                "\t{2}".format(currency, self.name, balances)
             )
-        available_balance = Decimal(list(available)[0])
-
-        pending = set([
-            bal['amount'] if bal['currency'] == currency else None
-            for bal in response_json['pending']
-        ])
-        if None in pending:
-            pending.remove(None)
-        if len(pending) != 1:
+        if pending_balance is None:
             raise PinError(
                 "Error retrieving pending balance for currency {0}"
                 "in environment {1}. Available currencies and values are: \n"
-                "\t{2}".format(currency, self.name, response_json['pending'])
+                "\t{2}".format(currency, self.name, balances)
             )
-        pending_balance = Decimal(list(pending)[0])
-
         return (available_balance, pending_balance)
 
+    @property
+    def _balance_cache_key(self):
+        return 'pinpayments:balances:{0}'.format(self.name)
+
+    def _cached_balances(self):
+        """ Returns the cached get_balances() result, if there is one """
+        if not self.balance_cache_timeout:
+            return None
+        return caches[self.balance_cache].get(self._balance_cache_key)
+
+    def _cache_balances(self, balances):
+        if self.balance_cache_timeout:
+            caches[self.balance_cache].set(
+                self._balance_cache_key, balances, self.balance_cache_timeout
+            )
+        return balances
+
+    def invalidate_balances(self):
+        """ Drop any cached balances, eg after money has been moved """
+        if self.balance_cache_timeout:
+            caches[self.balance_cache].delete(self._balance_cache_key)
+
+    def get_balances(self):
+        """
+        Query Pin for the balance of a Pin account in every currency held
+        Returns a dict mapping each currency to a tuple containing Decimals
+        of available and pending balance.
+        Results are cached for balance_cache_timeout seconds, if set for the
+        environment.
+        """
+        balances = self._cached_balances()
+        if balances is None:
+            response, response_json = self.pin_get('/balance')
+            balances = self._cache_balances(
+                self._parse_balances(response, response_json)
+            )
+        return balances
+
+    def get_balance(self, currency="AUD"):
+        """
+        Query Pin for the balance of a Pin account in the currency given
+        Returns a tuple containing Decimals of available and pending balance
+        """
+        return self._balance_for(self.get_balances(), currency)
+
     def get_available_balance(self, currency="AUD"):
         return self.get_balance(currency)[0]
 
     def get_pending_balance(self, currency="AUD"):
         return self.get_balance(currency)[1]
+
+    def _iter_pages(self, url_tail, params=None, deadline=None):
+        """
+        Yields the records from each page of a paginated list endpoint,
+        one list per page.
+        The next page is fetched in the background while the caller works
+        on the current one. Only that one page is read ahead, and nothing
+        more is fetched once the caller stops iterating.
+        """
+        params = dict(params or {})
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            page = executor.submit(
+                self.pin_get, url_tail, False, dict(params, page=1), deadline
+            )
+            while page is not None:
+                response_json = page.result()[1]
+                next_page = response_json.get('pagination', {}).get('next')
+                page = None
+                if next_page:
+                    page = executor.submit(
+                        self.pin_get, url_tail, False,
+                        dict(params, page=next_page), deadline
+                    )
+                yield response_json['response']
+        finally:
+            executor.shutdown(wait=False)
+
+    def iter_pages(self, url_tail, params=None, deadline=None):
+        """
+        Yields every record from a paginated list endpoint, eg /customers,
+        with any params added to the query string of each page.
+        Pages are read ahead one at a time, as for iter_charge_pages.
+        Any deadline bounds the requests for every page.
+        """
+        pages = self._iter_pages(url_tail, params, deadline)
+        try:
+            for records in pages:
+                for record in records:
+                    yield record
+        finally:
+            pages.close()
+
+    def iter_charge_pages(self):
+        """
+        Yields every charge in this environment, newest first, as one list
+        of charge dicts per page of the Charges API
+        """
+        return self._iter_pages('/charges')
+
+    def iter_transfer_pages(self):
+        """
+        Yields every transfer in this environment, newest first, as one
+        list of transfer dicts per page of the Transfers API
+        """
+        return self._iter_pages('/transfers')
+
+    def _search_params(self, query, start_date, end_date, sort, direction):
+        """ The query string of a search of the Charges API """
+        params = {}
+        if query:
+            params['query'] = query
+        if start_date is not None:
+            params['start_date'] = start_date.strftime('%Y/%m/%d')
+        if end_date is not None:
+            params['end_date'] = end_date.strftime('%Y/%m/%d')
+        if sort is not None:
+            params['sort'] = sort
+        if direction is not None:
+            params['direction'] = direction
+        return params
+
+    def search_charges(self, query=None, start_date=None, end_date=None,
+                       sort=None, direction=None, deadline=None):
+        """
+        Yields the charges Pin finds for a search, one at a time across
+        every page of results. Pin does the filtering:
+        query is matched against the description, amount (in the base unit
+        of the currency), email address, IP address and currency.
+        start_date and end_date are dates or datetimes bounding when the
+        charges were created. sort is one of created_at (the default),
+        amount or description, and direction 1 for ascending or -1 for
+        descending. Any deadline bounds the requests for every page.
+        """
+        return self.iter_pages('/charges/search', self._search_params(
+            query, start_date, end_date, sort, direction
+        ), deadline)
+
+
+class AsyncPinEnvironment(PinEnvironment):
+    """
+    A PinEnvironment for use from asyncio code. By default requests are
+    made through a single pooled httpx.AsyncClient, so should all come from
+    the same event loop, and httpx must be installed.
+    """
+    transport_setting = 'async_transport'
+    default_transport = 'pinpayments.transports.HttpxTransport'
+
+    @property
+    def client(self):
+        """ The pooled httpx.AsyncClient of an HttpxTransport """
+        return self.transport.client
+
+    async def aclose(self):
+        """ Close any pooled connections held by this environment """
+        await self.transport.aclose()
+
+    async def _apin_request(self, method, url_tail, payload=None,
+                            always_return=False, deadline=None, guard=None):
+        """
+        Internal method to abstract common details of async calls to Pin API
+        As for _pin_request, but any guard is a coroutine function.
+        """
+        method = method.lower()
+        url = self._url(method, url_tail)
+        transport = self.transport
+        policy = self.retry_policy(method, url_tail)
+        if deadline is None:
+            deadline = self.deadline
+        deadline = Deadline.coerce(deadline)
+        # Encoded first, so a payload that can't be sent is never measured
+        # as a request in flight
+        encoded = self._encode_payload(method, payload)
+        measurement = self._measure(method, url_tail)
+        attempt = 0
+        # Whether Pin may have acted on the last attempt
+        acted = False
+        try:
+            while True:
+                if acted and guard is not None:
+                    found = await guard(deadline)
+                    if found is not None:
+                        if measurement is not None:
+                            measurement.finish(found[0])
+                        return found
+                try:
+                    response = await transport.arequest(
+                        method, url, **self._request_kwargs(encoded, deadline)
+                    )
+                except transport.errors as exc:
+                    sent = not isinstance(exc, transport.connect_errors)
+                    delay = self._retry_delay(
+                        policy, method, attempt, deadline, sent=sent
+                    )
+                    if delay is None:
+                        if isinstance(exc, transport.timeout_errors):
+                            raise self._timed_out(url, exc) from exc
+                        raise
+                else:
+                    delay = self._retry_delay(
+                        policy, method, attempt, deadline, response=response,
+                        guarded=guard is not None
+                    )
+                    if delay is None:
+                        break
+                    acted = response.status_code != 429
+                await asyncio.sleep(delay)
+                attempt += 1
+                if measurement is not None:
+                    measurement.retries = attempt
+        except Exception as exc:
+            if measurement is not None:
+                measurement.finish(exc=exc)
+            raise
+        if measurement is not None:
+            measurement.finish(response)
+        return self._parse_response(response, url, always_return)
+
+    async def apin_get(self, url_tail, always_return=False, params=None,
+                       deadline=None):
+        """ Async equivalent of pin_get """
+        return await self._apin_request(
+            'GET', url_tail, params, always_return, deadline
+        )
+
+    async def apin_put(self, url_tail, payload, always_return=False,
+                       deadline=None):
+        """ Async equivalent of pin_put """
+        return await self._apin_request(
+            'PUT', url_tail, payload, always_return, deadline
+        )
+
+    async def apin_post(self, url_tail, payload, always_return=False,
+                        deadline=None, guard=None):
+        """ Async equivalent of pin_post, with guard a coroutine function """
+        return await self._apin_request(
+            'POST', url_tail, payload, always_return, deadline, guard
+        )
+
+    async def aget_balances(self):
+        """ Async equivalent of get_balances """
+        balances = self._cached_balances()
+        if balances is None:
+            response, response_json = await self.apin_get('/balance')
+            balances = self._cache_balances(
+                self._parse_balances(response, response_json)
+            )
+        return balances
+
+    async def aget_balance(self, currency="AUD"):
+        """ Async equivalent of get_balance """
+        return self._balance_for(await self.aget_balances(), currency)
+
+    async def aget_available_balance(self, currency="AUD"):
+        return (await self.aget_balance(currency))[0]
+
+    async def aget_pending_balance(self, currency="AUD"):
+        return (await self.aget_balance(currency))[1]
+
+    async def aiter_pages(self, url_tail, params=None, deadline=None):
+        """
+        Async equivalent of iter_pages. The next page is fetched in a task
+        while the caller works on the current one, and cancelled if the
+        caller stops iterating.
+        """
+        params = dict(params or {})
+        page = asyncio.ensure_future(
+            self.apin_get(url_tail, False, dict(params, page=1), deadline)
+        )
+        try:
+            while page is not None:
+                response_json = (await page)[1]
+                next_page = response_json.get('pagination', {}).get('next')
+                page = None
+                if next_page:
+                    page = asyncio.ensure_future(self.apin_get(
+                        url_tail, False, dict(params, page=next_page), deadline
+                    ))
+                for record in response_json['response']:
+                    yield record
+        finally:
+            if page is not None:
+                page.cancel()
+
+    def asearch_charges(self, query=None, start_date=None, end_date=None,
+                        sort=None, direction=None, deadline=None):
+        """ Async equivalent of search_charges, for use with async for """
+        return self.aiter_pages('/charges/search', self._search_params(
+            query, start_date, end_date, sort, direction
+        ), deadline)
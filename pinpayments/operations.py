@@ -0,0 +1,49 @@
+"""
+Migration operations for large tables
+"""
+from django.db import NotSupportedError
+from django.db.migrations import AddIndex
+
+
+class AddIndexConcurrently(AddIndex):
+    """
+    Adds an index as AddIndex does, but on PostgreSQL builds it with
+    CREATE INDEX CONCURRENTLY, so the table isn't locked against writes
+    while it is built. Other databases get a plain CREATE INDEX.
+    Migrations using it must set atomic = False.
+    """
+    def describe(self):
+        return "{0} (concurrently on PostgreSQL)".format(
+            super(AddIndexConcurrently, self).describe()
+        )
+
+    def _concurrently(self, schema_editor):
+        """ Whether the index can, and must, be changed concurrently """
+        if schema_editor.connection.vendor != 'postgresql':
+            return False
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError(
+                "AddIndexConcurrently can't run inside a transaction; "
+                "set atomic = False on the migration"
+            )
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if not self._concurrently(schema_editor):
+            return super(AddIndexConcurrently, self).database_forwards(
+                app_label, schema_editor, from_state, to_state
+            )
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if not self._concurrently(schema_editor):
+            return super(AddIndexConcurrently, self).database_backwards(
+                app_label, schema_editor, from_state, to_state
+            )
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
@@ -0,0 +1,194 @@
+"""
+Compares the charges and transfers stored locally against those held by Pin
+"""
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import get_default_timezone
+
+from .exceptions import PinError
+from .models import PinTransaction, PinTransfer
+
+
+# kind is one of 'missing_locally', 'missing_remotely', 'amount_mismatch'
+# or 'stale_status'. local and remote are the amount or status compared,
+# where relevant.
+Discrepancy = namedtuple('Discrepancy', 'kind token local remote')
+
+# The number of recent pages whose tokens are kept to match local records
+# against, allowing for local and remote creation times differing a little
+RECENT_PAGES = 3
+
+# The most stored records looked up on Pin at once, when they weren't found
+# on the pages around their local time
+CONFIRM_BATCH_SIZE = 50
+
+
+def _created_at(record):
+    """ The creation time of a record returned by Pin """
+    created = parse_datetime(record['created_at'])
+    if not settings.USE_TZ:
+        created = timezone.make_naive(created, get_default_timezone())
+    return created
+
+
+def _iter_window(pages, since, until):
+    """
+    Yields the remote records from pages (newest first) a page at a time,
+    skipping those created from until and stopping at the first record
+    created before since
+    """
+    try:
+        for records in pages:
+            window = []
+            finished = False
+            for record in records:
+                created = _created_at(record)
+                if until is not None and created >= until:
+                    continue
+                if since is not None and created < since:
+                    finished = True
+                    break
+                window.append(record)
+            if window:
+                yield window
+            if finished:
+                return
+    finally:
+        pages.close()
+
+
+def _unknown_to_pin(pin_env, url_tail, tokens):
+    """
+    Yields those of tokens that Pin has no record of, looking each up at
+    url_tail (eg '/charges/{0}'), a batch at a time in parallel
+    """
+    def status(token):
+        response = pin_env.pin_get(url_tail.format(token), True)[0]
+        if response.status_code != 404 and response.status_code >= 400:
+            raise PinError(
+                "Error looking up {0} in environment {1}: status {2}".format(
+                    token, pin_env.name, response.status_code
+                )
+            )
+        return response.status_code
+
+    with ThreadPoolExecutor(max_workers=pin_env.pool_maxsize) as executor:
+        for start in range(0, len(tokens), CONFIRM_BATCH_SIZE):
+            batch = tokens[start:start + CONFIRM_BATCH_SIZE]
+            for token, code in zip(batch, executor.map(status, batch)):
+                if code == 404:
+                    yield token
+
+
+def _reconcile(pin_env, url_tail, pages, since, until, local, stored,
+               token_field, date_field, fields, compare):
+    """
+    Yields a Discrepancy for every difference between the remote records
+    in pages and the local queryset, where stored holds the local records
+    Pin should also have.
+    Each page is matched against local rows with one token lookup, and
+    compare(remote, values) yields the differences for each match, given
+    the values of fields. Stored records are checked for a page's span of
+    time at a time, against the tokens of the pages around it, so memory
+    use doesn't grow with the length of the history. Those not found there,
+    such as transactions queued long before pin_worker sent them, are
+    looked up on Pin at url_tail before being reported.
+    """
+    recent = deque(maxlen=RECENT_PAGES)
+
+    def missing_remotely(lower, upper):
+        window = stored
+        if lower is not None:
+            window = window.filter(**{date_field + '__gte': lower})
+        if upper is not None:
+            window = window.filter(**{date_field + '__lt': upper})
+        seen = set().union(*recent)
+        unseen = [
+            token for token in
+            window.values_list(token_field, flat=True).iterator()
+            if token not in seen
+        ]
+        for token in _unknown_to_pin(pin_env, url_tail, unseen):
+            yield Discrepancy('missing_remotely', token, None, None)
+
+    span = None  # the (lower, upper) times of the last page, unchecked
+    for records in _iter_window(pages, since, until):
+        tokens = set(record['token'] for record in records)
+        matched = dict(
+            (row[0], row[1:]) for row in local.filter(
+                **{token_field + '__in': tokens}
+            ).values_list(token_field, *fields)
+        )
+        for record in records:
+            if record['token'] in matched:
+                yield from compare(record, matched[record['token']])
+            else:
+                yield Discrepancy(
+                    'missing_locally', record['token'], None, None
+                )
+        recent.append(tokens)
+        if span is not None:
+            yield from missing_remotely(*span)
+        span = (_created_at(records[-1]), span[0] if span else until)
+    # The oldest page's span reaches back to since
+    yield from missing_remotely(since, span[1] if span else until)
+
+
+def _compare_charge(charge, values):
+    amount, succeeded = values
+    if amount != charge['amount']:
+        yield Discrepancy(
+            'amount_mismatch', charge['token'], amount, charge['amount']
+        )
+    if succeeded != bool(charge.get('success')):
+        yield Discrepancy(
+            'stale_status', charge['token'], succeeded,
+            bool(charge.get('success'))
+        )
+
+
+def _compare_transfer(transfer, values):
+    amount, status = values
+    if amount != transfer['amount']:
+        yield Discrepancy(
+            'amount_mismatch', transfer['token'], amount, transfer['amount']
+        )
+    if status != transfer['status']:
+        yield Discrepancy(
+            'stale_status', transfer['token'], status, transfer['status']
+        )
+
+
+def reconcile_charges(pin_env, since=None, until=None):
+    """
+    Yields a Discrepancy for every difference between the charges Pin holds
+    for pin_env and the PinTransactions stored for it, looking only at
+    charges created from since (or ever, if None) up to until.
+    """
+    transactions = PinTransaction.objects.filter(environment=pin_env.name)
+    return _reconcile(
+        pin_env, '/charges/{0}', pin_env.iter_charge_pages(), since, until,
+        transactions,
+        transactions.filter(processed=True, transaction_token__isnull=False),
+        'transaction_token', 'date', ('amount_minor', 'succeeded'),
+        _compare_charge
+    )
+
+
+def reconcile_transfers(pin_env, since=None, until=None):
+    """
+    Yields a Discrepancy for every difference between the transfers Pin
+    holds for pin_env and the PinTransfers stored for it, looking only at
+    transfers created from since (or ever, if None) up to until
+    """
+    transfers = PinTransfer.objects.filter(environment=pin_env.name)
+    return _reconcile(
+        pin_env, '/transfers/{0}', pin_env.iter_transfer_pages(), since,
+        until, transfers,
+        transfers.filter(transfer_token__isnull=False),
+        'transfer_token', 'created', ('amount', 'status'), _compare_transfer
+    )
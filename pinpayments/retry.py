@@ -0,0 +1,96 @@
+"""
+Policies deciding when a failed request to Pin is tried again
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+
+
+# Methods that can be repeated without changing the outcome. Anything else
+# (ie a POST, which creates a charge, customer, recipient or transfer) is
+# only retried when Pin can't have acted on the request.
+IDEMPOTENT_METHODS = ('get', 'put')
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds asked for by a Retry-After header,
+    which may be a number of seconds or an HTTP date, or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy(object):
+    """
+    How many times, and after which failures, a request is retried.
+    Waits between attempts back off exponentially with full jitter, unless
+    Pin sends a Retry-After header.
+    """
+    def __init__(self, total=2, backoff_factor=0.5, max_backoff=30,
+                 statuses=(500, 502, 503, 504)):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = tuple(statuses)
+
+    @classmethod
+    def from_settings(cls, retry_dict, method, url_tail):
+        """
+        Builds the policy for a request from the 'retry' dict of an
+        environment. Its 'endpoints' dict can override any option for URLs
+        starting with a given path, optionally prefixed by the method, eg
+        '/balance' or 'GET /charges'. The longest matching key wins.
+        """
+        options = dict(
+            (key, value) for key, value in retry_dict.items()
+            if key != 'endpoints'
+        )
+        request = '{0} {1}'.format(method.upper(), url_tail)
+        matches = sorted((
+            key for key in retry_dict.get('endpoints', {})
+            if url_tail.startswith(key) or request.startswith(key)
+        ), key=len)
+        for key in matches:
+            options.update(retry_dict['endpoints'][key])
+        return cls(**options)
+
+    def should_retry(self, method, attempt, status=None, sent=True,
+                     guarded=False):
+        """
+        Whether to retry after the given attempt (counting from 0) failed.
+        status is the HTTP status received, or None if the request failed
+        in transit. sent is False when the connection to Pin was never made.
+        guarded is True when a request that isn't idempotent is checked
+        for having taken effect before it is sent again. Only a complete
+        error response is retried then; one that failed in transit may
+        still be under way at Pin, where no check can see it yet.
+        """
+        if attempt >= self.total:
+            return False
+        if status == 429 or not sent:
+            return True
+        if method.lower() not in IDEMPOTENT_METHODS:
+            return guarded and status in self.statuses
+        return status is None or status in self.statuses
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the attempt following the given one.
+        A Retry-After from Pin is honoured up to max_backoff.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        ceiling = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        return random.uniform(0, ceiling)
@@ -1,2 +1,10 @@
+from pinpayments.tests.admin import *
+from pinpayments.tests.commands import *
+from pinpayments.tests.fake_server import *
+from pinpayments.tests.metrics import *
 from pinpayments.tests.models import *
+from pinpayments.tests.objects import *
+from pinpayments.tests.retry import *
 from pinpayments.tests.templatetags import *
+from pinpayments.tests.transports import *
+from pinpayments.tests.utils import *
@@ -0,0 +1,244 @@
+""" Ensure that the admin stays cheap on large tables """
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.urls import path
+from mock import patch
+from pinpayments.admin import EstimatedCountPaginator
+from pinpayments.models import (
+    BankAccount, CustomerToken, PinRecipient, PinTransaction, PinTransfer
+)
+from pinpayments.objects import get_environment
+
+urlpatterns = [
+    path('admin/', site.urls),
+]
+
+SEARCH_URL = '/admin/pinpayments/pintransaction/search-pin/'
+
+ENV_IN_MEMORY = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'transport': 'pinpayments.transports.InMemoryTransport',
+    },
+}
+
+
+class AdminTests(TestCase):
+    """ Admin query related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(AdminTests, self).setUp()
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'
+        )
+        self.customer = CustomerToken.objects.create(
+            user=self.user, token='cus_1', environment='test'
+        )
+        for index in range(30):
+            PinTransaction.objects.create(
+                customer_token=self.customer,
+                ip_address='127.0.0.1',
+                amount=index,
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+            )
+        bank_account = BankAccount.objects.create(
+            bank_name='Bank', branch='Branch', name='Test', bsb='123456',
+            number='987654321', environment='test',
+        )
+        for index in range(3):
+            recipient = PinRecipient.objects.create(
+                token='rp_{0}'.format(index), email='test@example.com',
+                bank_account=bank_account, environment='test',
+            )
+            PinTransfer.objects.create(
+                transfer_token='tfer_{0}'.format(index), currency='AUD',
+                amount=100, recipient=recipient,
+            )
+
+    def request(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    def changelist(self, model, **params):
+        return site._registry[model].get_changelist_instance(
+            self.request(**params)
+        )
+
+    def test_related_loaded(self):
+        """ Check foreign keys in the lists are loaded with a join """
+        for model, field in ((CustomerToken, 'user'),
+                             (PinTransfer, 'recipient'),
+                             (PinRecipient, 'bank_account')):
+            results = list(self.changelist(model).result_list)
+            with self.assertNumQueries(0):
+                for obj in results:
+                    str(getattr(obj, field))
+
+    def test_search_recipient(self):
+        """ Check transfers are found by the exact recipient token """
+        changelist = self.changelist(PinTransfer, q='rp_1')
+        self.assertEqual(
+            [t.transfer_token for t in changelist.result_list], ['tfer_1']
+        )
+        self.assertEqual(
+            self.changelist(PinTransfer, q='rp_').result_count, 0
+        )
+
+    def test_search_transactions(self):
+        """ Check transactions are searched with indexable lookups """
+        transaction = PinTransaction.objects.first()
+        transaction.email_address = 'Found@Example.com'
+        transaction.ip_address = '10.0.0.1'
+        transaction.save()
+        for term in ('FOUND@', '10.0.0.1', ' found@example.com '):
+            changelist = self.changelist(PinTransaction, q=term)
+            self.assertEqual(list(changelist.result_list), [transaction])
+            self.assertNotIn('UPPER', str(changelist.queryset.query))
+        self.assertEqual(
+            self.changelist(PinTransaction, q='example.com').result_count, 0
+        )
+        model_admin = site._registry[PinTransaction]
+        with patch.object(model_admin, 'email_search', 'exact'):
+            self.assertEqual(
+                self.changelist(PinTransaction, q='found@').result_count, 0
+            )
+        with patch.object(model_admin, 'email_search', 'contains'):
+            self.assertEqual(
+                self.changelist(PinTransaction, q='FOUND@EX').result_count, 1
+            )
+
+    def test_inline_capped(self):
+        """ Check only the newest transactions are shown for a token """
+        model_admin = site._registry[CustomerToken]
+        request = self.request()
+        inline = model_admin.get_inline_instances(request, self.customer)[0]
+        formset = inline.get_formset(request, self.customer)(
+            instance=self.customer
+        )
+        self.assertEqual(len(formset.forms), 20)
+        self.assertEqual(formset.forms[0].instance.amount, 29)
+
+    def test_estimated_count(self):
+        """ Check the paginator only estimates large unfiltered tables """
+        queryset = PinTransaction.objects.all()
+        with patch.object(
+            EstimatedCountPaginator, '_estimate', return_value=5000000
+        ):
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 5000000)
+            self.assertEqual(EstimatedCountPaginator(
+                queryset.filter(succeeded=True), 100
+            ).count, 0)
+        self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 30)
+        for model in (PinTransaction, CustomerToken, PinTransfer, PinRecipient):
+            model_admin = site._registry[model]
+            self.assertIs(model_admin.paginator, EstimatedCountPaginator)
+            self.assertFalse(model_admin.show_full_result_count)
+            self.assertIsNone(model_admin.date_hierarchy)
+
+    def test_fixed_filters(self):
+        """ Check the filter choices aren't read from the table """
+        PinTransfer.objects.filter(transfer_token='tfer_0').update(
+            status='paid'
+        )
+        for model in (PinTransaction, CustomerToken, PinTransfer, PinRecipient):
+            changelist = self.changelist(model)
+            with self.assertNumQueries(0):
+                for spec in changelist.filter_specs:
+                    list(spec.choices(changelist))
+        changelist = self.changelist(PinTransfer, status='paid')
+        self.assertEqual(
+            [transfer.transfer_token for transfer in changelist.result_list],
+            ['tfer_0']
+        )
+        self.assertEqual(
+            self.changelist(PinTransaction, currency='USD').result_count, 0
+        )
+        self.assertEqual(
+            self.changelist(PinTransaction, error_code='card_declined')
+            .result_count, 0
+        )
+        self.assertEqual(
+            list(self.changelist(CustomerToken, environment='test').result_list),
+            [self.customer]
+        )
+
+    def test_token_search(self):
+        """ Check tokens are only found by their exact, indexed, token """
+        CustomerToken.objects.filter(pk=self.customer.pk).update(
+            card_number='XXXX-XXXX-XXXX-0000'
+        )
+        for term in ('cus_', '0000'):
+            self.assertEqual(
+                self.changelist(CustomerToken, q=term).result_count, 0
+            )
+        self.assertEqual(
+            list(self.changelist(CustomerToken, q='cus_1').result_list),
+            [self.customer]
+        )
+
+@override_settings(
+    PIN_ENVIRONMENTS=ENV_IN_MEMORY, ROOT_URLCONF='pinpayments.tests.admin'
+)
+class SearchPinTests(TestCase):
+    """ Tests for searching the charges held by Pin from the admin """
+    def setUp(self):
+        """ Common setup for methods """
+        super(SearchPinTests, self).setUp()
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'
+        )
+        self.client.force_login(self.user)
+        self.stored = PinTransaction.objects.create(
+            card_token='card_1',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+            transaction_token='ch_stored',
+        )
+        self.transport = get_environment('test').transport
+        self.transport.clear()
+        self.transport.add('GET', '/charges/search', 200, {
+            'response': [
+                {'token': token, 'amount': 1000, 'currency': 'AUD',
+                 'email': 'test@example.com', 'created_at': '2020-01-02'}
+                for token in ('ch_stored', 'ch_missing')
+            ],
+            'pagination': {'next': None},
+        })
+
+    def test_search(self):
+        """ Check the search is made by Pin, and stored charges linked """
+        response = self.client.get(SEARCH_URL, {
+            'environment': 'test',
+            'query': 'test@example.com',
+            'start_date': '2020-01-01',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(result['charge']['token'], result['pk'])
+             for result in response.context['results']],
+            [('ch_stored', self.stored.pk), ('ch_missing', None)]
+        )
+        self.assertEqual(response.context['results'][0]['value'], 10)
+        self.assertContains(response, 'ch_missing')
+        params = self.transport.requests[0][2]['params']
+        self.assertEqual(params, {
+            'query': 'test@example.com', 'start_date': '2020/01/01', 'page': 1,
+        })
+
+    def test_unbound(self):
+        """ Check nothing is sent to Pin until the form is submitted """
+        response = self.client.get(SEARCH_URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.transport.requests, [])
+        response = self.client.get('/admin/pinpayments/pintransaction/')
+        self.assertContains(response, 'search-pin/')
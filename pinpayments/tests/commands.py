@@ -0,0 +1,417 @@
+""" Ensure that the management commands work as intended """
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+from mock import patch
+from pinpayments.models import (
+    PinTransaction, PinTransfer, ReconciliationCheckpoint
+)
+from pinpayments.objects import get_environment
+from pinpayments.reconcile import Discrepancy, reconcile_charges
+from pinpayments.tests.models import FakeResponse
+
+
+def charge_page(tokens, page, next_page=None):
+    """ A page of the Charges API, holding a charge for each token """
+    return json.dumps({
+        'response': [{
+            'token': token,
+            'success': True,
+            'amount': 1050,
+            'currency': 'AUD',
+            'description': 'test charge',
+            'email': 'test@example.com',
+            'ip_address': '127.0.0.1',
+            'created_at': '2012-06-20T03:10:49Z',
+            'status_message': 'Success!',
+            'total_fees': 62,
+            'card': {
+                'token': 'card_' + token,
+                'display_number': 'XXXX-XXXX-XXXX-0000',
+                'scheme': 'master',
+                'address_line1': '42 Sevenoaks St',
+                'address_line2': None,
+                'address_city': 'Lathlain',
+                'address_postcode': '6454',
+                'address_state': 'WA',
+                'address_country': 'Australia',
+            },
+        } for token in tokens],
+        'pagination': {'current': page, 'next': next_page},
+    })
+
+
+class PinWorkerTests(TestCase):
+    """ Tests for the pin_worker command """
+    def setUp(self):
+        """ Common setup for methods """
+        super(PinWorkerTests, self).setUp()
+        for amount in (10, 20, 30):
+            PinTransaction.objects.create(
+                card_token='12345',
+                ip_address='127.0.0.1',
+                amount=amount,
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+            )
+        self.response_data = json.dumps({
+            'response': {
+                'token': '12345',
+                'total_fees': 10,
+                'status_message': 'Success!',
+                'card': {
+                    'display_number': 'XXXX-XXXX-XXXX-0000',
+                    'scheme': 'visa',
+                    'address_line1': '42 Sevenoaks St',
+                    'address_line2': None,
+                    'address_city': 'Lathlain',
+                    'address_postcode': '6454',
+                    'address_state': 'WA',
+                    'address_country': 'Australia',
+                },
+            }
+        })
+
+    def test_claim(self):
+        """ Check claimed rows are marked processed and not claimed again """
+        claimed = PinTransaction.objects.claim(2)
+        self.assertEqual([t.amount for t in claimed], [10, 20])
+        self.assertTrue(all(t.processed for t in claimed))
+        self.assertEqual(
+            PinTransaction.objects.filter(processed=False).count(), 1
+        )
+        self.assertEqual(len(PinTransaction.objects.claim(2)), 1)
+        self.assertEqual(PinTransaction.objects.claim(2), [])
+
+    @patch('requests.Session.post')
+    def test_drains_once(self, mock_request):
+        """ Check every transaction is sent exactly once """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        stdout = StringIO()
+        call_command(
+            'pin_worker', once=True, batch_size=2, concurrency=1,
+            stdout=stdout
+        )
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(
+            PinTransaction.objects.filter(succeeded=True).count(), 3
+        )
+        self.assertIn("Processed 2 transactions, 2 succeeded", stdout.getvalue())
+        self.assertIn("Processed 1 transactions, 1 succeeded", stdout.getvalue())
+
+    @patch('requests.Session.post')
+    def test_environment(self, mock_request):
+        """ Check only the requested environment is drained """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        call_command(
+            'pin_worker', once=True, environment='live', stdout=StringIO()
+        )
+        self.assertFalse(mock_request.called)
+
+    @patch('requests.Session.post')
+    def test_records_errors(self, mock_request):
+        """ Check exceptions are recorded against the transaction """
+        mock_request.side_effect = ValueError('connection reset')
+        call_command(
+            'pin_worker', once=True, concurrency=1, stdout=StringIO()
+        )
+        self.assertEqual(
+            PinTransaction.objects.filter(
+                processed=True, pin_response='Failure: connection reset'
+            ).count(),
+            3
+        )
+
+
+class PinImportChargesTests(TestCase):
+    """ Tests for the pin_import_charges command """
+    def setUp(self):
+        """ Common setup for methods """
+        super(PinImportChargesTests, self).setUp()
+        self.existing = PinTransaction.objects.create(
+            card_token='12345',
+            ip_address='127.0.0.1',
+            amount=10.50,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+            transaction_token='ch_2',
+            error_code='card_declined',
+        )
+        self.pages = [
+            FakeResponse(200, charge_page(['ch_1', 'ch_2'], 1, 2)),
+            FakeResponse(200, charge_page(['ch_3'], 2)),
+        ]
+
+    @patch('requests.Session.get')
+    def test_import(self, mock_request):
+        """ Check new charges are created and known ones updated """
+        mock_request.side_effect = self.pages
+        stdout = StringIO()
+        call_command('pin_import_charges', stdout=stdout)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertIn("Created 2 transactions, updated 1", stdout.getvalue())
+        self.assertEqual(PinTransaction.objects.count(), 3)
+        self.existing.refresh_from_db()
+        self.assertTrue(self.existing.succeeded)
+        self.assertEqual(self.existing.pin_response, 'Success!')
+        self.assertIsNone(self.existing.error_code)
+        imported = PinTransaction.objects.get(transaction_token='ch_3')
+        self.assertEqual(imported.amount, Decimal('10.50'))
+        self.assertEqual(imported.fees, Decimal('0.62'))
+        self.assertEqual(imported.card_token, 'card_ch_3')
+        self.assertEqual(imported.environment, 'test')
+        self.assertIsNone(imported.pin_response_text)
+        self.assertEqual(imported.pin_response_data['token'], 'ch_3')
+
+    @patch('requests.Session.get')
+    def test_import_without_contact(self, mock_request):
+        """ Check charges made without an email or IP address import """
+        page = json.loads(charge_page(['ch_4'], 1))
+        del page['response'][0]['ip_address']
+        page['response'][0]['email'] = None
+        mock_request.side_effect = [FakeResponse(200, json.dumps(page))]
+        self.assertEqual(PinTransaction.objects.import_charges(), (1, 0))
+        imported = PinTransaction.objects.get(transaction_token='ch_4')
+        self.assertEqual(imported.email_address, '')
+        self.assertEqual(imported.ip_address, '0.0.0.0')
+
+    @patch('requests.Session.get')
+    def test_import_declined(self, mock_request):
+        """ Check failed charges are imported with an error code """
+        page = json.loads(charge_page(['ch_5', 'ch_6'], 1))
+        page['response'][0].update(
+            success=False, error_message='Card declined'
+        )
+        page['response'][1].update(
+            success=False, error='insufficient_funds',
+            error_message='Insufficient funds'
+        )
+        mock_request.side_effect = [FakeResponse(200, json.dumps(page))]
+        PinTransaction.objects.import_charges()
+        self.assertEqual(
+            list(PinTransaction.objects.filter(
+                transaction_token__in=['ch_5', 'ch_6']
+            ).order_by('transaction_token').values_list(
+                'error_code', 'error_message'
+            )),
+            [('declined', 'Card declined'),
+             ('insufficient_funds', 'Insufficient funds')]
+        )
+
+    @patch('requests.Session.get')
+    def test_import_twice(self, mock_request):
+        """ Check importing again updates rather than duplicates """
+        mock_request.side_effect = self.pages + [
+            FakeResponse(200, charge_page(['ch_1', 'ch_2'], 1, 2)),
+            FakeResponse(200, charge_page(['ch_3'], 2)),
+        ]
+        PinTransaction.objects.import_charges()
+        self.assertEqual(PinTransaction.objects.import_charges(), (0, 3))
+        self.assertEqual(PinTransaction.objects.count(), 3)
+
+
+class PinReconcileTests(TestCase):
+    """ Tests for the pin_reconcile command """
+    def setUp(self):
+        """ Common setup for methods """
+        super(PinReconcileTests, self).setUp()
+        for token, amount, succeeded in (
+                ('ch_1', Decimal('10.50'), True),  # matches
+                ('ch_2', Decimal('99.00'), True),  # wrong amount
+                ('ch_3', Decimal('10.50'), False),  # stale status
+                ('ch_9', Decimal('10.50'), True)):  # not held by Pin
+            PinTransaction.objects.create(
+                card_token='12345',
+                ip_address='127.0.0.1',
+                amount=amount,
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+                transaction_token=token,
+                processed=True,
+                succeeded=succeeded,
+            )
+        PinTransfer.objects.create(
+            transfer_token='tfer_1', status='pending', currency='AUD',
+            amount=500,
+        )
+        # ch_4 is held by Pin but not stored locally
+        self.charges = charge_page(['ch_4', 'ch_3', 'ch_2', 'ch_1'], 1)
+        self.transfers = json.dumps({
+            'response': [{
+                'token': 'tfer_1', 'status': 'paid', 'currency': 'AUD',
+                'amount': 500, 'created_at': '2012-06-20T03:10:49Z',
+            }],
+            'pagination': {'current': 1, 'next': None},
+        })
+
+    def fake_get(self, url, **kwargs):
+        """ Serves the charge and transfer lists, and each listed charge """
+        if url.endswith('/charges'):
+            return FakeResponse(200, self.charges)
+        if url.endswith('/transfers'):
+            return FakeResponse(200, self.transfers)
+        token = url.rsplit('/', 1)[1]
+        for charge in json.loads(self.charges)['response']:
+            if charge['token'] == token:
+                return FakeResponse(200, json.dumps({'response': charge}))
+        return FakeResponse(404, json.dumps({
+            'error': 'not_found', 'error_description': 'Not found',
+        }))
+
+    @patch('requests.Session.get')
+    def test_reconcile(self, mock_request):
+        """ Check every kind of discrepancy is reported """
+        mock_request.side_effect = self.fake_get
+        stdout = StringIO()
+        call_command('pin_reconcile', stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("charges missing_locally ch_4", output)
+        self.assertIn("charges amount_mismatch ch_2 local=9900 remote=1050", output)
+        self.assertIn("charges stale_status ch_3 local=False remote=True", output)
+        self.assertIn("charges missing_remotely ch_9", output)
+        self.assertNotIn(" ch_1 ", output)
+        self.assertIn("Found 4 discrepancies in charges", output)
+        self.assertIn(
+            "transfers stale_status tfer_1 local=pending remote=paid", output
+        )
+        self.assertEqual(ReconciliationCheckpoint.objects.count(), 2)
+
+    @patch('requests.Session.get')
+    def test_environment(self, mock_request):
+        """ Check transfers are only compared with their own environment """
+        mock_request.side_effect = self.fake_get
+        PinTransfer.objects.create(
+            transfer_token='tfer_live', status='paid', currency='AUD',
+            amount=500, environment='live',
+        )
+        stdout = StringIO()
+        call_command('pin_reconcile', only='transfers', stdout=stdout)
+        self.assertNotIn('tfer_live', stdout.getvalue())
+
+    @patch('requests.Session.get')
+    def test_window(self, mock_request):
+        """ Check records outside since and until are left alone """
+        mock_request.side_effect = self.fake_get
+        before = datetime(2012, 6, 1, tzinfo=timezone.utc)
+        self.assertEqual(list(reconcile_charges(
+            get_environment(), until=before
+        )), [])
+        stdout = StringIO()
+        call_command(
+            'pin_reconcile', only='charges', since='2012-06-21T00:00:00',
+            stdout=stdout
+        )
+        self.assertNotIn('missing_locally', stdout.getvalue())
+        self.assertIn('missing_remotely ch_9', stdout.getvalue())
+
+    def test_pages(self):
+        """ Check stored records are matched against neighbouring pages """
+        PinTransaction.objects.all().delete()
+        for token, day in (('ch_a', 2), ('ch_b', 2), ('ch_x', 1)):
+            PinTransaction.objects.create(
+                card_token='12345',
+                ip_address='127.0.0.1',
+                amount=Decimal('10.50'),
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+                transaction_token=token,
+                processed=True,
+                succeeded=True,
+                date=datetime(2012, 6, day, 12, tzinfo=timezone.utc),
+            )
+        # One charge per page; ch_a is stored with a time in ch_b's span
+        charges = json.loads(charge_page(['ch_a', 'ch_b', 'ch_c'], 1))
+        pages = (
+            [dict(charge, created_at='2012-06-0{0}T00:00:00Z'.format(3 - i))]
+            for i, charge in enumerate(charges['response'])
+        )
+        pin_env = get_environment()
+        with patch.object(pin_env, 'iter_charge_pages', return_value=pages), \
+                patch('requests.Session.get') as mock_request:
+            mock_request.side_effect = self.fake_get
+            found = list(reconcile_charges(pin_env))
+        self.assertEqual(found, [
+            Discrepancy('missing_locally', 'ch_c', None, None),
+            Discrepancy('missing_remotely', 'ch_x', None, None),
+        ])
+        # Only ch_x, which wasn't on the pages around it, was looked up
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_sent_later(self, mock_request):
+        """ Check a row queued long before its charge is looked up on Pin """
+        mock_request.side_effect = self.fake_get
+        PinTransaction.objects.all().delete()
+        charges = json.loads(charge_page(
+            ['ch_{0}'.format(index) for index in range(6)], 1
+        ))['response']
+        for index, charge in enumerate(charges):
+            charge['created_at'] = '2012-06-20T{0:02d}:00:00Z'.format(
+                12 - index
+            )
+        # ch_0 is the newest charge, but was queued three days before
+        PinTransaction.objects.create(
+            card_token='12345',
+            ip_address='127.0.0.1',
+            amount=Decimal('10.50'),
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+            transaction_token='ch_0',
+            processed=True,
+            succeeded=True,
+            date=datetime(2012, 6, 17, 12, tzinfo=timezone.utc),
+        )
+        self.charges = json.dumps({'response': charges})
+        pages = ([charge] for charge in charges)
+        pin_env = get_environment()
+        with patch.object(pin_env, 'iter_charge_pages', return_value=pages):
+            found = list(reconcile_charges(pin_env))
+        self.assertNotIn(
+            Discrepancy('missing_remotely', 'ch_0', None, None), found
+        )
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertTrue(mock_request.call_args[0][0].endswith('/charges/ch_0'))
+
+    @patch('requests.Session.get')
+    def test_checkpoint(self, mock_request):
+        """ Check the next run only looks at records since the last one """
+        mock_request.side_effect = self.fake_get
+        call_command('pin_reconcile', only='charges', stdout=StringIO())
+        stdout = StringIO()
+        call_command('pin_reconcile', only='charges', stdout=stdout)
+        self.assertIn("Found 0 discrepancies in charges", stdout.getvalue())
+        self.assertFalse(ReconciliationCheckpoint.objects.filter(
+            kind='transfers'
+        ).exists())
+
+
+class PinDeclineReportTests(TestCase):
+    """ Tests for the pin_decline_report command """
+    def test_report(self):
+        """ Check each error code is listed with its share of the day """
+        for error_code in (None, None, 'card_declined', 'expired_card'):
+            PinTransaction.objects.create(
+                card_token='12345',
+                ip_address='127.0.0.1',
+                amount=10,
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+                processed=True,
+                succeeded=error_code is None,
+                error_code=error_code,
+            )
+        stdout = StringIO()
+        call_command('pin_decline_report', stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(' card_declined 1 25.0%'))
+        self.assertTrue(lines[1].endswith(' expired_card 1 25.0%'))
@@ -0,0 +1,231 @@
+""" Ensure that the fake Pin API and the load test command work as intended """
+import asyncio
+from datetime import date
+from io import StringIO
+from unittest import skipUnless
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from pinpayments.exceptions import PinError
+from pinpayments.fake_server import PER_PAGE, FakePinServer
+from pinpayments.models import (
+    CustomerToken, PinRecipient, PinTransaction, PinTransfer
+)
+from pinpayments.objects import get_async_environment, get_environment
+from pinpayments.tests.models import httpx
+
+
+def fake_environments(server, **extra):
+    """ PIN_ENVIRONMENTS pointing the default environment at server """
+    env = {
+        'key': 'pk_fake',
+        'secret': 'sk_fake',
+        'host': server.host,
+        'scheme': 'http',
+    }
+    env.update(extra)
+    return {'test': env}
+
+
+class FakeServerTestCase(object):
+    """ Starts a FakePinServer for the tests in the class """
+    server_options = {}
+    env_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakePinServer(('127.0.0.1', 0), **cls.server_options)
+        cls.server.serve_in_thread()
+        cls.fake_settings = override_settings(
+            PIN_ENVIRONMENTS=fake_environments(cls.server, **cls.env_options)
+        )
+        cls.fake_settings.enable()
+        super(FakeServerTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(FakeServerTestCase, cls).tearDownClass()
+        cls.fake_settings.disable()
+        get_environment().close()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+
+class FakePinServerTests(FakeServerTestCase, TestCase):
+    """ Tests for FakePinServer """
+    def charge(self, card_token='card_1'):
+        transaction = PinTransaction.objects.create(
+            card_token=card_token,
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        )
+        transaction.process_transaction()
+        return transaction
+
+    def test_charge(self):
+        """ Check charges succeed, or are declined for card_declined """
+        transaction = self.charge()
+        self.assertTrue(transaction.succeeded)
+        self.assertTrue(transaction.transaction_token.startswith('ch_'))
+        self.assertEqual(transaction.pin_response, 'Success')
+        transaction = self.charge('card_declined')
+        self.assertFalse(transaction.succeeded)
+        self.assertEqual(
+            transaction.pin_response, 'Failure: The card was declined'
+        )
+
+    @skipUnless(httpx, "httpx is not installed")
+    def test_async_loops(self):
+        """ Check the shared async environment works from each new loop """
+        pin_env = get_async_environment()
+        for _ in range(2):
+            response = asyncio.run(pin_env.apin_get('/balance'))[0]
+            self.assertEqual(response.status_code, 200)
+        asyncio.run(pin_env.aclose())
+
+    def test_search(self):
+        """ Check charges are searched by email and creation date """
+        self.server.records['charges'] = []
+        self.charge()
+        self.server.records['charges'][0]['email'] = 'found@example.com'
+        self.charge()
+        pin_env = get_environment()
+        today = self.server.records['charges'][0]['created_at'][:10]
+        found = list(pin_env.search_charges(
+            'FOUND@', start_date=date.fromisoformat(today)
+        ))
+        self.assertEqual([c['email'] for c in found], ['found@example.com'])
+        self.assertEqual(
+            list(pin_env.search_charges('found', end_date=date(2000, 1, 1))),
+            []
+        )
+
+    def test_customer(self):
+        """ Check customers can be created and their card updated """
+        user = get_user_model().objects.create(
+            username='test', email='test@example.com'
+        )
+        customer = CustomerToken.create_from_card_token('card_1', user)
+        self.assertTrue(customer.token.startswith('cus_'))
+        self.assertEqual(customer.card_type, 'master')
+        customer.update_card('card_2')
+        with self.assertRaises(PinError):
+            get_environment().pin_put('/customers/cus_missing', {})
+
+    def test_pages(self):
+        """ Check charges are listed a page at a time, newest first """
+        del self.server.records['charges'][:]
+        for _ in range(PER_PAGE + 1):
+            self.charge()
+        pages = list(get_environment().iter_charge_pages())
+        self.assertEqual([len(page) for page in pages], [PER_PAGE, 1])
+        self.assertGreater(pages[0][0]['token'], pages[1][0]['token'])
+
+    def test_transfer(self):
+        """ Check transfers are paid out of the balance """
+        pin_env = get_environment()
+        before = pin_env.get_available_balance('AUD')
+        recipient = PinRecipient.create_with_bank_account(
+            'test@example.com', 'Test', '123456', '987654321'
+        )
+        transfer = PinTransfer.send_new(500, 'Test', recipient)
+        self.assertEqual(transfer.status, 'pending')
+        self.assertEqual(pin_env.get_available_balance('AUD'), before - 500)
+
+
+class FakePinServerLimitTests(FakeServerTestCase, TestCase):
+    """ Tests for the rate limit and error rate of FakePinServer """
+    server_options = {'rate_limit': 1, 'error_rate': 1}
+    env_options = {'retry': {'total': 0}}
+
+    def test_limits(self):
+        """ Check requests over the rate limit get a 429 with Retry-After """
+        pin_env = get_environment()
+        statuses = [
+            pin_env.pin_get('/balance', always_return=True)[0]
+            for _ in range(2)
+        ]
+        self.assertEqual([r.status_code for r in statuses], [500, 429])
+        self.assertEqual(statuses[1].headers['Retry-After'], '1')
+
+
+class FakePinServerJsonTests(FakeServerTestCase, TestCase):
+    """ Tests for FakePinServer with JSON and compressed request bodies """
+    env_options = {'body_format': 'json', 'compress_min_size': 1}
+
+    def test_charge(self):
+        """ Check a gzipped JSON charge is understood """
+        transaction = PinTransaction.objects.create(
+            card_token='card_declined',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        )
+        transaction.process_transaction()
+        self.assertEqual(transaction.error_code, 'card_declined')
+
+    def test_recipient(self):
+        """ Check a recipient's bank account is sent as a JSON object """
+        recipient = PinRecipient.create_with_bank_account(
+            'test@example.com', 'Mr Roland Robot', '123456', '987654321'
+        )
+        self.assertEqual(recipient.bank_account.name, 'Mr Roland Robot')
+        self.assertEqual(recipient.bank_account.bsb, '123456')
+        self.assertEqual(recipient.bank_account.number, '987654321')
+
+
+class PinLoadtestTests(FakeServerTestCase, TransactionTestCase):
+    """ Tests for the pin_loadtest command """
+    def test_charges(self):
+        """ Check every charge is sent and latency is reported """
+        out = StringIO()
+        call_command(
+            'pin_loadtest', requests=9, concurrency=4, stdout=out
+        )
+        self.assertIn("Sent 9 charge operations", out.getvalue())
+        self.assertIn("0 errors", out.getvalue())
+        self.assertEqual(
+            PinTransaction.objects.filter(succeeded=True).count(), 9
+        )
+
+    def test_transfers(self):
+        """ Check transfers are sent to a recipient created first """
+        out = StringIO()
+        call_command(
+            'pin_loadtest', operation='transfer', requests=3, stdout=out
+        )
+        self.assertIn("0 errors", out.getvalue())
+        self.assertEqual(PinTransfer.objects.count(), 3)
+
+    def test_transfers_environment(self):
+        """ Check transfers never fall back to a default environment on Pin """
+        environments = {
+            'test': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+            'fake': fake_environments(self.server)['test'],
+        }
+        out = StringIO()
+        with override_settings(PIN_ENVIRONMENTS=environments):
+            call_command(
+                'pin_loadtest', environment='fake', operation='transfer',
+                requests=2, stdout=out
+            )
+        self.assertIn("0 errors", out.getvalue())
+        self.assertEqual(PinRecipient.objects.get().environment, 'fake')
+        self.assertEqual(
+            PinTransfer.objects.filter(environment='fake').count(), 2
+        )
+
+    @override_settings(PIN_ENVIRONMENTS={'test': {
+        'key': 'k', 'secret': 's', 'host': 'test-api.pinpayments.com'
+    }})
+    def test_refuses_pin(self):
+        """ Check Pin's own hosts are never load tested """
+        with self.assertRaises(CommandError):
+            call_command('pin_loadtest', stdout=StringIO())
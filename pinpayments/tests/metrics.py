@@ -0,0 +1,113 @@
+""" Ensure that metrics are reported as intended """
+import json
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from requests import ConnectionError
+from pinpayments.metrics import (
+    MetricsBackend, endpoint_label, error_category, get_metrics_backend
+)
+from pinpayments.models import PinTransaction
+from pinpayments.objects import get_environment
+from pinpayments.tests.models import FakeResponse
+
+
+class RecordingBackend(MetricsBackend):
+    """ Keeps every measurement, for inspection """
+    def __init__(self):
+        self.started = []
+        self.finished = []
+        self.timings = []
+
+    def request_started(self, environment, method, endpoint):
+        self.started.append((environment, method, endpoint))
+
+    def request_finished(self, environment, method, endpoint, status,
+                         duration, retries, error):
+        self.finished.append((environment, method, endpoint, status, retries,
+                              error))
+
+    def timing(self, environment, name, duration):
+        self.timings.append((environment, name))
+
+
+@override_settings(PIN_METRICS_BACKEND='pinpayments.tests.metrics.RecordingBackend')
+class MetricsTests(TestCase):
+    """ Metrics related tests """
+    def test_labels(self):
+        """ Check tokens are removed from endpoint labels """
+        self.assertEqual(endpoint_label('/charges'), '/charges')
+        self.assertEqual(
+            endpoint_label('/customers/cus_XyZ/charges'),
+            '/customers/:token/charges'
+        )
+        self.assertEqual(endpoint_label('/bank_accounts'), '/bank_accounts')
+        self.assertEqual(
+            endpoint_label('/transfers/tfer_lfUYEBK14zotCTykezJkfg/line_items'),
+            '/transfers/:token/line_items'
+        )
+        self.assertEqual(endpoint_label('/charges/search'), '/charges/search')
+        self.assertEqual(error_category(200, None), None)
+        self.assertEqual(error_category(429, None), 'rate_limited')
+        self.assertEqual(error_category(422, None), 'client')
+        self.assertEqual(error_category(502, None), 'server')
+        self.assertEqual(error_category(None, ValueError()), 'transport')
+
+    @patch('time.sleep')
+    @patch('requests.Session.get')
+    def test_request(self, mock_request, mock_sleep):
+        """ Check a request is reported once, including its retries """
+        mock_request.side_effect = [
+            FakeResponse(503, 'unavailable'),
+            FakeResponse(200, json.dumps({'response': {}})),
+        ]
+        get_environment('test').pin_get('/customers/cus_1')
+        backend = get_metrics_backend()
+        self.assertEqual(backend.started, [('test', 'get', '/customers/:token')])
+        self.assertEqual(
+            backend.finished,
+            [('test', 'get', '/customers/:token', 200, 1, None)]
+        )
+        self.assertEqual(backend.timings, [('test', 'parse')])
+
+    @patch('requests.Session.post')
+    def test_encode_error(self, mock_request):
+        """ Check a payload that can't be encoded is never reported """
+        pin_env = get_environment('test')
+        with patch.object(pin_env, '_encode_payload', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                pin_env.pin_post('/charges', {})
+        backend = get_metrics_backend()
+        self.assertEqual((backend.started, backend.finished), ([], []))
+        self.assertFalse(mock_request.called)
+
+    @patch('requests.Session.post')
+    def test_error(self, mock_request):
+        """ Check failed requests are reported with their category """
+        mock_request.side_effect = ConnectionError('reset')
+        with self.assertRaises(ConnectionError):
+            get_environment('test').pin_post('/charges', {})
+        self.assertEqual(
+            get_metrics_backend().finished,
+            [('test', 'post', '/charges', None, 0, 'transport')]
+        )
+
+    @patch('requests.Session.post')
+    def test_transaction_save(self, mock_request):
+        """ Check saving a processed transaction is timed """
+        mock_request.return_value = FakeResponse(200, '')
+        PinTransaction.objects.create(
+            card_token='12345',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        ).process_transaction()
+        self.assertIn(('test', 'transaction_save'), get_metrics_backend().timings)
+
+    def test_no_backend(self):
+        """ Check nothing is measured by default """
+        with override_settings(PIN_METRICS_BACKEND=None):
+            self.assertIsNone(get_metrics_backend())
+            self.assertIsNone(get_environment('test').metrics)
@@ -1,9 +1,11 @@
 """ Ensure that the models work as intended """
 import json
+from decimal import Decimal
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from mock import patch
 from pinpayments.models import (
     ConfigError,
@@ -12,6 +14,12 @@ from pinpayments.models import (
     PinTransaction
 )
 from requests import Response
+from unittest import skipUnless
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 ENV_MISSING_SECRET = {
     'test': {
@@ -35,6 +43,11 @@ class FakeResponse(Response):
         self._content = content.encode('utf-8')
 
 
+def fake_async_response(status_code, content):
+    """ The httpx equivalent of FakeResponse """
+    return httpx.Response(status_code, content=content.encode('utf-8'))
+
+
 class CustomerTokenTests(TestCase):
     # Need to override the setting so we can delete it, not sure why.
     @override_settings(PIN_DEFAULT_ENVIRONMENT=None)
@@ -85,7 +98,7 @@ class CreateFromCardTokenTests(TestCase):
                 'One or more parameters were missing or invalid.'
         })
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_default_environment(self, mock_request):
         """ return a default environment """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -93,7 +106,7 @@ class CreateFromCardTokenTests(TestCase):
         self.assertEqual(token.environment, 'test')
 
     @override_settings(PIN_ENVIRONMENTS={})
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_valid_environment(self, mock_request):
         """ Check errors are raised with no environments """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -103,7 +116,7 @@ class CreateFromCardTokenTests(TestCase):
             )
 
     @override_settings(PIN_ENVIRONMENTS=ENV_MISSING_SECRET)
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_secret_set(self, mock_request):
         """ Check errors are raised when the secret is not set """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -113,7 +126,7 @@ class CreateFromCardTokenTests(TestCase):
             )
 
     @override_settings(PIN_ENVIRONMENTS=ENV_MISSING_HOST)
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_host_set(self, mock_request):
         """ Check errors are raised when the host is not set """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -122,7 +135,7 @@ class CreateFromCardTokenTests(TestCase):
                 '1234', self.user, environment='test'
             )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_not_json(self, mock_request):
         """ Validate non-json response """
         mock_request.return_value = FakeResponse(200, '')
@@ -131,7 +144,7 @@ class CreateFromCardTokenTests(TestCase):
                 '1234', self.user, environment='test'
             )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_error(self, mock_request):
         """ Validate generic error response """
         mock_request.return_value = FakeResponse(200, self.response_error)
@@ -140,7 +153,7 @@ class CreateFromCardTokenTests(TestCase):
                 '1234', self.user, environment='test'
             )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_success(self, mock_request):
         """ Validate successful response """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -154,6 +167,28 @@ class CreateFromCardTokenTests(TestCase):
         self.assertEqual(customer.card_number, 'XXXX-XXXX-XXXX-0000')
         self.assertEqual(customer.card_type, 'master')
 
+    @skipUnless(httpx, "httpx is not installed")
+    @patch('httpx.AsyncClient.post')
+    async def test_async_response_success(self, mock_request):
+        """ Validate successful response through the async client """
+        mock_request.return_value = fake_async_response(200, self.response_data)
+        customer = await CustomerToken.acreate_from_card_token(
+            '1234', self.user, environment='test'
+        )
+        self.assertIsInstance(customer, CustomerToken)
+        self.assertEqual(customer.token, '1234')
+        self.assertEqual(customer.card_number, 'XXXX-XXXX-XXXX-0000')
+
+    @skipUnless(httpx, "httpx is not installed")
+    @patch('httpx.AsyncClient.post')
+    async def test_async_response_error(self, mock_request):
+        """ Validate generic error response through the async client """
+        mock_request.return_value = fake_async_response(200, self.response_error)
+        with self.assertRaises(PinError):
+            await CustomerToken.acreate_from_card_token(
+                '1234', self.user, environment='test'
+            )
+
 
 class PinTransactionTests(TestCase):
     """ Transaction construction/init related tests """
@@ -197,6 +232,69 @@ class PinTransactionTests(TestCase):
         self.transaction.environment = 'this should not exist'
         self.assertRaises(PinError, self.transaction.save)
 
+    def test_minor_units(self):
+        """ Check the base unit amount follows amount and currency """
+        self.transaction.save()
+        self.assertEqual(self.transaction.amount_minor, 50000)
+        self.assertEqual(self.transaction.fees_minor, 0)
+        self.assertEqual(self.transaction._charge_payload()['amount'], 50000)
+        self.transaction.currency = 'JPY'
+        self.transaction.save(update_fields=['currency'])
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.amount_minor, 500)
+        self.assertEqual(self.transaction._charge_payload()['amount'], 500)
+        # Changed but not yet saved
+        self.transaction.amount = 750
+        self.assertEqual(self.transaction._charge_payload()['amount'], 750)
+
+    def test_email_lower(self):
+        """ Check the lower cased e-mail address follows the address """
+        self.transaction.email_address = 'Test@Example.COM'
+        self.transaction.save()
+        self.assertEqual(self.transaction.email_lower, 'test@example.com')
+        self.transaction.email_address = 'Other@Example.com'
+        self.transaction.save(update_fields=['email_address'])
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.email_lower, 'other@example.com')
+        transaction = PinTransaction.objects.only('pk', 'card_token').get()
+        transaction.save(update_fields=['card_token'])
+        self.assertEqual(
+            PinTransaction.objects.get().email_lower, 'other@example.com'
+        )
+
+    def test_totals(self):
+        """ Check amounts and fees are summed per currency """
+        for amount, fees, currency in (('10.50', '0.50', 'AUD'),
+                                       ('2.25', '0.25', 'AUD'),
+                                       ('700', '10', 'JPY')):
+            self.transaction.pk = None
+            self.transaction.amount = Decimal(amount)
+            self.transaction.fees = Decimal(fees)
+            self.transaction.currency = currency
+            self.transaction.save()
+        self.assertEqual(PinTransaction.objects.totals(), {
+            'AUD': (Decimal('12.75'), Decimal('0.75')),
+            'JPY': (Decimal('700'), Decimal('10')),
+        })
+
+    def test_response_text_deferred(self):
+        """
+        Check the raw response is only loaded on request, and isn't
+        overwritten when a row loaded without it is saved
+        """
+        self.transaction.pin_response_text = '{"response": {}}'
+        self.transaction.save()
+        transaction = PinTransaction.objects.get(pk=self.transaction.pk)
+        self.assertIn('pin_response_text', transaction.get_deferred_fields())
+        transaction.pin_response = 'Updated'
+        transaction.save()
+        transaction = PinTransaction.objects.with_response_text().get(
+            pk=self.transaction.pk
+        )
+        self.assertEqual(transaction.get_deferred_fields(), set())
+        self.assertEqual(transaction.pin_response_text, '{"response": {}}')
+        self.assertEqual(transaction.pin_response, 'Updated')
+
 
 class ProcessTransactionsTests(TestCase):
     """ Transaction processing related tests """
@@ -262,7 +360,7 @@ class ProcessTransactionsTests(TestCase):
             'charge_token': '1234'
         })
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_only_process_once(self, mock_request):
         """ Check that transactions are processed exactly once """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -279,42 +377,77 @@ class ProcessTransactionsTests(TestCase):
         result = self.transaction.process_transaction()
         self.assertIsNone(result)
 
+    @patch('requests.Session.post')
+    def test_claimed_elsewhere(self, mock_request):
+        """ Check a transaction claimed by another copy isn't sent again """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        stale = PinTransaction.objects.get(pk=self.transaction.pk)
+        self.transaction.process_transaction()
+        self.assertIsNone(stale.process_transaction())
+        self.assertTrue(stale.processed)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch('requests.Session.post')
+    def test_narrow_writes(self, mock_request):
+        """ Check processing claims the row then writes only the outcome """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        with CaptureQueriesContext(connection) as queries:
+            self.transaction.process_transaction()
+        claim, result = [query['sql'] for query in queries]
+        self.assertIn('"processed"', claim.split('WHERE')[1])
+        self.assertNotIn('"email_address"', claim + result)
+        self.assertNotIn('"processed"', result)
+        self.assertIn('"pin_response_text"', result)
+        self.transaction.refresh_from_db()
+        self.assertTrue(self.transaction.processed)
+        self.assertEqual(self.transaction.transaction_token, '12345')
+
     @override_settings(PIN_ENVIRONMENTS={})
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_valid_environment(self, mock_request):
         """ Check that an error is thrown with no environment """
         mock_request.return_value = FakeResponse(200, self.response_data)
         self.assertRaises(PinError, self.transaction.process_transaction)
 
     @override_settings(PIN_ENVIRONMENTS=ENV_MISSING_SECRET)
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_secret_set(self, mock_request):
         """ Check that an error is thrown with no secret """
         mock_request.return_value = FakeResponse(200, self.response_data)
         self.assertRaises(ConfigError, self.transaction.process_transaction)
 
     @override_settings(PIN_ENVIRONMENTS=ENV_MISSING_HOST)
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_host_set(self, mock_request):
         """ Check that an error is thrown with no host """
         mock_request.return_value = FakeResponse(200, self.response_data)
         self.assertRaises(ConfigError, self.transaction.process_transaction)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_not_json(self, mock_request):
         """ Check that failure is returned for non-JSON responses """
-        mock_request.return_value = FakeResponse(200, '')
+        mock_request.return_value = FakeResponse(200, 'Bad Gateway')
         response = self.transaction.process_transaction()
         self.assertEqual(response, 'Failure.')
+        self.assertEqual(self.transaction.pin_response_text, 'Bad Gateway')
+        self.assertIsNone(self.transaction.pin_response_data)
+        self.assertEqual(self.transaction.response_text, 'Bad Gateway')
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_badparam(self, mock_request):
         """ Check that a specific error is thrown for invalid parameters """
         mock_request.return_value = FakeResponse(200, self.response_error)
         response = self.transaction.process_transaction()
         self.assertEqual(response, 'Failure: Description can\'t be blank')
+        self.assertEqual(self.transaction.error_code, 'invalid_resource')
+        self.assertEqual(
+            self.transaction.error_message, 'Description can\'t be blank'
+        )
+        self.assertEqual(
+            self.transaction.pin_response_data['charge_token'], '1234'
+        )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_noparam(self, mock_request):
         """ Check that a specific error is thrown for missing parameters """
         mock_request.return_value = FakeResponse(
@@ -326,7 +459,7 @@ class ProcessTransactionsTests(TestCase):
             'Failure: One or more parameters were missing or invalid.'
         )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_response_success(self, mock_request):
         """ Check that the success response is correctly processed """
         mock_request.return_value = FakeResponse(200, self.response_data)
@@ -344,3 +477,173 @@ class ProcessTransactionsTests(TestCase):
         self.assertEqual(self.transaction.card_country, 'Australia')
         self.assertEqual(self.transaction.card_number, 'XXXX-XXXX-XXXX-0000')
         self.assertEqual(self.transaction.card_type, 'master')
+        self.assertIsNone(self.transaction.error_code)
+        self.assertEqual(
+            self.transaction.pin_response_data['response']['token'], '12345'
+        )
+        # The JSON is stored once, decoded
+        self.assertIsNone(self.transaction.pin_response_text)
+        self.assertEqual(
+            json.loads(self.transaction.response_text),
+            json.loads(self.response_data)
+        )
+
+    @patch('requests.Session.post')
+    def test_decline_report(self, mock_request):
+        """ Check declines are counted by day and error code """
+        mock_request.side_effect = [
+            FakeResponse(200, self.response_data),
+            FakeResponse(400, self.response_error),
+            FakeResponse(400, self.response_error_no_messages),
+            FakeResponse(200, self.response_data),
+        ]
+        self.transaction.process_transaction()
+        for _ in range(3):
+            self.transaction.pk = None
+            self.transaction.processed = False
+            self.transaction.error_code = None
+            self.transaction.process_transaction()
+        with self.assertNumQueries(1):
+            report = PinTransaction.objects.decline_report()
+        self.assertEqual(
+            [(row['error_code'], row['count'], row['rate']) for row in report],
+            [(None, 2, 0.5), ('invalid_resource', 2, 0.5)]
+        )
+
+    @skipUnless(httpx, "httpx is not installed")
+    @patch('httpx.AsyncClient.post')
+    async def test_async_response_success(self, mock_request):
+        """ Check the async success response is correctly processed """
+        mock_request.return_value = fake_async_response(200, self.response_data)
+        response = await self.transaction.aprocess_transaction()
+        self.assertEqual(response, 'Success!')
+        self.assertTrue(self.transaction.succeeded)
+        self.assertEqual(self.transaction.transaction_token, '12345')
+        self.assertEqual(self.transaction.card_type, 'master')
+
+        # Shouldn't process anything the second time
+        result = await self.transaction.aprocess_transaction()
+        self.assertIsNone(result)
+
+    @skipUnless(httpx, "httpx is not installed")
+    @patch('httpx.AsyncClient.post')
+    async def test_async_response_not_json(self, mock_request):
+        """ Check that failure is returned for non-JSON async responses """
+        mock_request.return_value = fake_async_response(200, '')
+        response = await self.transaction.aprocess_transaction()
+        self.assertEqual(response, 'Failure.')
+
+
+class ProcessAllTests(TransactionTestCase):
+    """ Bulk transaction processing related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(ProcessAllTests, self).setUp()
+        self.transactions = []
+        for amount in (10, 20, 30, 40, 50):
+            transaction = PinTransaction(
+                card_token='12345',
+                ip_address='127.0.0.1',
+                amount=amount,
+                currency='AUD',
+                email_address='test@example.com',
+                environment='test',
+            )
+            transaction.save()
+            self.transactions.append(transaction)
+        self.response_data = json.dumps({
+            'response': {
+                'token': '12345',
+                'total_fees': 10,
+                'status_message': 'Success!',
+                'card': {
+                    'display_number': 'XXXX-XXXX-XXXX-0000',
+                    'scheme': 'visa',
+                    'address_line1': '42 Sevenoaks St',
+                    'address_line2': None,
+                    'address_city': 'Lathlain',
+                    'address_postcode': '6454',
+                    'address_state': 'WA',
+                    'address_country': 'Australia',
+                },
+            }
+        })
+
+    @patch('requests.Session.post')
+    def test_process_all_serial(self, mock_request):
+        """ Check every unprocessed transaction is processed exactly once """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        self.transactions[0].process_transaction()
+        mock_request.reset_mock()
+
+        outcomes = PinTransaction.objects.all().process_all(concurrency=1)
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertEqual(
+            outcomes,
+            dict((t.pk, 'Success!') for t in self.transactions[1:])
+        )
+        self.assertFalse(
+            PinTransaction.objects.filter(processed=False).exists()
+        )
+
+    @patch('requests.Session.post')
+    def test_process_all_concurrent(self, mock_request):
+        """ Check transactions are processed by the worker pool """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        outcomes = PinTransaction.objects.filter(
+            amount__gte=20
+        ).process_all(concurrency=3)
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertEqual(set(outcomes.values()), set(['Success!']))
+        self.assertEqual(
+            PinTransaction.objects.filter(succeeded=True).count(), 4
+        )
+
+    @patch('requests.Session.post')
+    def test_process_all_errors(self, mock_request):
+        """ Check exceptions are reported per transaction """
+        mock_request.side_effect = ValueError('boom')
+        outcomes = PinTransaction.objects.all().process_all(concurrency=2)
+        self.assertEqual(len(outcomes), 5)
+        for outcome in outcomes.values():
+            self.assertIsInstance(outcome, ValueError)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Query plans differ by database")
+class IndexUsageTests(TestCase):
+    """ Check the hot queries are planned to use the composite indexes """
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_unprocessed(self):
+        """ Unprocessed transactions for an environment, oldest first """
+        self.assertUsesIndex(
+            PinTransaction.objects.filter(
+                processed=False, environment='live'
+            ).order_by('date'),
+            'pin_txn_unprocessed_idx'
+        )
+
+    def test_customer_transactions(self):
+        """ Transactions for a customer token, newest first """
+        self.assertUsesIndex(
+            PinTransaction.objects.filter(customer_token_id=1),
+            'pin_txn_customer_date_idx'
+        )
+
+    def test_currency_filter(self):
+        """ The admin's currency filter, newest first """
+        self.assertUsesIndex(
+            PinTransaction.objects.filter(currency='AUD'),
+            'pin_txn_currency_date_idx'
+        )
+
+    def test_active_tokens(self):
+        """ Active tokens for a user in an environment """
+        self.assertUsesIndex(
+            CustomerToken.objects.filter(
+                user_id=1, environment='live', active=True
+            ),
+            'pin_token_user_active_idx'
+        )
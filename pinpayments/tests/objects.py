@@ -0,0 +1,398 @@
+""" Ensure that the non-model objects work as intended """
+import asyncio
+import gzip
+import json
+import threading
+from unittest import skipUnless
+from urllib.parse import parse_qs
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from pinpayments.exceptions import ConfigError, PinError
+from pinpayments.models import PinRecipient, PinTransfer
+from pinpayments.objects import (
+    PinEnvironment, get_async_environment, get_environment
+)
+from pinpayments.tests.models import (
+    FakeResponse, fake_async_response, httpx
+)
+
+ENV_CACHED = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'balance_cache_timeout': 60,
+    },
+}
+
+ENV_POOLED = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'pool_connections': 2,
+        'pool_maxsize': 20,
+        'pool_block': True,
+    },
+}
+
+
+class PinEnvironmentSessionTests(TestCase):
+    """ Connection pooling related tests """
+    @patch('requests.Session.get')
+    def test_session_reused(self, mock_request):
+        """ Check that every request goes through the same session """
+        mock_request.return_value = FakeResponse(200, '{"response": {}}')
+        pin_env = PinEnvironment('test')
+        session = pin_env.session
+        pin_env.pin_get('/balance')
+        pin_env.pin_get('/balance')
+        self.assertIs(pin_env.session, session)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_POOLED)
+    def test_pool_settings(self):
+        """ Check the pool size is taken from PIN_ENVIRONMENTS """
+        pin_env = PinEnvironment('test')
+        adapter = pin_env.session.get_adapter('https://test-api.pin.net.au/')
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertTrue(adapter._pool_block)
+
+    def test_close(self):
+        """ Check closing drops the session so a new one is built """
+        pin_env = PinEnvironment('test')
+        session = pin_env.session
+        pin_env.close()
+        self.assertIsNot(pin_env.session, session)
+
+
+ENV_JSON = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'transport': 'pinpayments.transports.InMemoryTransport',
+        'body_format': 'json',
+        'compress_min_size': 100,
+    },
+}
+
+
+@override_settings(PIN_ENVIRONMENTS={'test': dict(
+    ENV_JSON['test'], body_format='form', compress_min_size=None
+)})
+class RequestBodyTests(TestCase):
+    """ Request payload encoding related tests """
+    def sent(self):
+        """ The keyword arguments of the last request sent """
+        return get_environment().transport.requests[-1][2]
+
+    def test_form(self):
+        """ Check POSTs are sent as a form, leaving out None """
+        get_environment().pin_post(
+            '/customers', {'email': 'a@example.com', 'card_token': None}, True
+        )
+        kwargs = self.sent()
+        self.assertNotIn('params', kwargs)
+        self.assertEqual(
+            kwargs['headers'],
+            {'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        self.assertEqual(
+            parse_qs(kwargs['data'].decode()), {'email': ['a@example.com']}
+        )
+
+    def test_get(self):
+        """ Check GET parameters stay in the query string """
+        get_environment().pin_get('/charges', True, {'page': 2})
+        kwargs = self.sent()
+        self.assertEqual(kwargs['params'], {'page': 2})
+        self.assertNotIn('data', kwargs)
+        self.assertNotIn('headers', kwargs)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_JSON)
+    def test_json_compressed(self):
+        """ Check JSON bodies are sent, gzipped once they are large """
+        get_environment().pin_put('/customers/cus_1', {'email': 'a'}, True)
+        kwargs = self.sent()
+        self.assertEqual(kwargs['headers'], {'Content-Type': 'application/json'})
+        self.assertEqual(json.loads(kwargs['data'].decode()), {'email': 'a'})
+
+        get_environment().pin_put('/customers/cus_1', {'email': 'a' * 100}, True)
+        kwargs = self.sent()
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            json.loads(gzip.decompress(kwargs['data']).decode()),
+            {'email': 'a' * 100}
+        )
+
+    @override_settings(PIN_ENVIRONMENTS={'test': dict(
+        ENV_JSON['test'], compress_min_size=None
+    )})
+    def test_json_nested(self):
+        """ Check bracketed form fields are sent as nested JSON objects """
+        get_environment().pin_post('/recipients', {
+            'email': 'a@example.com',
+            'bank_account[name]': 'Mr Roland Robot',
+            'bank_account[bsb]': '123456',
+            'metadata[order][id]': 7,
+        }, True)
+        self.assertEqual(json.loads(self.sent()['data'].decode()), {
+            'email': 'a@example.com',
+            'bank_account': {'name': 'Mr Roland Robot', 'bsb': '123456'},
+            'metadata': {'order': {'id': 7}},
+        })
+
+    @override_settings(PIN_ENVIRONMENTS={'test': dict(
+        ENV_JSON['test'], body_format='xml'
+    )})
+    def test_invalid(self):
+        """ Check an unknown body_format raises ConfigError """
+        with self.assertRaises(ConfigError):
+            PinEnvironment('test')
+
+
+class EnvironmentRegistryTests(TestCase):
+    """ Shared environment related tests """
+    def test_shared(self):
+        """ Check the same environment is handed out on every call """
+        pin_env = get_environment('test')
+        self.assertIs(get_environment('test'), pin_env)
+        self.assertIs(get_environment(), pin_env)
+
+    def test_cleared_on_setting_changed(self):
+        """ Check environments are rebuilt when PIN_ENVIRONMENTS changes """
+        pin_env = get_environment('test')
+        with override_settings(PIN_ENVIRONMENTS=ENV_POOLED):
+            pooled_env = get_environment('test')
+            self.assertIsNot(pooled_env, pin_env)
+            self.assertEqual(pooled_env.pool_maxsize, 20)
+        self.assertIsNot(get_environment('test'), pooled_env)
+
+    @override_settings(PIN_ENVIRONMENTS={})
+    def test_invalid_not_cached(self):
+        """ Check invalid environments raise on every call """
+        with self.assertRaises(ConfigError):
+            get_environment('test')
+        with self.assertRaises(ConfigError):
+            get_environment('test')
+
+
+class AsyncPinEnvironmentTests(TestCase):
+    """ Async client related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(AsyncPinEnvironmentTests, self).setUp()
+        self.response_data = json.dumps({
+            'response': {
+                'available': [{'currency': 'AUD', 'amount': 400}],
+                'pending': [{'currency': 'AUD', 'amount': 1200}],
+            }
+        })
+
+    def test_shared(self):
+        """ Check async environments are shared separately to sync ones """
+        pin_env = get_async_environment('test')
+        self.assertIs(get_async_environment('test'), pin_env)
+        self.assertIsNot(get_environment('test'), pin_env)
+
+    @skipUnless(httpx, "httpx is not installed")
+    @patch('httpx.AsyncClient.get')
+    async def test_balance(self, mock_request):
+        """ Check balances are parsed from the async client """
+        mock_request.return_value = fake_async_response(200, self.response_data)
+        pin_env = get_async_environment('test')
+        self.assertEqual(await pin_env.aget_available_balance(), 400)
+        self.assertEqual(await pin_env.aget_pending_balance(), 1200)
+        self.assertIs(pin_env.client, pin_env.client)
+
+
+class IterChargePagesTests(TestCase):
+    """ Charge history paging related tests """
+    @patch('requests.Session.get')
+    def test_pages(self, mock_request):
+        """ Check every page is yielded in order """
+        mock_request.side_effect = [
+            FakeResponse(200, json.dumps({
+                'response': [{'token': 'ch_1'}, {'token': 'ch_2'}],
+                'pagination': {'current': 1, 'next': 2},
+            })),
+            FakeResponse(200, json.dumps({
+                'response': [{'token': 'ch_3'}],
+                'pagination': {'current': 2, 'next': None},
+            })),
+        ]
+        pages = list(get_environment('test').iter_charge_pages())
+        self.assertEqual(
+            [[charge['token'] for charge in page] for page in pages],
+            [['ch_1', 'ch_2'], ['ch_3']]
+        )
+        self.assertEqual(
+            mock_request.call_args_list[1][1]['params'], {'page': 2}
+        )
+
+    @patch('requests.Session.get')
+    def test_stops_early(self, mock_request):
+        """ Check no more than one page is read ahead of the caller """
+        read_ahead = threading.Event()
+
+        def get_page(*args, **kwargs):
+            if kwargs['params']['page'] == 2:
+                read_ahead.set()
+            return FakeResponse(200, json.dumps({
+                'response': [{'token': 'ch_1'}],
+                'pagination': {'next': kwargs['params']['page'] + 1},
+            }))
+        mock_request.side_effect = get_page
+        pages = get_environment('test').iter_charge_pages()
+        next(pages)
+        pages.close()
+        # The read-ahead was submitted before the first page was yielded,
+        # so wait for it while get is still patched
+        self.assertTrue(read_ahead.wait(5))
+        self.assertEqual(mock_request.call_count, 2)
+
+
+@override_settings(PIN_ENVIRONMENTS={'test': dict(
+    ENV_JSON['test'],
+    async_transport='pinpayments.transports.InMemoryTransport',
+)})
+class IterPagesTests(TestCase):
+    """ Generic paging related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(IterPagesTests, self).setUp()
+        get_environment('test').transport.clear()
+        get_async_environment('test').transport.clear()
+
+    def add_pages(self, transport):
+        """ Queues two pages of customers, the first linking to the second """
+        transport.add('GET', '/customers', 200, {
+            'response': [{'token': 'cus_1'}, {'token': 'cus_2'}],
+            'pagination': {'current': 1, 'next': 2},
+        })
+        transport.add('GET', '/customers', 200, {
+            'response': [{'token': 'cus_3'}],
+            'pagination': {'current': 2, 'next': None},
+        })
+
+    def test_records(self):
+        """ Check records are yielded across pages, keeping params """
+        pin_env = get_environment('test')
+        self.add_pages(pin_env.transport)
+        records = pin_env.iter_pages('/customers', {'per_page': 2})
+        self.assertEqual(
+            [customer['token'] for customer in records],
+            ['cus_1', 'cus_2', 'cus_3']
+        )
+        self.assertEqual(
+            [kwargs['params'] for _, _, kwargs in pin_env.transport.requests],
+            [{'per_page': 2, 'page': 1}, {'per_page': 2, 'page': 2}]
+        )
+
+    async def test_async(self):
+        """ Check the async iterator yields the same records """
+        pin_env = get_async_environment('test')
+        self.add_pages(pin_env.transport)
+        records = [
+            customer['token']
+            async for customer in pin_env.aiter_pages('/customers')
+        ]
+        self.assertEqual(records, ['cus_1', 'cus_2', 'cus_3'])
+
+    async def test_async_stops_early(self):
+        """ Check the read-ahead is cancelled once the caller stops """
+        pin_env = get_async_environment('test')
+        self.add_pages(pin_env.transport)
+        arequest = pin_env.transport.arequest
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def second_page_never_arrives(method, url, **kwargs):
+            if kwargs['params']['page'] == 1:
+                return await arequest(method, url, **kwargs)
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with patch.object(
+            pin_env.transport, 'arequest', second_page_never_arrives
+        ):
+            records = pin_env.aiter_pages('/customers')
+            await records.__anext__()
+            await asyncio.wait_for(started.wait(), 5)
+            await records.aclose()
+            await asyncio.wait_for(cancelled.wait(), 5)
+        self.assertEqual(len(pin_env.transport.requests), 1)
+
+
+class BalanceTests(TestCase):
+    """ Balance related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(BalanceTests, self).setUp()
+        cache.clear()
+        self.response_data = json.dumps({
+            'response': {
+                'available': [
+                    {'currency': 'AUD', 'amount': 400},
+                    {'currency': 'USD', 'amount': 50},
+                ],
+                'pending': [
+                    {'currency': 'AUD', 'amount': 1200},
+                    {'currency': 'USD', 'amount': 0},
+                ],
+            }
+        })
+
+    @patch('requests.Session.get')
+    def test_get_balances(self, mock_request):
+        """ Check every currency is returned from a single request """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        balances = get_environment('test').get_balances()
+        self.assertEqual(balances, {'AUD': (400, 1200), 'USD': (50, 0)})
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_get_balance(self, mock_request):
+        """ Check a single currency is picked out """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        pin_env = get_environment('test')
+        self.assertEqual(pin_env.get_balance('USD'), (50, 0))
+        self.assertEqual(pin_env.get_available_balance(), 400)
+        self.assertEqual(pin_env.get_pending_balance(), 1200)
+        with self.assertRaises(PinError):
+            pin_env.get_balance('NZD')
+        # Not cached unless configured
+        self.assertEqual(mock_request.call_count, 4)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_CACHED)
+    @patch('requests.Session.get')
+    def test_cached(self, mock_request):
+        """ Check balances are cached, and dropped after a transfer """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        pin_env = get_environment('test')
+        pin_env.get_available_balance('AUD')
+        pin_env.get_pending_balance('USD')
+        self.assertEqual(mock_request.call_count, 1)
+
+        recipient = PinRecipient.objects.create(
+            token='rp_1', email='test@example.com'
+        )
+        with patch('requests.Session.post') as mock_post:
+            mock_post.return_value = FakeResponse(200, json.dumps({
+                'response': {
+                    'token': 'tfer_1', 'status': 'pending',
+                    'currency': 'AUD', 'description': 'Payout',
+                    'amount': 400,
+                }
+            }))
+            PinTransfer.send_new(400, 'Payout', recipient)
+        pin_env.get_balances()
+        self.assertEqual(mock_request.call_count, 2)
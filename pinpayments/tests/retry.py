@@ -0,0 +1,285 @@
+""" Ensure that requests to Pin are retried and timed out as intended """
+import json
+from urllib.parse import parse_qs
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from requests import ConnectionError, ConnectTimeout, ReadTimeout
+from pinpayments.exceptions import PinTimeout
+from pinpayments.fake_server import CARD
+from pinpayments.models import PinTransaction
+from pinpayments.objects import Deadline, get_environment
+from pinpayments.retry import RetryPolicy, parse_retry_after
+from pinpayments.tests.models import FakeResponse
+from pinpayments.tests.transports import ENV_IN_MEMORY
+
+ENV_RETRY = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'retry': {
+            'total': 3,
+            'endpoints': {
+                '/balance': {'total': 1},
+                'GET /charges': {'statuses': [502]},
+            },
+        },
+    },
+}
+
+
+ENV_TIMEOUT = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'timeout': [3, 7],
+        'deadline': 5,
+    },
+}
+
+
+class RetryPolicyTests(TestCase):
+    """ Tests for the retry decisions themselves """
+    def test_idempotent_methods(self):
+        """ Check only GET and PUT are retried after server errors """
+        policy = RetryPolicy(total=2)
+        self.assertTrue(policy.should_retry('get', 0, status=503))
+        self.assertTrue(policy.should_retry('PUT', 1, status=None))
+        self.assertFalse(policy.should_retry('get', 2, status=503))
+        self.assertFalse(policy.should_retry('get', 0, status=200))
+        self.assertFalse(policy.should_retry('post', 0, status=503))
+        self.assertFalse(policy.should_retry('post', 0, status=None))
+
+    def test_safe_post_retries(self):
+        """ Check POSTs are retried only when Pin can't have acted on them """
+        policy = RetryPolicy(total=2)
+        self.assertTrue(policy.should_retry('post', 0, status=429))
+        self.assertTrue(policy.should_retry('post', 0, sent=False))
+        # Pin may still be acting on one that timed out or was dropped
+        self.assertFalse(policy.should_retry('post', 0, guarded=True))
+        self.assertTrue(policy.should_retry('post', 0, 503, guarded=True))
+        self.assertFalse(policy.should_retry('post', 0, 400, guarded=True))
+
+    def test_backoff(self):
+        """ Check backoff is jittered, capped and overridden by Retry-After """
+        policy = RetryPolicy(backoff_factor=1, max_backoff=3)
+        for attempt in range(6):
+            self.assertTrue(0 <= policy.backoff(attempt) <= 3)
+        self.assertEqual(policy.backoff(5, retry_after=2), 2)
+        self.assertEqual(policy.backoff(5, retry_after=12), 3)
+
+    def test_parse_retry_after(self):
+        """ Check both forms of Retry-After are understood """
+        self.assertEqual(parse_retry_after('7'), 7)
+        self.assertEqual(
+            parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0
+        )
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_from_settings(self):
+        """ Check endpoint overrides are applied, most specific last """
+        retry = ENV_RETRY['test']['retry']
+        balance = RetryPolicy.from_settings(retry, 'get', '/balance')
+        self.assertEqual(balance.total, 1)
+        charges = RetryPolicy.from_settings(retry, 'get', '/charges/ch_1')
+        self.assertEqual((charges.total, charges.statuses), (3, (502,)))
+        charges = RetryPolicy.from_settings(retry, 'post', '/charges')
+        self.assertEqual(charges.statuses, (500, 502, 503, 504))
+
+
+@patch('time.sleep')
+class PinRequestRetryTests(TestCase):
+    """ Tests for retrying requests made through PinEnvironment """
+    def setUp(self):
+        """ Common setup for methods """
+        super(PinRequestRetryTests, self).setUp()
+        self.response_data = json.dumps({'response': {}})
+
+    @patch('requests.Session.get')
+    def test_get_retried(self, mock_request, mock_sleep):
+        """ Check GETs are retried until they succeed """
+        mock_request.side_effect = [
+            FakeResponse(503, 'unavailable'),
+            ConnectionError('reset'),
+            FakeResponse(200, self.response_data),
+        ]
+        get_environment('test').pin_get('/customers')
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_RETRY)
+    @patch('requests.Session.get')
+    def test_gives_up(self, mock_request, mock_sleep):
+        """ Check the last response is used once retries run out """
+        mock_request.return_value = FakeResponse(503, 'unavailable')
+        response = get_environment('test').pin_get('/balance', True)[0]
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch('requests.Session.post')
+    def test_post_not_retried(self, mock_request, mock_sleep):
+        """ Check charges are never sent twice after an ambiguous failure """
+        mock_request.side_effect = ConnectionError('reset')
+        with self.assertRaises(ConnectionError):
+            get_environment('test').pin_post('/charges', {})
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch('requests.Session.post')
+    def test_post_retried_when_unsent(self, mock_request, mock_sleep):
+        """ Check POSTs are retried after rate limiting or connect failure """
+        rate_limited = FakeResponse(429, 'slow down')
+        rate_limited.headers['Retry-After'] = '3'
+        mock_request.side_effect = [
+            rate_limited,
+            ConnectTimeout('timed out'),
+            FakeResponse(200, self.response_data),
+        ]
+        get_environment('test').pin_post('/charges', {})
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_args_list[0][0][0], 3)
+
+    def charge_found_by_guard(self, **fields):
+        """
+        Creates a transaction whose charge fails with a server error, but
+        is then found on Pin, with the given fields, by the guard
+        """
+        transaction = PinTransaction.objects.create(
+            card_token='card_1',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        )
+        charge = dict({
+            'token': 'ch_1',
+            'success': True,
+            'amount': 1000,
+            'total_fees': 48,
+            'currency': 'AUD',
+            'created_at': '2012-06-20T03:10:49Z',
+            'status_message': 'Success',
+            'error_message': None,
+            'metadata': {'pinpayments_transaction': str(transaction.pk)},
+            'card': dict(CARD, token='card_1'),
+        }, **fields)
+        transport = get_environment('test').transport
+        transport.add('POST', '/charges', 500, {'error': 'server_error'})
+        transport.add('GET', '/charges/search', 200, {
+            'response': [dict(charge, token='ch_0', metadata={}), charge],
+            'pagination': {'pages': 1},
+        })
+        transport.add('GET', '/charges/ch_1', 200, {'response': charge})
+        return transaction, transport
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_IN_MEMORY)
+    def test_charge_found_by_guard(self, mock_sleep):
+        """ Check a charge Pin made before failing isn't sent again """
+        transaction, transport = self.charge_found_by_guard()
+        self.assertEqual(transaction.process_transaction(deadline=5), 'Success')
+        self.assertEqual(transaction.transaction_token, 'ch_1')
+        self.assertEqual(transaction.fees_minor, 48)
+        self.assertEqual(
+            [(method, url_tail) for method, url_tail, _ in transport.requests],
+            [
+                ('post', '/charges'),
+                ('get', '/charges/search'),
+                ('get', '/charges/ch_1'),
+            ]
+        )
+        payload = parse_qs(transport.requests[0][2]['data'].decode())
+        self.assertEqual(
+            payload['metadata[pinpayments_transaction]'], [str(transaction.pk)]
+        )
+        # The lookups share the charge's deadline
+        for _, _, kwargs in transport.requests:
+            self.assertTrue(max(kwargs['timeout']) <= 5)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_IN_MEMORY)
+    def test_declined_charge_found_by_guard(self, mock_sleep):
+        """ Check a declined charge found by the guard is a failure """
+        transaction, transport = self.charge_found_by_guard(
+            success=False, total_fees=None, status_message='Declined',
+            error_message='Card declined',
+        )
+        self.assertEqual(
+            transaction.process_transaction(), 'Failure: Card declined'
+        )
+        transaction.refresh_from_db()
+        self.assertTrue(transaction.processed)
+        self.assertFalse(transaction.succeeded)
+        self.assertEqual(transaction.transaction_token, 'ch_1')
+        self.assertEqual(transaction.error_code, 'declined')
+        self.assertEqual(transaction.error_message, 'Card declined')
+        self.assertEqual(transaction.fees_minor, 0)
+
+
+@patch('time.sleep')
+class TimeoutTests(TestCase):
+    """ Tests for timeouts and deadlines on requests to Pin """
+    @override_settings(PIN_ENVIRONMENTS=ENV_TIMEOUT)
+    @patch('requests.Session.get')
+    def test_timeout_settings(self, mock_request, mock_sleep):
+        """ Check the timeouts are taken from PIN_ENVIRONMENTS """
+        mock_request.return_value = FakeResponse(200, '{"response": {}}')
+        get_environment('test').pin_get('/customers')
+        connect, read = mock_request.call_args[1]['timeout']
+        self.assertEqual(connect, 3)
+        # Shortened to fit the 5 second default deadline
+        self.assertTrue(4 < read <= 5)
+
+    @patch('requests.Session.get')
+    def test_default_timeout(self, mock_request, mock_sleep):
+        """ Check requests are never made without a timeout """
+        mock_request.return_value = FakeResponse(200, '{"response": {}}')
+        get_environment('test').pin_get('/customers')
+        self.assertEqual(mock_request.call_args[1]['timeout'], (10, 60))
+
+    @patch('requests.Session.get')
+    def test_deadline_stops_retries(self, mock_request, mock_sleep):
+        """ Check retries that can't finish by the deadline aren't made """
+        unavailable = FakeResponse(503, 'unavailable')
+        unavailable.headers['Retry-After'] = '10'
+        mock_request.return_value = unavailable
+        response = get_environment('test').pin_get(
+            '/customers', True, deadline=2
+        )[0]
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertFalse(mock_sleep.called)
+
+    @patch('requests.Session.get')
+    def test_expired_deadline(self, mock_request, mock_sleep):
+        """ Check nothing is sent once the deadline has passed """
+        deadline = Deadline(0)
+        with self.assertRaises(PinTimeout):
+            get_environment('test').pin_get('/customers', deadline=deadline)
+        self.assertFalse(mock_request.called)
+
+    @patch('requests.Session.get')
+    @patch('requests.Session.post')
+    def test_process_transaction(self, mock_request, mock_search, mock_sleep):
+        """ Check a timed out charge raises PinTimeout and is recorded """
+        mock_request.side_effect = ReadTimeout('read timed out')
+        mock_search.return_value = FakeResponse(
+            200, '{"response": [], "pagination": {"pages": 1}}'
+        )
+        transaction = PinTransaction.objects.create(
+            card_token='12345',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        )
+        with self.assertRaises(PinTimeout):
+            transaction.process_transaction(deadline=10)
+        # Its outcome is unknown, so it's neither looked for nor resent
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertFalse(mock_search.called)
+        transaction.refresh_from_db()
+        self.assertTrue(transaction.processed)
+        self.assertEqual(transaction.pin_response, 'Timed out.')
@@ -0,0 +1,193 @@
+""" Ensure that the transports work as intended """
+import asyncio
+import json
+import shutil
+import tempfile
+from unittest import skipUnless
+from urllib.parse import parse_qs
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from requests import ConnectTimeout
+from pinpayments.exceptions import ConfigError, PinError
+from pinpayments.models import PinTransaction
+from pinpayments.objects import (
+    PinEnvironment, get_async_environment, get_environment
+)
+from pinpayments.tests.models import FakeResponse, httpx
+from pinpayments.transports import HttpxTransport, InMemoryTransport
+
+ENV_IN_MEMORY = {
+    'test': {
+        'key': 'key1',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+        'transport': 'pinpayments.transports.InMemoryTransport',
+        'async_transport': 'pinpayments.transports.InMemoryTransport',
+    },
+}
+
+BALANCE = {
+    'response': {
+        'available': [{'currency': 'AUD', 'amount': 400}],
+        'pending': [{'currency': 'AUD', 'amount': 1200}],
+    }
+}
+
+
+@override_settings(PIN_ENVIRONMENTS=ENV_IN_MEMORY)
+class InMemoryTransportTests(TestCase):
+    """ InMemoryTransport related tests """
+    def test_selected(self):
+        """ Check the transport is chosen by PIN_ENVIRONMENTS """
+        self.assertIsInstance(get_environment().transport, InMemoryTransport)
+        self.assertIsInstance(
+            get_async_environment().transport, InMemoryTransport
+        )
+
+    @override_settings(PIN_ENVIRONMENTS={'test': dict(
+        ENV_IN_MEMORY['test'], transport='pinpayments.transports.Missing'
+    )})
+    def test_invalid(self):
+        """ Check a transport that can't be imported raises ConfigError """
+        with self.assertRaises(ConfigError):
+            PinEnvironment('test')
+
+    def test_charge(self):
+        """ Check a charge is answered without touching the network """
+        transport = get_environment().transport
+        transport.add('POST', '/charges', 400, {
+            'error': 'card_declined',
+            'error_description': 'The card was declined',
+            'charge_token': 'ch_1',
+        })
+        transaction = PinTransaction.objects.create(
+            card_token='card_1',
+            ip_address='127.0.0.1',
+            amount=10,
+            currency='AUD',
+            email_address='test@example.com',
+            environment='test',
+        )
+        transaction.process_transaction()
+        self.assertEqual(
+            transaction.pin_response, 'Failure: The card was declined'
+        )
+        method, url_tail, kwargs = transport.requests[0]
+        self.assertEqual((method, url_tail), ('post', '/charges'))
+        self.assertEqual(parse_qs(kwargs['data'].decode())['amount'], ['1000'])
+
+    @patch('time.sleep')
+    def test_queued(self, mock_sleep):
+        """ Check queued responses and errors are used in order """
+        transport = get_environment().transport
+        transport.add('GET', '/balance', exc=ConnectTimeout())
+        transport.add('GET', '/balance', 200, BALANCE)
+        self.assertEqual(get_environment().get_available_balance(), 400)
+        self.assertEqual(get_environment().get_pending_balance(), 1200)
+        self.assertEqual(len(transport.requests), 3)
+        transport.clear()
+        with self.assertRaises(PinError):
+            get_environment().get_balances()
+
+    async def test_async(self):
+        """ Check async environments can use the in-memory transport """
+        pin_env = get_async_environment()
+        pin_env.transport.add('GET', '/balance', 200, BALANCE)
+        self.assertEqual(await pin_env.aget_available_balance(), 400)
+
+
+class RecordReplayTransportTests(TestCase):
+    """ RecordReplayTransport related tests """
+    def setUp(self):
+        """ Common setup for methods """
+        super(RecordReplayTransportTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def environments(self, record):
+        return {'test': dict(
+            ENV_IN_MEMORY['test'],
+            transport='pinpayments.transports.RecordReplayTransport',
+            transport_options={'path': self.path, 'record': record},
+        )}
+
+    @patch('requests.Session.get')
+    def test_record_replay(self, mock_request):
+        """ Check recorded responses are replayed in order """
+        mock_request.side_effect = [
+            FakeResponse(200, json.dumps(BALANCE)),
+            FakeResponse(200, json.dumps({'response': {
+                'available': [{'currency': 'AUD', 'amount': 500}],
+                'pending': [],
+            }})),
+        ]
+        with override_settings(PIN_ENVIRONMENTS=self.environments(True)):
+            self.assertEqual(get_environment().get_available_balance(), 400)
+            get_environment().pin_get('/balance')
+        self.assertEqual(mock_request.call_count, 2)
+
+        with override_settings(PIN_ENVIRONMENTS=self.environments(False)):
+            pin_env = get_environment()
+            self.assertEqual(pin_env.get_available_balance(), 400)
+            for _ in range(2):
+                self.assertEqual(
+                    pin_env.pin_get('/balance')[1]['response']['available'],
+                    [{'currency': 'AUD', 'amount': 500}]
+                )
+            with self.assertRaises(PinError):
+                pin_env.pin_get('/charges')
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch('time.sleep')
+    @patch('requests.Session.get')
+    def test_headers(self, mock_request, mock_sleep):
+        """ Check response headers, eg Retry-After, are replayed """
+        unavailable = FakeResponse(503, 'unavailable')
+        unavailable.headers['Retry-After'] = '2'
+        mock_request.side_effect = [
+            unavailable, FakeResponse(200, json.dumps(BALANCE))
+        ]
+        with override_settings(PIN_ENVIRONMENTS=self.environments(True)):
+            get_environment().get_balances()
+
+        with override_settings(PIN_ENVIRONMENTS=self.environments(False)):
+            get_environment().get_balances()
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(
+            [args[0][0] for args in mock_sleep.call_args_list], [2, 2]
+        )
+
+
+@skipUnless(httpx, "httpx is not installed")
+class HttpxTransportTests(TestCase):
+    """ HttpxTransport related tests """
+    async def open_client(self, transport):
+        return transport.client
+
+    def test_close(self):
+        """ Check close() closes the client on the loop that opened it """
+        transport = HttpxTransport(get_async_environment())
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        client = loop.run_until_complete(self.open_client(transport))
+        transport.close()
+        self.assertTrue(client.is_closed)
+        self.assertEqual(transport._clients, {})
+
+    async def test_close_in_loop(self):
+        """ Check close() from a running loop schedules the client's close """
+        transport = HttpxTransport(get_async_environment())
+        client = await self.open_client(transport)
+        transport.close()
+        await asyncio.gather(*transport._closing)
+        self.assertTrue(client.is_closed)
+
+    def test_client_per_loop(self):
+        """ Check each event loop gets its own client """
+        transport = HttpxTransport(get_async_environment())
+        first = asyncio.run(self.open_client(transport))
+        second = asyncio.run(self.open_client(transport))
+        self.assertIsNot(first, second)
+        # The first loop has closed, so its client was dropped
+        self.assertEqual(list(transport._clients.values()), [second])
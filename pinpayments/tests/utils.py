@@ -0,0 +1,49 @@
+""" Ensure that the currency helpers work as intended """
+from decimal import Decimal
+from django.test import TestCase
+from pinpayments.models import PinTransfer
+from pinpayments.utils import (
+    CURRENCIES, CURRENCY_EXPONENTS, get_exponent, get_value, get_values
+)
+
+
+class CurrencyTests(TestCase):
+    """ Currency conversion related tests """
+    def test_registry(self):
+        """ Check every currency has an exponent """
+        self.assertEqual(set(CURRENCY_EXPONENTS), set(CURRENCIES))
+        self.assertEqual(get_exponent('AUD'), 2)
+        self.assertEqual(get_exponent('JPY'), 0)
+        self.assertEqual(get_exponent('MYR'), 0)
+        self.assertEqual(get_exponent('XXX'), 0)
+
+    def test_get_value(self):
+        """ Check base units are converted to the currency's value """
+        self.assertEqual(get_value(1050, 'AUD'), Decimal('10.50'))
+        self.assertEqual(get_value(1050, 'JPY'), Decimal('1050'))
+        self.assertEqual(
+            get_values([(1050, 'AUD'), (1050, 'JPY'), (5, 'USD')]),
+            [Decimal('10.50'), Decimal('1050'), Decimal('0.05')]
+        )
+
+    def test_transfers(self):
+        """ Check transfer values are computed and summed in the database """
+        for amount, currency in ((1050, 'AUD'), (250, 'AUD'), (700, 'JPY')):
+            PinTransfer.objects.create(amount=amount, currency=currency)
+        transfers = PinTransfer.objects.with_value().order_by('amount')
+        self.assertEqual(
+            [(t.db_value, t.value) for t in transfers],
+            [(Decimal('2.50'), Decimal('2.50')),
+             (Decimal('700'), Decimal('700')),
+             (Decimal('10.50'), Decimal('10.50'))]
+        )
+        self.assertEqual(
+            list(PinTransfer.objects.with_value().order_by(
+                '-db_value'
+            ).values_list('amount', flat=True)),
+            [700, 1050, 250]
+        )
+        self.assertEqual(
+            PinTransfer.objects.totals(),
+            {'AUD': Decimal('13.00'), 'JPY': Decimal('700')}
+        )
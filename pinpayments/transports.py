@@ -0,0 +1,337 @@
+"""
+Transports carry requests from a PinEnvironment to Pin, and back.
+Each environment builds its own from the 'transport' key of its settings
+(or 'async_transport', for an AsyncPinEnvironment), which is the dotted
+path to a BaseTransport subclass. Any 'transport_options' are passed to it.
+"""
+from hashlib import sha1
+from urllib.parse import urlsplit
+import asyncio
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .exceptions import ConfigError, PinError
+
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class BaseTransport(object):
+    """
+    Sends requests to Pin for a PinEnvironment.
+    request() (or arequest(), for async environments) receives the method,
+    the full URL and the keyword arguments of requests.request(), and
+    returns a response with status_code, headers, text and json().
+    Failures in transit are raised as one of the errors below, so the
+    environment can decide whether to retry them.
+    """
+    # Raised when a request failed in transit
+    errors = (requests.ConnectionError, requests.Timeout)
+    # Those errors raised before a connection to Pin was made
+    connect_errors = (requests.ConnectTimeout,)
+    # Those errors raised when a request timed out
+    timeout_errors = (requests.Timeout,)
+
+    def __init__(self, pin_env):
+        self.pin_env = pin_env
+
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError(
+            "{0} can't send requests".format(self.__class__.__name__)
+        )
+
+    async def arequest(self, method, url, **kwargs):
+        raise NotImplementedError(
+            "{0} can't send async requests".format(self.__class__.__name__)
+        )
+
+    def close(self):
+        """ Close any connections held by this transport """
+
+    async def aclose(self):
+        self.close()
+
+
+class RequestsTransport(BaseTransport):
+    """
+    Sends requests with a pooled keep-alive requests.Session, sized by the
+    pool_connections, pool_maxsize and pool_block keys of the environment
+    """
+    def __init__(self, pin_env):
+        super(RequestsTransport, self).__init__(pin_env)
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        A pooled keep-alive session, created on first use and shared by
+        every request made through this transport
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=self.pin_env.pool_connections,
+                        pool_maxsize=self.pin_env.pool_maxsize,
+                        pool_block=self.pin_env.pool_block,
+                    )
+                    session.mount('{0}://'.format(self.pin_env.scheme), adapter)
+                    self._session = session
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        return getattr(self.session, method)(url, **kwargs)
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class HttpxTransport(BaseTransport):
+    """
+    Sends async requests with a single pooled httpx.AsyncClient, so they
+    should all come from the same event loop. Requires httpx.
+    """
+    if httpx is not None:
+        errors = (httpx.TransportError,)
+        connect_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+        timeout_errors = (httpx.TimeoutException,)
+
+    def __init__(self, pin_env):
+        super(HttpxTransport, self).__init__(pin_env)
+        # One client per event loop, as a client's connections can only be
+        # used from the loop that opened them
+        self._clients = {}
+        self._lock = threading.Lock()
+        # Tasks closing clients from close(), kept so they can finish
+        self._closing = set()
+
+    @property
+    def client(self):
+        """
+        The pooled keep-alive httpx.AsyncClient of the running event loop,
+        created on first use there and shared by every request made from
+        it. Clients left behind by loops that have since closed are dropped.
+        """
+        if httpx is None:
+            raise ConfigError("httpx must be installed to use HttpxTransport")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                for closed in [other for other in self._clients
+                               if other is not None and other.is_closed()]:
+                    del self._clients[closed]
+                client = self._clients[loop] = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=self.pin_env.pool_maxsize,
+                        max_keepalive_connections=self.pin_env.pool_maxsize,
+                    )
+                )
+        return client
+
+    async def arequest(self, method, url, **kwargs):
+        if isinstance(kwargs.get('timeout'), tuple):
+            connect, read = kwargs['timeout']
+            kwargs['timeout'] = httpx.Timeout(read, connect=connect)
+        if isinstance(kwargs.get('data'), bytes):
+            # httpx takes an encoded body as content
+            kwargs['content'] = kwargs.pop('data')
+        return await getattr(self.client, method)(url, **kwargs)
+
+    def close(self):
+        """
+        An AsyncClient can only be closed on the event loop it was used
+        from: if that loop is running, closing is scheduled on it,
+        otherwise it's run there now. Once the loop is closed it's too
+        late, so call aclose() from it before then.
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for loop, client in clients.items():
+            # A client made outside any loop holds no connections
+            if loop is None or loop.is_closed():
+                continue
+            if loop is current:
+                task = loop.create_task(client.aclose())
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+            elif loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+            else:
+                loop.run_until_complete(client.aclose())
+
+    async def aclose(self):
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+        self.close()
+
+
+def _url_tail(url):
+    """ The part of a Pin URL after the API version, eg /charges """
+    path = urlsplit(url).path
+    if path.startswith('/1/'):
+        path = path[2:]
+    return path
+
+
+def _make_response(status_code, content, headers=None):
+    """ A requests Response holding the given body """
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content.encode('utf-8')
+    response.headers.update(headers or {})
+    response.encoding = 'utf-8'
+    return response
+
+
+class InMemoryTransport(BaseTransport):
+    """
+    Answers requests from canned responses, without any network access.
+    Add them with add(); every request sent is kept in requests. Works for
+    both sync and async environments, eg in tests:
+
+        transport = get_environment().transport
+        transport.add('POST', '/charges', 201, {'response': {...}})
+    """
+    def __init__(self, pin_env):
+        super(InMemoryTransport, self).__init__(pin_env)
+        self.routes = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def add(self, method, url_tail, status_code=200, data=None, headers=None,
+            exc=None):
+        """
+        Queue a response to the next method request to url_tail, either
+        data encoded as JSON or, if given, the exception exc raised instead.
+        Queued responses are used in order; the last one is repeated.
+        """
+        outcome = exc
+        if outcome is None:
+            outcome = _make_response(status_code, json.dumps(data), headers)
+        with self._lock:
+            self.routes.setdefault(
+                (method.lower(), url_tail), []
+            ).append(outcome)
+
+    def clear(self):
+        """ Forget every queued response and sent request """
+        with self._lock:
+            self.routes.clear()
+            del self.requests[:]
+
+    def request(self, method, url, **kwargs):
+        url_tail = _url_tail(url)
+        with self._lock:
+            self.requests.append((method, url_tail, kwargs))
+            queued = self.routes.get((method, url_tail))
+            if not queued:
+                return _make_response(404, json.dumps({
+                    'error': 'not_found',
+                    'error_description': 'No response added for {0} {1}'.format(
+                        method.upper(), url_tail
+                    ),
+                }))
+            outcome = queued.pop(0) if len(queued) > 1 else queued[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def arequest(self, method, url, **kwargs):
+        return self.request(method, url, **kwargs)
+
+
+class RecordReplayTransport(BaseTransport):
+    """
+    Replays responses recorded from Pin, stored as JSON files in the
+    directory given by the 'path' option. With 'record': True, requests are
+    sent to Pin with RequestsTransport and their responses saved there
+    first. Requests are matched on method, URL and parameters. A repeated
+    request gets each recorded response in turn, then the last again.
+    """
+    def __init__(self, pin_env, path, record=False):
+        super(RecordReplayTransport, self).__init__(pin_env)
+        self.path = path
+        self.record = record
+        self.seen = {}
+        self._lock = threading.Lock()
+        self._live = RequestsTransport(pin_env) if record else None
+
+    def _filename(self, method, url, kwargs):
+        """ The file holding the next recording of a request """
+        url_tail = _url_tail(url)
+        fingerprint = sha1(json.dumps(
+            [method, url_tail, kwargs.get('params'), kwargs.get('data'),
+             kwargs.get('json')],
+            sort_keys=True, default=str
+        ).encode('utf-8')).hexdigest()[:12]
+        prefix = os.path.join(self.path, '{0}{1}_{2}'.format(
+            method, url_tail.replace('/', '_'), fingerprint
+        ))
+        with self._lock:
+            count = self.seen.get(fingerprint, 0)
+            filename = '{0}_{1}.json'.format(prefix, count)
+            if self.record or os.path.exists(filename):
+                self.seen[fingerprint] = count + 1
+            elif count:
+                # The recordings have run out, so repeat the last one
+                filename = '{0}_{1}.json'.format(prefix, count - 1)
+        return filename
+
+    def request(self, method, url, **kwargs):
+        filename = self._filename(method, url, kwargs)
+        if self.record:
+            response = self._live.request(method, url, **kwargs)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(filename, 'w') as recording:
+                json.dump({
+                    'method': method.upper(),
+                    'url': _url_tail(url),
+                    'status_code': response.status_code,
+                    'headers': dict(response.headers),
+                    'body': response.text,
+                }, recording, indent=2, sort_keys=True)
+            return response
+
+        if not os.path.exists(filename):
+            raise PinError(
+                "No recorded response for {0} {1} in {2}".format(
+                    method.upper(), _url_tail(url), self.path
+                )
+            )
+        with open(filename) as recording:
+            recorded = json.load(recording)
+        return _make_response(
+            recorded['status_code'], recorded['body'], recorded['headers']
+        )
+
+    async def arequest(self, method, url, **kwargs):
+        if self.record:
+            raise ConfigError("Responses can only be recorded synchronously")
+        return self.request(method, url, **kwargs)
+
+    def close(self):
+        if self._live is not None:
+            self._live.close()
@@ -1,7 +1,10 @@
 """
 Utility functions without objects
 """
-from decimal import Decimal
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db.models import Case, DecimalField, F, Value, When
+from django.db.models.functions import Cast
 
 
 CURRENCIES = (
@@ -36,7 +39,7 @@ DECIMAL_CURRENCIES = (
 
 
 SINGLE_UNIT_CURRENCIES = (
-    "JPY"
+    "JPY",
     "MYR",
     "THB",
     "PHP",
@@ -45,6 +48,13 @@ SINGLE_UNIT_CURRENCIES = (
     "TWD",
 )
 
+# The number of decimal places in each currency's major unit, ie amounts
+# in the base unit are divided by 10 ** exponent to get the value
+CURRENCY_EXPONENTS = dict(
+    [(currency, 2) for currency in DECIMAL_CURRENCIES] +
+    [(currency, 0) for currency in SINGLE_UNIT_CURRENCIES]
+)
+
 CURRENCY_DETAIL = {
     "AUD": {
         "symbol": "$",
@@ -109,12 +119,64 @@ CURRENCY_DETAIL = {
 }
 
 
+def get_exponent(currency):
+    """ The number of decimal places of currency, 0 if it's unknown """
+    return CURRENCY_EXPONENTS.get(currency, 0)
+
+
 def get_value(amount, currency):
     """
     Returns the value of the transfer in the representation of the
     currency it is in, without symbols
     That is, 1000 cents as 10.00, 1000 yen as 1000
     """
-    if currency in DECIMAL_CURRENCIES:
-        return Decimal(amount)/Decimal(100)
-    return Decimal(amount)
+    return Decimal(amount).scaleb(-CURRENCY_EXPONENTS.get(currency, 0))
+
+
+def get_minor_units(value, currency):
+    """
+    Returns a value in the currency's usual unit as an integer amount of
+    its base unit, the reverse of get_value
+    That is, 10.00 dollars as 1000 cents, 1000 yen as 1000
+    """
+    return int(Decimal(value).scaleb(
+        CURRENCY_EXPONENTS.get(currency, 0)
+    ).to_integral_value(ROUND_HALF_UP))
+
+
+def get_values(pairs):
+    """
+    Returns the value of each (amount, currency) pair, as get_value does.
+    pairs can be any iterable, such as a values_list('amount', 'currency')
+    queryset, and is read once.
+    """
+    exponents = CURRENCY_EXPONENTS
+    return [
+        Decimal(amount).scaleb(-exponents.get(currency, 0))
+        for amount, currency in pairs
+    ]
+
+
+def value_expression(amount='amount', currency='currency'):
+    """
+    A database expression computing get_value() of the amount and currency
+    fields, for use in annotate(), order_by() or aggregates
+    """
+    output_field = DecimalField(max_digits=20, decimal_places=2)
+    whens = [
+        When(**{
+            currency + '__in': [
+                code for code, places in CURRENCY_EXPONENTS.items()
+                if places == exponent
+            ],
+            'then': Cast(F(amount), output_field) * Value(
+                Decimal(1).scaleb(-exponent), output_field=output_field
+            ),
+        })
+        for exponent in sorted(set(CURRENCY_EXPONENTS.values())) if exponent
+    ]
+    return Case(
+        *whens,
+        default=Cast(F(amount), output_field),
+        output_field=output_field
+    )
@@ -131,6 +131,7 @@ setup(
     package_data=find_package_data("pinpayments", only_in_packages=False),
     include_package_data=True,
     zip_safe=False,
-    install_requires=['setuptools','requests','django'],
+    install_requires=['setuptools','requests','django>=3.1'],
+    extras_require={'async': ['httpx']},
 )
 